@@ -1,8 +1,18 @@
 import tkinter as tk
 from tkinter import ttk
+from tkinter.scrolledtext import ScrolledText
 import subprocess
 import configparser
+import threading
+import queue
+import signal
+import re
 import os
+import sys
+from multiprocessing import AuthenticationError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controllers'))
+from session import stop_session
 
 # --- Configuration ---
 CONFIG_FILE = 'params.ini'
@@ -10,54 +20,189 @@ DETECT_SCRIPT = os.path.join('controllers', 'detect.py')
 EXPERIMENT_SCRIPT = os.path.join('controllers', 'experiment.py')
 CALIBRATION_SCRIPT = os.path.join('controllers', 'calibration.py')
 PLOTTER_SCRIPT = os.path.join('controllers', 'plotter.py')
+SESSION_SCRIPT = os.path.join('controllers', 'session.py')
+
+POLL_MS = 100           # how often the log pane drains the output queue
+CANCEL_GRACE_MS = 15000 # time a cancelled job gets to stop the magnet before it is killed
+SESSION_STOP_SEC = 10   # time the session gets to release the instruments before it is killed
+PROGRESS_RE = re.compile(r"^\[(\d+)/(\d+)\]")  # scripts prefix sweep points with [i/n]
+TRACE_RE = re.compile(r"^\[trace\] (.*)")        # I/O counters, see controllers/tracing.py
 
 # --- Backend Functions ---
 
+# the job currently running, and the queue its reader threads feed
+job = {'process': None, 'script': None, 'cancelled': False}
+output_queue = queue.Queue()
+# the long-lived instrument session, see controllers/session.py
+session = {'process': None}
+
+def _pipe_reader(stream, tag):
+    """Worker thread: forwards each line of a pipe to the output queue."""
+    for line in iter(stream.readline, ''):
+        output_queue.put((tag, line))
+    stream.close()
+
+def _wait_for_job(process, readers):
+    """Worker thread: reports the exit code once the process and its pipes are done."""
+    for reader in readers:
+        reader.join()
+    output_queue.put(('done', process.wait()))
+
 def run_script(script_name):
-    """Runs a Python script using subprocess and updates the status bar."""
+    """
+    Starts a Python script in a subprocess without blocking the GUI.
+    Its stdout/stderr are streamed into the log pane by _poll_output().
+    """
+    if job['process'] is not None:
+        status_var.set(f"{job['script']} is still running, cancel it first.")
+        return
     status_var.set(f"Running {script_name}...")
-    
+    progress_var.set(0)
+    trace_var.set("")
+    _append_log(f"$ python {script_name}\n", 'info')
+
     try:
         print(f"Starting subprocess: python {script_name}")
-        process = subprocess.Popen(['python', script_name], 
-                                   stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE, 
-                                   text=True)
-        
-        # Wait for the process to complete, get output
-        stdout, stderr = process.communicate()
-        
-        # --- Print output to console ---
-        print("--- Script Output ---")
-        if stdout:
-            print(f"stdout: {stdout.strip()}")
-        if stderr:
-            # This is key: errors are printed to the console
-            print(f"stderr: {stderr.strip()}")
-        print("---------------------")
-
-        # --- Check for errors ---
-        if process.returncode != 0:
-            # The script failed!
-            print(f"Error: {script_name} exited with code {process.returncode}")
-            status_var.set(f"{script_name} errored, see console for more details")
-        else:
-            # Success
-            status_var.set(f"{script_name} finished.")
-
-    except subprocess.TimeoutExpired:
-        process.kill() # Stop the process if it times out
-        print(f"Error: {script_name} timed out after 30 seconds.")
-        status_var.set(f"Error: {script_name} timed out!")
-        
+        process, readers = _start_process(script_name)
     except FileNotFoundError:
         print(f"Error: Script '{script_name}' not found.")
         status_var.set(f"Error: {script_name} not found!")
-
+        return
     except Exception as e:
         # Catch other unexpected errors
         status_var.set(f"Error running {script_name}!")
         print(f"An unexpected error occurred: {e}")
+        return
+
+    job.update(process=process, script=script_name, cancelled=False)
+    threading.Thread(target=_wait_for_job, args=(process, readers), daemon=True).start()
+
+def _start_process(script_name, stdout_tag='stdout'):
+    """Starts an unbuffered Python script with reader threads on its pipes."""
+    # a new process group lets us send CTRL_BREAK to the child alone on Windows
+    flags = subprocess.CREATE_NEW_PROCESS_GROUP if os.name == 'nt' else 0
+    process = subprocess.Popen(['python', '-u', script_name],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               text=True,
+                               bufsize=1,
+                               creationflags=flags)
+    readers = [threading.Thread(target=_pipe_reader, args=(process.stdout, stdout_tag), daemon=True),
+               threading.Thread(target=_pipe_reader, args=(process.stderr, 'stderr'), daemon=True)]
+    for reader in readers:
+        reader.start()
+    return process, readers
+
+def _interrupt(process):
+    """Ctrl+C for a child started by _start_process()."""
+    if os.name == 'nt':
+        process.send_signal(signal.CTRL_BREAK_EVENT)
+    else:
+        process.send_signal(signal.SIGINT)
+
+def _stop_session(process):
+    """
+    Asks the session to shut down and release the instruments; Ctrl+C does
+    not interrupt its accept() on Windows. Kills it if it does not exit in time.
+    """
+    try:
+        stop_session()
+    except (OSError, EOFError, AuthenticationError):
+        # not listening (yet or any more)
+        _interrupt(process)
+    try:
+        process.wait(SESSION_STOP_SEC)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def _append_log(text, tag):
+    log_text.configure(state='normal')
+    log_text.insert(tk.END, text, tag)
+    log_text.see(tk.END)
+    log_text.configure(state='disabled')
+
+def _poll_output():
+    """Runs on the Tk main loop: moves queued output into the log pane."""
+    try:
+        while True:
+            tag, item = output_queue.get_nowait()
+            if tag == 'done':
+                _finish_job(item)
+                continue
+            # live I/O counters go to the trace bar, not the log
+            match = TRACE_RE.match(item)
+            if match:
+                trace_var.set(match.group(1))
+                continue
+            # --- Print output to console as well ---
+            print(item, end='')
+            _append_log(item, tag)
+            match = PROGRESS_RE.match(item)
+            if match:
+                done, total = map(int, match.groups())
+                progress_var.set(100.0 * done / total)
+                status_var.set(f"Running {job['script']}: point {done}/{total}")
+    except queue.Empty:
+        pass
+    root.after(POLL_MS, _poll_output)
+
+def _finish_job(returncode):
+    script_name = job['script']
+    # --- Check for errors ---
+    if job['cancelled']:
+        status_var.set(f"{script_name} cancelled.")
+    elif returncode != 0:
+        # The script failed!
+        print(f"Error: {script_name} exited with code {returncode}")
+        status_var.set(f"{script_name} errored, see log for more details")
+    else:
+        # Success
+        progress_var.set(100)
+        status_var.set(f"{script_name} finished.")
+    _append_log(f"[exit code {returncode}]\n", 'info')
+    job.update(process=None, script=None, cancelled=False)
+
+def on_cancel_click():
+    """
+    Asks the running job to stop. Sweep scripts catch the interrupt and
+    stop the magnet before exiting; the job is killed if it does not exit in time.
+    """
+    process = job['process']
+    if process is None:
+        status_var.set("Nothing to cancel.")
+        return
+    job['cancelled'] = True
+    status_var.set(f"Cancelling {job['script']}...")
+    _interrupt(process)
+    root.after(CANCEL_GRACE_MS, lambda: process.poll() is None and process.kill())
+
+def on_session_click():
+    """
+    Starts or stops the instrument session. While it runs, sweep scripts use
+    its already connected instruments instead of connecting their own.
+    """
+    process = session['process']
+    if process is not None and process.poll() is None:
+        _stop_session(process)
+        session['process'] = None
+        session_button_var.set("Start Session")
+        status_var.set("Instrument session stopped.")
+        return
+    try:
+        session['process'], _ = _start_process(SESSION_SCRIPT, stdout_tag='info')
+    except Exception as e:
+        status_var.set("Error starting instrument session!")
+        print(f"An unexpected error occurred: {e}")
+        return
+    session_button_var.set("Stop Session")
+    status_var.set("Instrument session started.")
+
+def on_close():
+    """Stops the instrument session along with the window."""
+    if session['process'] is not None and session['process'].poll() is None:
+        _stop_session(session['process'])
+    root.destroy()
 
 def load_config():
     """Loads values from params.ini into the GUI's variables."""
@@ -74,6 +219,8 @@ def load_config():
         exp_high_var.set(config.get('Experiment', 'high', fallback='1'))
         exp_step_var.set(config.get('Experiment', 'step', fallback='0.1'))
         exp_unit_var.set(config.get('Experiment', 'unit', fallback='A'))
+        exp_refine_var.set(config.get('Experiment', 'refine', fallback='0'))
+        exp_live_var.set(config.get('Experiment', 'live', fallback='0'))
         
         # Load Calibration tab values
         cal_res_var.set(config.get('Calibration', 'cal_res', fallback='800'))
@@ -101,6 +248,8 @@ def save_config():
         config['Experiment']['high'] = exp_high_var.get()
         config['Experiment']['step'] = exp_step_var.get()
         config['Experiment']['unit'] = exp_unit_var.get()
+        config['Experiment']['refine'] = exp_refine_var.get() or '0'
+        config['Experiment']['live'] = exp_live_var.get()
         
         # Save Calibration tab values
         config['Calibration']['cal_res'] = cal_res_var.get()
@@ -161,6 +310,12 @@ def _validate_float(new_value):
     except ValueError:
         return False
 
+def _validate_int(new_value):
+    """
+    Validation function to allow empty string, or a non-negative integer.
+    """
+    return new_value == "" or (new_value.isascii() and new_value.isdigit())
+
 # --- END OF NEW VALIDATION CODE ---
 
 
@@ -173,6 +328,7 @@ root.title("Instrument Controller")
 # --- REGISTER THE VALIDATION COMMAND ---
 # We register it with the root window
 vcmd_float = (root.register(_validate_float), '%P')
+vcmd_int = (root.register(_validate_int), '%P')
 # '%P' is a substitution code: it passes the "value if change is allowed" to our function
 
 # Create string variables to hold the values from our widgets
@@ -180,8 +336,13 @@ exp_low_var = tk.StringVar()
 exp_high_var = tk.StringVar()
 exp_step_var = tk.StringVar()
 exp_unit_var = tk.StringVar(value='A') # Default value
+exp_refine_var = tk.StringVar(value='0')
+exp_live_var = tk.StringVar(value='0')
 cal_res_var = tk.StringVar()
 status_var = tk.StringVar(value="Ready. Load config or enter values.")
+progress_var = tk.DoubleVar(value=0)
+trace_var = tk.StringVar(value="")
+session_button_var = tk.StringVar(value="Start Session")
 
 # --- Create the Tabbed Interface ---
 tab_control = ttk.Notebook(root)
@@ -218,16 +379,27 @@ exp_step_entry = ttk.Entry(exp_inputs_frame,
                            validatecommand=vcmd_float)
 exp_step_entry.grid(row=2, column=1, sticky='ew')
 
+ttk.Label(exp_inputs_frame, text="Refine pts:").grid(row=3, column=0, sticky='w', pady=5)
+exp_refine_entry = ttk.Entry(exp_inputs_frame,
+                             textvariable=exp_refine_var,
+                             validate='key',
+                             validatecommand=vcmd_int)
+exp_refine_entry.grid(row=3, column=1, sticky='ew')
+
 # Radio buttons
 radio_frame = ttk.Frame(exp_inputs_frame)
-radio_frame.grid(row=3, column=0, columnspan=2, pady=10)
+radio_frame.grid(row=4, column=0, columnspan=2, pady=10)
 ttk.Radiobutton(radio_frame, text="A", variable=exp_unit_var, value="A").pack(side=tk.LEFT, padx=5)
 ttk.Radiobutton(radio_frame, text="mT", variable=exp_unit_var, value="mT").pack(side=tk.LEFT, padx=5)
+ttk.Checkbutton(exp_inputs_frame, text="Live plot", variable=exp_live_var,
+                onvalue='1', offvalue='0').grid(row=5, column=0, columnspan=2, sticky='w')
 
 # Buttons
 ttk.Button(exp_buttons_frame, text="Detect Insts!", command=on_detect_click).pack(fill=tk.X, pady=5)
+ttk.Button(exp_buttons_frame, textvariable=session_button_var, command=on_session_click).pack(fill=tk.X, pady=5)
 ttk.Button(exp_buttons_frame, text="Plot", command=on_plot_click).pack(fill=tk.X, pady=5) # <-- NEW
 ttk.Button(exp_buttons_frame, text="START Exp", command=on_start_exp_click, style='Accent.TButton').pack(fill=tk.X, pady=5)
+ttk.Button(exp_buttons_frame, text="Cancel", command=on_cancel_click).pack(fill=tk.X, pady=5)
 
 # -- Calibration Tab --
 tab_cal = ttk.Frame(tab_control, padding=10)
@@ -249,7 +421,9 @@ cal_res_entry.grid(row=0, column=1, sticky='ew')
 
 # Buttons
 ttk.Button(cal_buttons_frame, text="Detect Insts!", command=on_detect_click).pack(fill=tk.X, pady=5)
+ttk.Button(cal_buttons_frame, textvariable=session_button_var, command=on_session_click).pack(fill=tk.X, pady=5)
 ttk.Button(cal_buttons_frame, text="START CAL", command=on_start_cal_click, style='Accent.TButton').pack(fill=tk.X, pady=5)
+ttk.Button(cal_buttons_frame, text="Cancel", command=on_cancel_click).pack(fill=tk.X, pady=5)
 
 # --- Style and Status Bar ---
 
@@ -258,12 +432,27 @@ style = ttk.Style()
 style.configure('Accent.TButton', font=('Helvetica', 10, 'bold'), foreground='blue')
 
 # Add the main tab control to the window
-tab_control.pack(expand=1, fill='both')
-
-# Add status bar
-status_bar = ttk.Label(root, textvariable=status_var, relief=tk.SUNKEN, anchor=tk.W, padding=5)
-status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+tab_control.pack(fill='x')
+
+# Add status bar with the sweep progress
+status_frame = ttk.Frame(root)
+status_frame.pack(side=tk.BOTTOM, fill=tk.X)
+status_bar = ttk.Label(status_frame, textvariable=status_var, relief=tk.SUNKEN, anchor=tk.W, padding=5)
+status_bar.pack(side=tk.LEFT, fill=tk.X, expand=1)
+progress_bar = ttk.Progressbar(status_frame, variable=progress_var, maximum=100, length=150)
+progress_bar.pack(side=tk.RIGHT, padx=5)
+# instrument I/O counters, when the scripts run with SWEEP_TRACE=counters
+trace_bar = ttk.Label(root, textvariable=trace_var, anchor=tk.W, padding=(5, 0), foreground='gray')
+trace_bar.pack(side=tk.BOTTOM, fill=tk.X)
+
+# Add the job log pane
+log_text = ScrolledText(root, height=12, width=80, state='disabled', font=('Courier', 9))
+log_text.tag_configure('stderr', foreground='red')
+log_text.tag_configure('info', foreground='gray')
+log_text.pack(expand=1, fill='both', padx=5, pady=5)
 
 # --- Load initial data and run ---
 load_config()
+root.after(POLL_MS, _poll_output)
+root.protocol("WM_DELETE_WINDOW", on_close)
 root.mainloop()
\ No newline at end of file
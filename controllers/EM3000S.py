@@ -1,59 +1,149 @@
 import pyvisa
 import time,os
+from collections import namedtuple
 import numpy as np
-import pandas as pd
 from dotenv import load_dotenv
+from calibration_model import FieldCalibration
+from tracing import tracer, traced
+from transport import resource_manager
 
 load_dotenv()
 
+# --- Serial protocol tables -----------------------------------------------------
+ACK = 0x12              # "command done" byte the controller sends after START/STOP/END
+BYTE_TIMEOUT_MS = 250   # a plain one-byte acknowledgement
+ACK_TIMEOUT_MS = 2000   # waiting for ACK while the supply ramps
+
+# One exchange of the handshake.
+#   tx:         bytes to write (may be empty when only a reply is expected)
+#   replies:    number of reply bytes to read
+#   until:      keep reading single bytes until this one arrives (overrides replies)
+#   echo:       write the reply straight back, as the query handshake requires
+#   timeout_ms: read timeout for this step
+#   pipelined:  may be written back-to-back with neighbouring pipelined steps,
+#               their replies are then collected in one bulk read
+Step = namedtuple("Step", ["tx", "replies", "until", "echo", "timeout_ms", "pipelined"],
+                  defaults=(1, None, False, BYTE_TIMEOUT_MS, False))
+
+def start_steps(value_bytes):
+    """The 10-step START sequence that sets a new output value."""
+    return [
+        Step(b"\x64", pipelined=True),                        # 1. Ready
+        Step(b"\x64", pipelined=True),                        # 2. Ready
+        Step(b"\x1E", until=ACK, timeout_ms=ACK_TIMEOUT_MS),  # 3. Start
+        Step(b"\x64", pipelined=True),                        # 4. Ready
+        Step(b"\x2C", pipelined=True),                        # 5. Set Value
+        # 6-9. the 4-byte value, each byte is acknowledged
+        *(Step(bytes([b]), pipelined=True) for b in value_bytes),
+        Step(b"\x00", until=ACK, timeout_ms=ACK_TIMEOUT_MS),  # 10. End Command
+    ]
+
+QUERY_STEPS = (
+    Step(b"\x64"),                                        # Ready Check
+    Step(b"\x2B", until=ACK, timeout_ms=ACK_TIMEOUT_MS),  # Stop Cmd
+    Step(b"\x0A", echo=True),                             # Query -> Field Mag High Byte
+    Step(b"", echo=True),                                 # Field Mag Low Byte
+    Step(b"", echo=True),                                 # Field Sign Flag
+)
+
+# We use the sequence from the -1.0A log (packets_-1.txt)
+# as it seems to be a reliable "set to zero"
+STOP_STEPS = (
+    Step(b"\x4E"),
+    Step(b"\x00", replies=0),                             # No response in log
+    Step(b"\x64"),                                        # Ready Check
+    Step(b"\x82", until=ACK, timeout_ms=ACK_TIMEOUT_MS),  # End Cmd
+)
+
+# --- DAC encoding ----------------------------------------------------------------
+MAX_CURRENT_A = 4.0  # output limit of the supply
+
+class DacEncoder:
+    """
+    Current (A) -> 4-byte DAC payload [code high, code low, 0x00, sign],
+    sign 0x01 for positive and 0x00 for negative currents.
+    The payloads for every reachable code are built once; encoding is a table lookup.
+    """
+    def __init__(self, coeffs, max_current=MAX_CURRENT_A):
+        self.coeffs = tuple(coeffs)
+        self.max_current = max_current
+        self.max_code = int(np.polyval(self.coeffs, np.linspace(0, max_current, 4097)).max())
+        if self.max_code > 0xFFFF:
+            raise ValueError(f"DAC code {self.max_code} at {max_current} A does not fit in two bytes.")
+        codes = np.arange(self.max_code + 1)
+        # table[sign, code] -> payload, sign index 1 for positive currents
+        self.table = np.zeros((2, codes.size, 4), dtype=np.uint8)
+        self.table[:, :, 0] = codes >> 8
+        self.table[:, :, 1] = codes & 0xFF
+        self.table[1, :, 3] = 1
+        self._payloads = [[bytes(row) for row in sign] for sign in self.table]
+
+    def codes(self, currents):
+        """DAC codes for current magnitudes, truncated and clipped to zero like the supply expects."""
+        codes = np.polyval(self.coeffs, np.abs(currents)).astype(np.int64)
+        return np.clip(codes, 0, self.max_code)
+
+    def validate(self, currents):
+        """Raises ValueError if any current is not finite or exceeds the supply limit."""
+        currents = np.asarray(currents, dtype=float)
+        bad = np.flatnonzero(~(np.abs(currents) <= self.max_current))
+        if bad.size:
+            shown = ", ".join(f"#{i}: {currents.flat[i]}" for i in bad[:5])
+            raise ValueError(f"{bad.size} current(s) outside +/-{self.max_current} A ({shown}).")
+        return currents
+
+    def encode(self, current):
+        """Payload for a single current, as bytes."""
+        self.validate(current)
+        return self._payloads[int(current >= 0)][int(self.codes(current))]
+
+    def encode_many(self, currents):
+        """Payloads for a whole array of currents at once, as an (n, 4) uint8 array."""
+        currents = self.validate(currents)
+        return self.table[(currents >= 0).astype(np.intp), self.codes(currents)]
+
 class MagnetController:
     """
     A PyVISA-based controller for the Holmarc EM-series electromagnet
     based on reverse-engineered packet captures.
     
     Protocol: 19200 Baud, 8-N-1, Raw Byte Commands
+    The handshakes are described as Step tables and run by _run_steps().
     """
     startup_delay_sec = -2.0  # Time to wait 
+    # back-to-back writes of the pipelined steps; off (lock-step, as captured) until a
+    # hardware capture shows the supply keeps up, MAGNET_PIPELINING=1 turns it on
+    pipelining = os.getenv("MAGNET_PIPELINING", "0") not in ("", "0")
 
-    def _current_map(self,current_amps):
-        """Returns the 4-byte value array for a given current in Amps."""
-        def map_func(amp):
-            # amp = int((1299-35)/(4.0-0.1)*amp)
-            amp = 4.76264*amp**3 + 2.00444*amp**2 + 252.08648*amp - 8.46937
-            print(amp)
-            return int(amp)
-        pos = 1
-        if current_amps<0:
-            current_amps = abs(current_amps)
-            pos = 0
-        mapped = hex(map_func(current_amps))
-        return_list = [0x00]*4
-        try:
-            return_list[1] = int(mapped[-2:],16)
-        except ValueError:
-            return_list[1] = 0
-        if (zeroth:=mapped.split('x')[1][:-2])!='':
-            return_list[0] = int(zeroth,16)
-        return_list[-1] = pos
-        return return_list
+    def _current_map(self, current_amps):
+        """Returns the 4-byte value for a given current in Amps."""
+        return self.dac.encode(current_amps)
 
     def __init__(self, resource_name=os.getenv("EM_ID")):
         self.resource_name = resource_name
         self.baud_rate = 19200
         self.inst = None
-        self.rm = pyvisa.ResourceManager()
+        self._timeout_ms = None
+        self.calibration = FieldCalibration()  # loaded on first set_field()
+        self.dac_coeffs = self.calibration.dac_coeffs()  # current -> DAC code
+        self.dac = DacEncoder(self.dac_coeffs)
+        # last field set, to pick the hysteresis branch of the next approach
+        self._last_field = 0.0
+        self._branch = 'up'
+        self.rm = resource_manager(source='magnet')  # pyvisa, or record/replay, see transport.py
 
     def connect(self):
         """Initializes and configures the serial connection."""
         print(f"Connecting to {self.resource_name} at {self.baud_rate} baud...")
-        self.inst = self.rm.open_resource(self.resource_name)
+        self.inst = traced(self.rm.open_resource(self.resource_name), 'magnet')
         self.inst.baud_rate = self.baud_rate
         self.inst.data_bits = 8
         self.inst.parity = pyvisa.constants.Parity.none
         self.inst.stop_bits = pyvisa.constants.StopBits.one
         self.inst.write_termination = None
         self.inst.read_termination = None
-        self.inst.timeout = 2000  # 2-second timeout
+        self.inst.timeout = 2000  # 2-second timeout, steps set their own
+        self._timeout_ms = 2000
         self.inst.clear()
         print("Connection successful.")
         return True
@@ -79,29 +169,96 @@ class MagnetController:
                 response = self.inst.read_bytes(1)[0]
                 if response == expected_byte:
                     return response
+                tracer.emit('magnet', 'retry', f"got 0x{response:02X}, waiting for 0x{expected_byte:02X}",
+                            status='retry')
         except pyvisa.errors.VisaIOError:
             return None
 
+    def _set_timeout(self, timeout_ms):
+        """Only touch the VISA attribute when the value actually changes."""
+        if self._timeout_ms != timeout_ms:
+            self.inst.timeout = timeout_ms
+            self._timeout_ms = timeout_ms
+
+    def _exchange(self, step):
+        """Runs a single step, returns the reply as an int, or None."""
+        self._set_timeout(step.timeout_ms)
+        if step.tx:
+            self.inst.write_raw(step.tx)
+        if step.until is not None:
+            return self._poll_for_byte(step.until)
+        if step.replies == 0:
+            return None
+        reply = self._read_one_byte()
+        if step.echo and reply is not None:
+            self.inst.write_raw(bytes([reply]))
+        return reply
+
+    def _exchange_pipelined(self, steps):
+        """
+        Writes a run of pipelined steps in one go, then reads their replies.
+        The replies that arrived before a timeout are kept, the steps after it
+        get None, as in lock-step.
+        """
+        self._set_timeout(max(step.timeout_ms for step in steps))
+        self.inst.write_raw(b"".join(step.tx for step in steps))
+        raw = []
+        for _ in range(sum(step.replies for step in steps)):
+            reply = self._read_one_byte()
+            if reply is None:
+                break
+            raw.append(reply)
+        replies, pos = [], 0
+        for step in steps:
+            replies.append(raw[pos] if step.replies and pos < len(raw) else None)
+            pos += step.replies
+        return replies
+
+    def _run_steps(self, steps, name='steps'):
+        """
+        Runs a table of protocol steps, batching consecutive pipelined steps.
+        Returns one reply per step (int, or None for no reply/timeout).
+        `name` labels the handshake and its steps in the trace, e.g. 'START 3'.
+        """
+        replies = []
+        i = 0
+        with tracer.span('magnet', 'handshake', name):
+            while i < len(steps):
+                j = i + 1
+                if self.pipelining and steps[i].pipelined:
+                    while j < len(steps) and steps[j].pipelined:
+                        j += 1
+                if j - i > 1:
+                    with tracer.span('magnet', 'step', f"{name} {i+1}-{j}"):
+                        replies.extend(self._exchange_pipelined(steps[i:j]))
+                else:
+                    with tracer.span('magnet', 'step', f"{name} {i+1}"):
+                        replies.append(self._exchange(steps[i]))
+                i = j
+        return replies
+
     def _run_start_sequence(self, value_bytes):
         """Sends the full 10-step START sequence."""
         print(f"  Sending START sequence: {[f'0x{b:02X}' for b in value_bytes]}")
-        
-        self.inst.write_raw(bytes([0x64])); self._read_one_byte() # 1. Ready
-        self.inst.write_raw(bytes([0x64])); self._read_one_byte() # 2. Ready
-        self.inst.write_raw(bytes([0x1E])); self._poll_for_byte(0x12) # 3. Start
-        self.inst.write_raw(bytes([0x64])); self._read_one_byte() # 4. Ready
-        self.inst.write_raw(bytes([0x2C])); self._read_one_byte() # 5. Set Value
-        
-        # Steps 6-9: Send the 4-byte value
-        self.inst.write_raw(bytes([value_bytes[0]])); self._read_one_byte()
-        self.inst.write_raw(bytes([value_bytes[1]])); self._read_one_byte()
-        self.inst.write_raw(bytes([value_bytes[2]])); self._read_one_byte()
-        self.inst.write_raw(bytes([value_bytes[3]])); self._read_one_byte()
-        
-        # Step 10: End Command
-        self.inst.write_raw(bytes([0x00])); self._poll_for_byte(0x12)
+        self._run_steps(start_steps(value_bytes), 'START')
         print("  START sequence complete.")
 
+    def _query_bytes(self):
+        """Runs the query handshake, returns the 3 field bytes or None on failure."""
+        field_bytes = self._run_steps(QUERY_STEPS, 'QUERY')[2:]
+        if None in field_bytes:
+            return None
+        return field_bytes
+
+    @staticmethod
+    def _decode_field(byte1, byte2, byte3):
+        """Decodes the 3 query bytes to a field in mT."""
+        raw_magnitude = (byte1 << 8) | byte2
+        scaled_magnitude = raw_magnitude / 10.0 # Our 10x scaling factor
+
+        # Sign Flag: 0x01 = Negative, 0x00 = Positive
+        return -scaled_magnitude if byte3 == 0x01 else scaled_magnitude
+
     def set_current(self, amps):
         """
         Sets the electromagnet current to a known value.
@@ -119,14 +276,47 @@ class MagnetController:
     def set_field(self, field):
         """
         Sets the electromagnet field to a known value in mT based on
-        calibration data. Run field_calibration.py to generate.
+        calibration data. Run calibration.py to generate.
+        Uses the up- or down-sweep branch of the calibration depending on
+        the direction the field is approached from. Fields between calibration
+        samples are interpolated; returns the expected field, clipped to the
+        calibrated range.
         """
-        dataframe = pd.read_csv('field_calibration_data.csv')
-        field_cal = dataframe['Field_mT'].values
-        current_cal = dataframe['Current_A'].values
-        idx = (np.abs(field_cal - field)).argmin()
-        self.set_current(current_cal[idx])
-        return field_cal[idx]
+        if field > self._last_field:
+            self._branch = 'up'
+        elif field < self._last_field:
+            self._branch = 'down'
+        current = self.calibration.current_for(field, self._branch)
+        self.set_current(current)
+        self._last_field = field
+        return float(self.calibration.field_for(current, self._branch))
+
+    def preflight(self, setpoints, unit='mT'):
+        """
+        Checks a whole sweep plan before anything is sent to the supply and
+        returns the (n, 4) DAC payloads it will use. Fields are mapped with the
+        hysteresis branch each one will be approached on, starting from the
+        current state. Raises ValueError for setpoints outside the supply limit
+        or, in mT, outside the calibrated range.
+        """
+        setpoints = np.asarray(setpoints, dtype=float)
+        if unit == 'A':
+            return self.dac.encode_many(setpoints)
+        # direction of each move, 0 keeps the previous branch
+        moves = np.sign(np.diff(np.concatenate([[self._last_field], setpoints])))
+        moves = np.concatenate([[1 if self._branch == 'up' else -1], moves])
+        last_move = np.maximum.accumulate(np.where(moves != 0, np.arange(moves.size), 0))
+        up = moves[last_move][1:] > 0
+        currents = np.empty_like(setpoints)
+        for branch, mask in (('up', up), ('down', ~up)):
+            low, high = self.calibration.field_range(branch)
+            bad = np.flatnonzero(mask & ~((setpoints >= low) & (setpoints <= high)))
+            if bad.size:
+                shown = ", ".join(f"#{i}: {setpoints[i]}" for i in bad[:5])
+                raise ValueError(f"{bad.size} field(s) outside the calibrated {branch} branch "
+                                 f"({low:.1f} to {high:.1f} mT): {shown}.")
+            currents[mask] = self.calibration.current_for(setpoints[mask], branch)
+        return self.dac.encode_many(currents)
 
     def stop_and_query_field(self):
         """
@@ -134,94 +324,64 @@ class MagnetController:
         Returns the field reading in mT.
         """
         print("\n  Sending STOP and QUERY sequence...")
-        
-        # --- Part 1: Send STOP command ---
-        self.inst.write_raw(bytes([0x64])); self._read_one_byte() # Ready Check
-        self.inst.write_raw(bytes([0x2B])); self._poll_for_byte(0x12) # Stop Cmd
-        
-        # --- Part 2: Send QUERY command (0x0A) ---
-        self.inst.write_raw(bytes([0x0A])) # The query
-        
-        byte1 = self._read_one_byte() # Field Mag High Byte
-        if byte1 is None: return "Query Failed"
-        self.inst.write_raw(bytes([byte1])) # Echo
-        
-        byte2 = self._read_one_byte() # Field Mag Low Byte
-        if byte2 is None: return "Query Failed"
-        self.inst.write_raw(bytes([byte2])) # Echo
-        
-        byte3 = self._read_one_byte() # Field Sign Flag
-        if byte3 is None: return "Query Failed"
-        self.inst.write_raw(bytes([byte3])) # Echo
+
+        # --- Part 1 & 2: STOP and QUERY, echoing each field byte ---
+        field_bytes = self._query_bytes()
+        if field_bytes is None: return "Query Failed"
 
         # --- Part 3: Finish the STOP sequence ---
-        # We use the sequence from the -1.0A log (packets_-1.txt)
-        # as it seems to be a reliable "set to zero"
-        self.inst.write_raw(bytes([0x4E])); self._read_one_byte()
-        self.inst.write_raw(bytes([0x00])); # No response in log
-        
-        self.inst.write_raw(bytes([0x64])); self._read_one_byte() # Ready Check
-        self.inst.write_raw(bytes([0x82])); self._poll_for_byte(0x12) # End Cmd
-        
+        self._run_steps(STOP_STEPS, 'STOP')
+        self._last_field = 0.0
+
         print("  STOP/QUERY sequence complete.")
 
         # --- Decode and return the value ---
         try:
-            raw_magnitude = (byte1 << 8) | byte2
-            scaled_magnitude = raw_magnitude / 10.0 # Our 10x scaling factor
-            
-            # Sign Flag: 0x01 = Negative, 0x00 = Positive
-            final_value = -scaled_magnitude if byte3 == 0x01 else scaled_magnitude
-            
-            print(f"  Received Bytes: [0x{byte1:02X}, 0x{byte2:02X}, 0x{byte3:02X}]")
+            final_value = self._decode_field(*field_bytes)
+            print(f"  Received Bytes: {[f'0x{b:02X}' for b in field_bytes]}")
             print(f"  Decoded Field: {final_value} mT")
             return final_value
         except Exception as e:
             return f"Query Failed: Error decoding bytes: {e}"
-    
+
     def query_field(self):
         """
         Queries the field without stopping the current.
         Returns the field reading in mT.
         """
-        # print("\n  Sending QUERY sequence...")
-
-        # --- Part 1: Send STOP command ---
-        self.inst.write_raw(bytes([0x64])); self._read_one_byte() # Ready Check
-        self.inst.write_raw(bytes([0x2B])); self._poll_for_byte(0x12) # Stop Cmd
-        
-        # --- Send QUERY command (0x0A) ---
-        self.inst.write_raw(bytes([0x0A])) # The query
-        
-        byte1 = self._read_one_byte() # Field Mag High Byte
-        if byte1 is None: return "Query Failed"
-        self.inst.write_raw(bytes([byte1])) # Echo
-        
-        byte2 = self._read_one_byte() # Field Mag Low Byte
-        if byte2 is None: return "Query Failed"
-        self.inst.write_raw(bytes([byte2])) # Echo
-        
-        byte3 = self._read_one_byte() # Field Sign Flag
-        if byte3 is None: return "Query Failed"
-        self.inst.write_raw(bytes([byte3])) # Echo
-
-        # print("  QUERY sequence complete.")
+        field_bytes = self._query_bytes()
+        if field_bytes is None: return "Query Failed"
 
         # --- Decode and return the value ---
         try:
-            raw_magnitude = (byte1 << 8) | byte2
-            scaled_magnitude = raw_magnitude / 10.0 # Our 10x scaling factor
-            
-            # Sign Flag: 0x01 = Negative, 0x00 = Positive
-            final_value = -scaled_magnitude if byte3 == 0x01 else scaled_magnitude
-            
-            # print(f"  Received Bytes: [0x{byte1:02X}, 0x{byte2:02X}, 0x{byte3:02X}]")
-            # print(f"  Decoded Field: {final_value} mT")
-            return final_value
+            return self._decode_field(*field_bytes)
         except Exception as e:
             Warning(f"Query Failed: Error decoding bytes: {e}")
             return None
 
+    def wait_for_settle(self, tolerance_mT=0.5, window=3, interval_sec=0.2, max_wait_sec=10.0):
+        """
+        Polls query_field() until the last `window` readings agree within
+        `tolerance_mT`, or for at most max_wait_sec / interval_sec polls.
+        The limit counts polls, not seconds, so a transport replay at any
+        speed makes the same queries as the recorded run.
+        Returns (last field reading in mT, seconds waited).
+        """
+        t0 = time.monotonic()
+        max_polls = max(window, int(np.ceil(round(max_wait_sec / interval_sec, 6))))
+        readings = []
+        for poll in range(1, max_polls + 1):
+            field = self.query_field()
+            if isinstance(field, float):
+                readings = (readings + [field])[-window:]
+                if len(readings) == window and max(readings) - min(readings) <= tolerance_mT:
+                    break
+            if poll == max_polls:
+                print(f"  Field not settled after {max_polls} readings, last readings: {readings}")
+                break
+            time.sleep(interval_sec)
+        return (readings[-1] if readings else None), time.monotonic() - t0
+
     def current_map_test(self):
         currs = np.arange(-.4,.4,0.1)
         for curr in currs:
@@ -1,33 +1,58 @@
-import pyvisa
 import numpy as np
 import os
 from dotenv import load_dotenv
-import time
+from tracing import tracer, traced
+from transport import resource_manager
 
 load_dotenv()
 
+# S-parameter code -> trace name used on channel 1
+SPARAM_TRACES = {
+    "S11": "MeasS11",
+    "S12": "MeasS12",
+    "S21": "MeasS21",
+    "S22": "MeasS22",
+}
+
+# data_format option -> (FORMat argument, struct datatype for block reads)
+DATA_FORMATS = {
+    "ascii": ("ASC", None),
+    "real32": ("REAL,32", "f"),
+    "real64": ("REAL,64", "d"),
+}
+
 class VNAController:
     """
     Thin wrapper for R&S ZNLE SCPI over VISA (LAN).
-    Provides read_s11/s12/s21/s22 methods returning (freq_hz, complex_sparam).
+    Provides read_s11/s12/s21/s22 methods returning (freq_hz, complex_sparam),
+    and read_all_sparams() which gets all four from a single sweep.
     """
-    def __init__(self, timeout_ms=50000, backend='@py'):
+    def __init__(self, timeout_ms=50000, backend='@py', data_format="real32"):
         """
         ip: string, e.g. '192.168.1.20'
         timeout_ms: VISA timeout in milliseconds
-        backend: optional VISA backend string for pyvisa.ResourceManager(), e.g. '@ni'
+        backend: optional VISA backend string for pyvisa.ResourceManager(), e.g. '@ni';
+                 SWEEP_TRANSPORT can record or replay the session, see transport.py
+        data_format: trace transfer format, 'real32', 'real64' (IEEE binary blocks)
+                     or 'ascii' as a fallback for firmwares without binary support
         """
+        if data_format not in DATA_FORMATS:
+            raise ValueError(f"Unknown data_format {data_format!r}, expected one of {list(DATA_FORMATS)}")
         # self.ip = os.getenv("VNA_IP")
         self.resource_str = os.getenv("VNA_ID")
         self.backend = backend
         self.timeout_ms = timeout_ms
+        self.data_format = data_format
         self.rm = None
         self.vna = None
+        # settings cache: sweep frequency axis and names of traces defined on channel 1
+        self._freq = None
+        self._traces = None
 
     # --- lifecycle ------------------------------------------------------------
     def connect(self):
-        self.rm = pyvisa.ResourceManager(self.backend) if self.backend else pyvisa.ResourceManager()
-        self.vna = self.rm.open_resource(self.resource_str)
+        self.rm = resource_manager(self.backend, source='vna')
+        self.vna = traced(self.rm.open_resource(self.resource_str), 'vna')
         self.vna.timeout = self.timeout_ms
         self.vna.read_termination = '\n'
         self.vna.write_termination = '\n'
@@ -37,9 +62,12 @@ class VNAController:
             raise RuntimeError(f"Unexpected instrument: {idn.strip()}")
         # deterministic sweeps
         self.vna.write("INIT1:CONT OFF")
+        self._configure_format()
+        self._load_settings()
         return idn.strip()
 
     def close(self):
+        self.clear_cache()
         if self.vna is not None:
             try:
                 self.vna.close()
@@ -64,43 +92,79 @@ class VNAController:
     def read_s21(self): return self._read_sparam("S21", trace_name="MeasS21")
     def read_s22(self): return self._read_sparam("S22", trace_name="MeasS22")
 
+    def set_sweep(self, f_start=None, f_stop=None, npts=None):
+        """Change the channel 1 frequency sweep (Hz, points) and refresh the settings cache."""
+        v = self._require_connection()
+        if f_start is not None:
+            v.write(f"SENS1:FREQ:STAR {f_start}")
+        if f_stop is not None:
+            v.write(f"SENS1:FREQ:STOP {f_stop}")
+        if npts is not None:
+            v.write(f"SENS1:SWE:POIN {int(npts)}")
+        self._freq = None
+        return self._frequency_axis()
+
+    def clear_cache(self):
+        """
+        Forget the cached sweep axis and trace catalog. Call this after changing
+        the VNA setup from its front panel or another program.
+        """
+        self._freq = None
+        self._traces = None
+
+    def read_all_sparams(self):
+        """
+        Define all four traces, run a single sweep and fetch every trace from it.
+        Returns (freq_hz, {'s11': ..., 's12': ..., 's21': ..., 's22': ...}).
+        """
+        self.trigger_sweep()
+        return self.fetch_all_sparams()
+
+    def trigger_sweep(self):
+        """Run one sweep on channel 1 and block until it has finished."""
+        v = self._require_connection()
+        self._ensure_measurements(SPARAM_TRACES)
+        # *OPC? only answers once the sweep is done, so the data is complete
+        with tracer.span('vna', 'sweep', "INIT1"):
+            v.query("INIT1; *OPC?")
+
+    def fetch_all_sparams(self):
+        """
+        Pull every S-parameter trace of the last sweep without sweeping again.
+        Returns (freq_hz, {'s11': ..., 's12': ..., 's21': ..., 's22': ...}).
+        """
+        self._require_connection()
+        freq = self._frequency_axis()
+        traces = {}
+        for code, trace_name in SPARAM_TRACES.items():
+            s_complex = self._fetch_trace(trace_name)
+            # sanity alignment
+            if freq.size != s_complex.size:
+                raise RuntimeError(f"Point count mismatch: freq={freq.size}, {code}={s_complex.size}")
+            traces[code.lower()] = s_complex
+        return freq, traces
+
     # --- internals ------------------------------------------------------------
+    def _require_connection(self):
+        if self.vna is None:
+            raise RuntimeError("Not connected. Call connect() first.")
+        return self.vna
+
     def _read_sparam(self, code, trace_name="Meas"):
         """
         Ensure a trace for the given S-parameter exists on channel 1,
         run a single sweep, return (freq_hz, complex_values).
         """
-        v = self.vna
-        if v is None:
-            raise RuntimeError("Not connected. Call connect() first.")
+        v = self._require_connection()
 
-        # ensure the measurement exists and is selected
-        self._ensure_measurement(code, trace_name)
-        # print(f"Measurement {code} {trace_name} exists")
+        # ensure the measurement exists
+        self._ensure_measurements({code: trace_name})
 
-        t0 = time.time()
         # trigger one sweep and wait until done
         v.write("INIT1; *WAI")
-        # print(f"Sweep for {code} done in {time.time()-t0:.3f} s")
 
-        # get complex data: interleaved Re,Im
-        raw = v.query("CALC1:DATA? SDAT")
-        # print(f"Raw data length for {code}: {len(raw)}")
-        data = np.fromstring(raw, sep=",", dtype=float)
-        real = data[0::2]
-        imag = data[1::2]
-        s_complex = real + 1j * imag
-
-        # get frequency axis (Hz)
-        # (On ZNLE, SENSe1:FREQuency:DATA? yields an array of frequency points.)
-        # Build frequency vector from sweep settings
-        f_start = float(v.query("SENS1:FREQ:STAR?"))
-        f_stop  = float(v.query("SENS1:FREQ:STOP?"))
-        npts    = int(float(v.query("SENS1:SWE:POIN?")))
-        freq = np.linspace(f_start, f_stop, npts)
-        # f_raw = v.query("SENS1:FREQ:DATA?") ### TIMEOUT HERE
-        # print(f"Raw frequency data length for {code}: {len(freq)}")
-        # freq = np.fromstring(f_raw, sep=",", dtype=float)
+        s_complex = self._fetch_trace(trace_name)
+        freq = self._frequency_axis()
 
         # sanity alignment
         if freq.size != s_complex.size:
@@ -108,34 +172,86 @@ class VNAController:
 
         return freq, s_complex
 
-    def _ensure_measurement(self, code, trace_name):
-        """
-        Create/select a measurement named `trace_name` for S-parameter `code` (e.g., 'S21').
-        Idempotent: if it exists, just selects it.
-        """
+    def _configure_format(self):
+        """Set the trace transfer format; binary blocks are sent little-endian."""
+        form, datatype = DATA_FORMATS[self.data_format]
+        self.vna.write(f"FORM {form}")
+        if datatype is not None:
+            # SWAPped = least significant byte first
+            self.vna.write("FORM:BORD SWAP")
+
+    def _fetch_trace(self, trace_name):
+        """Select `trace_name` and return its complex data (interleaved Re,Im on the wire)."""
+        with tracer.span('vna', 'trace', trace_name):
+            return self._parse_block(self._read_block(trace_name))
+
+    def _read_block(self, trace_name):
+        """The raw trace: the ASCII reply, or the bytes of the binary block."""
+        # select and read in one compound message, saving a round-trip per trace
+        cmd = f"CALC1:PAR:SEL '{trace_name}';:CALC1:DATA? SDAT"
+        if DATA_FORMATS[self.data_format][1] is None:
+            return self.vna.query(cmd)
+        # IEEE 488.2 definite-length block, read straight into a numpy byte buffer
+        return self.vna.query_binary_values(cmd, datatype='B', container=np.array)
+
+    def _parse_block(self, raw):
+        """Trace values from _read_block(), as complex (timed on its own by benchmark.py)."""
+        datatype = DATA_FORMATS[self.data_format][1]
+        if datatype is None:
+            data = np.array(raw.split(","), dtype=float)
+        else:
+            data = np.asarray(raw).view('<' + datatype)  # little-endian, see _configure_format
+        # reinterpret interleaved Re,Im pairs as complex without copying
+        return data.astype(np.float64, copy=False).view(np.complex128)
+
+    def _load_settings(self):
+        """Fill the settings cache; nothing in it changes during a field sweep."""
+        self.clear_cache()
+        self._frequency_axis()
+        self._trace_catalog()
+
+    def _frequency_axis(self):
+        """Frequency vector (Hz) built from the sweep settings, cached after the first query."""
+        if self._freq is not None:
+            return self._freq
+        # (On ZNLE, SENSe1:FREQuency:DATA? yields an array of frequency points.)
         v = self.vna
+        f_start = float(v.query("SENS1:FREQ:STAR?"))
+        f_stop  = float(v.query("SENS1:FREQ:STOP?"))
+        npts    = int(float(v.query("SENS1:SWE:POIN?")))
+        # f_raw = v.query("SENS1:FREQ:DATA?") ### TIMEOUT HERE
+        self._freq = np.linspace(f_start, f_stop, npts)
+        self._freq.flags.writeable = False
+        return self._freq
 
-        # Query existing parameters on channel 1
+    def _trace_catalog(self):
+        """Set of trace names defined on channel 1, cached after the first query."""
+        if self._traces is not None:
+            return self._traces
         # Returns: "name1,def1,name2,def2,..."
-        cat = v.query("CALC1:PAR:CAT?").strip().strip('"')
+        cat = self.vna.query("CALC1:PAR:CAT?").strip().strip('"')
         tokens = [t for t in cat.split(",") if t] if cat else []
+        self._traces = set(tokens[0::2])
+        return self._traces
 
-        exists = False
-        for i in range(0, len(tokens), 2):
-            name_i = tokens[i]
-            if name_i == trace_name:
-                exists = True
-                break
+    def _ensure_measurements(self, traces):
+        """
+        Create measurements for a {code: trace_name} mapping, e.g. {'S21': 'MeasS21'}.
+        Idempotent: only traces missing from the cached catalog are defined.
+        """
+        v = self.vna
+        existing = self._trace_catalog()
 
-        if not exists:
+        for window_trace, (code, trace_name) in enumerate(traces.items(), start=1):
+            if trace_name in existing:
+                continue
             # Define and bind the measurement to a (visible) trace if needed
             v.write(f"CALC1:PAR:DEF '{trace_name}',{code}")
             # Optional: create a new trace window binding (if none exists for this name)
             # Many VNAs auto-bind, but this is safe:
-            v.write(f"DISP:WIND1:TRAC1:FEED '{trace_name}'")
-
-        # Select it so CALC1:DATA? applies to this measurement
-        v.write(f"CALC1:PAR:SEL '{trace_name}'")
+            v.write(f"DISP:WIND1:TRAC{window_trace}:FEED '{trace_name}'")
+            existing.add(trace_name)
+        # no selection here: _fetch_trace selects each trace as it reads it
 
 if __name__ == "__main__":
     with VNAController() as vna:
@@ -0,0 +1,265 @@
+"""
+End-to-end sweep benchmark. Runs an experiment.py-style (pipelined field sweep
+through SweepEngine) or calibration.py-style (current steps, settle, journal)
+sweep, times every instrument and storage call and writes a JSON report with
+per-stage statistics, per-point timings and the throughput in points/min.
+
+    python controllers/benchmark.py --mode experiment --points 50 --time-scale 0.1
+    python controllers/benchmark.py --compare data/benchmarks/<baseline>.json
+    python controllers/benchmark.py --backend replay --time-scale 0   # latest benchmark recording
+
+With --compare the run fails (exit code 1) when the throughput dropped by more
+than --tolerance against the baseline report.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+from calibration_model import BRANCHES
+from dataset import SweepWriter
+from journal import Journal
+from planner import order_setpoints
+from sweep import SweepEngine
+
+BENCHMARK_DIR = os.path.join("data", "benchmarks")
+REPORT_VERSION = 1
+
+class StageTimer:
+    """
+    Replaces methods on instrument/writer instances with timed wrappers.
+    A call made while another timed call runs on the same thread (e.g. the
+    field polls inside wait_for_settle) is part of the outer stage and not
+    recorded again, unless its stage is registered with nested=True.
+    """
+    def __init__(self):
+        self.samples = defaultdict(list)  # stage -> call durations in seconds
+        self.untimed = set()  # wrapped stages with no call recorded yet, or whose method is missing
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def wrap(self, obj, method, stage, nested=False):
+        """stage: a name, or a function of the call's arguments returning one."""
+        label = method if callable(stage) else stage
+        self.untimed.add(label)
+        original = getattr(obj, method, None)
+        if original is None:
+            return
+        def timed(*args, **kwargs):
+            depth = getattr(self._local, 'depth', 0)
+            self._local.depth = depth + 1
+            t0 = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                self._local.depth = depth
+                if depth == 0 or nested:
+                    name = stage(*args, **kwargs) if callable(stage) else stage
+                    with self._lock:
+                        self.samples[name].append(elapsed)
+                        self.untimed.discard(label)
+        setattr(obj, method, timed)
+
+    def stats(self):
+        report = {}
+        for stage, samples in self.samples.items():
+            ms = np.asarray(samples) * 1e3
+            report[stage] = {'calls': int(ms.size), 'total_sec': float(ms.sum() / 1e3),
+                             'mean_ms': float(ms.mean()), 'median_ms': float(np.median(ms)),
+                             'p95_ms': float(np.percentile(ms, 95)), 'max_ms': float(ms.max())}
+        return report
+
+    def per_point(self, n_points):
+        """
+        One row per point; stages called k times per point are summed per point.
+        Returns (rows, totals): stages whose calls do not split evenly over the
+        points (e.g. a once-per-sweep stop) only have their total, in ms.
+        """
+        columns, totals = {}, {}
+        for stage, samples in self.samples.items():
+            if samples and len(samples) % n_points == 0:
+                columns[stage] = np.asarray(samples).reshape(n_points, -1).sum(axis=1) * 1e3
+            elif samples:
+                totals[f'{stage}_ms'] = float(np.sum(samples) * 1e3)
+        rows = [{f'{stage}_ms': float(values[i]) for stage, values in columns.items()}
+                for i in range(n_points)]
+        return rows, totals
+
+def open_backend(args):
+    """Unconnected magnet and VNA controllers for args.backend."""
+    backend, data_format = args.backend, args.data_format
+    if backend == 'emulator':
+        import lab_emulator
+        lab_emulator.TIME_SCALE = args.time_scale
+        return lab_emulator.MagnetController(), lab_emulator.VNAController(data_format=data_format)
+    if backend == 'replay':
+        # the real controllers, answered from a recording of the same benchmark
+        import transport
+        transport.configure('replay', args.recording, args.time_scale and 1 / args.time_scale)
+    if backend in ('lab', 'replay'):
+        from EM3000S import MagnetController
+        from VNA import VNAController
+        return MagnetController(), VNAController(data_format=data_format)
+    raise ValueError(f"Unknown backend '{backend}'.")
+
+def instrument(timer, magnet, vna):
+    timer.wrap(magnet, 'set_field', 'setpoint')
+    timer.wrap(magnet, 'set_current', 'setpoint')
+    timer.wrap(magnet, 'wait_for_settle', 'settle')
+    timer.wrap(magnet, 'query_field', 'field_query')
+    timer.wrap(magnet, 'stop_and_query_field', 'stop')
+    if vna is not None:
+        timer.wrap(vna, 'trigger_sweep', 'vna_sweep')
+        # the trace name's tail is the S-parameter, e.g. 'MeasS21' -> read_s21
+        timer.wrap(vna, '_fetch_trace', lambda trace_name: f'read_{trace_name[-3:].lower()}')
+        timer.wrap(vna, '_parse_block', 'parse', nested=True)
+
+def run_experiment(timer, magnet, vna, workdir, args):
+    """Pipelined field sweep, as experiment.py runs it."""
+    setpoints = order_setpoints(np.linspace(args.low, args.high, args.points), start=0.0)
+    with SweepWriter(workdir, len(setpoints), 'mT', meta={'benchmark': True}) as writer:
+        timer.wrap(writer, 'append', 'save')
+        SweepEngine(magnet, vna, writer, setpoints, unit='mT').run()
+    return len(setpoints)
+
+def run_calibration(timer, magnet, vna, workdir, args):
+    """Current steps up then back down with settle and a journaled reading, as calibration.py runs them."""
+    up = np.linspace(-args.current, args.current, args.points)
+    currents = np.concatenate([up, up[::-1]])
+    branches = np.repeat(BRANCHES, args.points)
+    journal = Journal(os.path.join(workdir, 'journal.jsonl'), {'benchmark': True})
+    timer.wrap(journal, 'record', 'save')
+    try:
+        for curr, branch in zip(currents, branches):
+            magnet.set_current(curr)
+            field, _ = magnet.wait_for_settle()
+            journal.record(current=float(curr), field=field, branch=str(branch))
+    finally:
+        journal.close()
+    return len(currents)
+
+MODES = {'experiment': run_experiment, 'calibration': run_calibration}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args):
+    magnet, vna = open_backend(args)
+    if args.mode != 'experiment':
+        vna = None
+    timer = StageTimer()
+    instrument(timer, magnet, vna)
+    with open(os.devnull, 'w') as devnull, tempfile.TemporaryDirectory() as workdir, \
+            contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        magnet.connect()
+        if vna is not None:
+            vna.connect()
+        try:
+            t0 = time.perf_counter()
+            n_points = MODES[args.mode](timer, magnet, vna, workdir, args)
+            wall = time.perf_counter() - t0
+        finally:
+            magnet.stop_and_query_field()
+            magnet.disconnect()
+            if vna is not None:
+                vna.close()
+    per_point, per_point_totals = timer.per_point(n_points)
+    return {
+        'version': REPORT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'mode': args.mode, 'backend': args.backend, 'points': args.points,
+                   'time_scale': args.time_scale, 'data_format': args.data_format,
+                   'low_mT': args.low, 'high_mT': args.high, 'current_A': args.current},
+        'points': n_points,
+        'wall_sec': wall,
+        'points_per_min': 60.0 * n_points / wall,
+        'stages': timer.stats(),
+        'per_point': per_point,
+        'per_point_totals': per_point_totals,  # stages left out of per_point
+        'untimed': sorted(timer.untimed),
+    }
+
+def summarize(report):
+    print(f"{report['config']['mode']} on {report['config']['backend']}: {report['points']} points "
+          f"in {report['wall_sec']:.2f} s, {report['points_per_min']:.1f} points/min")
+    print(f"  {'stage':<14}{'calls':>7}{'mean ms':>10}{'p95 ms':>10}{'total s':>10}")
+    for stage, s in sorted(report['stages'].items(), key=lambda item: -item[1]['total_sec']):
+        print(f"  {stage:<14}{s['calls']:>7}{s['mean_ms']:>10.2f}{s['p95_ms']:>10.2f}{s['total_sec']:>10.2f}")
+    if report.get('per_point_totals'):
+        names = ', '.join(name[:-len('_ms')] for name in report['per_point_totals'])
+        print(f"  not split per point, totals only: {names}")
+    if report.get('untimed'):
+        # e.g. a stage only called within another, or one the backend does not have
+        print(f"  not timed: {', '.join(report['untimed'])}")
+
+def compare(report, baseline, tolerance):
+    """Prints the change against a baseline report; returns False on a throughput regression."""
+    if report['config'] != baseline['config']:
+        print("  Warning: baseline was run with a different configuration.")
+    ratio = report['points_per_min'] / baseline['points_per_min']
+    print(f"  throughput {baseline['points_per_min']:.1f} -> {report['points_per_min']:.1f} points/min "
+          f"({(ratio - 1) * 100:+.1f}%), baseline {baseline.get('commit')}")
+    for stage, s in sorted(report['stages'].items()):
+        if stage in baseline['stages']:
+            before = baseline['stages'][stage]['mean_ms']
+            print(f"  {stage:<14}{before:>10.2f} -> {s['mean_ms']:.2f} ms")
+    return ratio >= 1 - tolerance
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end sweep benchmark.")
+    parser.add_argument('--mode', choices=sorted(MODES), default='experiment')
+    parser.add_argument('--backend', choices=['emulator', 'lab', 'replay'], default='emulator',
+                        help="'replay' answers the lab controllers from --recording")
+    parser.add_argument('--recording', default=None,
+                        help="transport recording of a lab run with the same options "
+                             "(made with SWEEP_TRANSPORT=record), default the latest one")
+    parser.add_argument('--points', type=int, default=30, help="setpoints (per branch in calibration mode)")
+    parser.add_argument('--low', type=float, default=-100.0, help="experiment field range start (mT)")
+    parser.add_argument('--high', type=float, default=100.0, help="experiment field range end (mT)")
+    parser.add_argument('--current', type=float, default=4.0, help="calibration current range +/- (A)")
+    parser.add_argument('--data-format', choices=['ascii', 'real32', 'real64'], default='real32')
+    parser.add_argument('--time-scale', type=float, default=float(os.getenv("EMULATOR_TIME_SCALE", "1.0")),
+                        help="emulator/replay clock scale, 0.1 runs ten times faster than the lab, "
+                             "0 replays as fast as possible (replay only, the emulator needs a clock)")
+    parser.add_argument('--output', help="report path, default data/benchmarks/<mode>_<time>.json")
+    parser.add_argument('--compare', help="baseline report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="allowed relative throughput drop against the baseline")
+    parser.add_argument('--verbose', action='store_true', help="show the instruments' output")
+    args = parser.parse_args(argv)
+    if args.time_scale < 0 or (args.time_scale == 0 and args.backend == 'emulator'):
+        parser.error("--time-scale must be > 0 for the emulator (0 is only for --backend replay).")
+
+    report = run_benchmark(args)
+    output = args.output or os.path.join(
+        BENCHMARK_DIR, f"{args.mode}_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    summarize(report)
+    print(f"Report saved to '{output}'.")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.tolerance):
+            print(f"Throughput regressed by more than {args.tolerance:.0%}.")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
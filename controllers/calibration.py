@@ -1,9 +1,18 @@
 from EM3000S import MagnetController
 # from lab_emulator import MagnetController
+from calibration_model import (CALIBRATION_FILE, MODEL_FILE, BRANCHES, FieldCalibration,
+                               read_raw, fit_model, update_model, load_model, save_model, model_enabled)
+from session import open_instruments
+from journal import Journal
 import pandas as pd
 import numpy as np
 import configparser
-import time, os
+import signal
+import os
+
+# the GUI's Cancel button sends CTRL_BREAK on Windows, treat it like Ctrl+C
+if hasattr(signal, 'SIGBREAK'):
+    signal.signal(signal.SIGBREAK, signal.default_int_handler)
 
 dir = "data"
 
@@ -18,34 +27,82 @@ config.read(CONFIG_FILE)
 try:
     # Load Experiment tab values
     calibration_resolution = int(config.get('Calibration', 'cal_res', fallback='800'))   
+    # 'full' re-measures and refits everything, 'update' corrects the saved model
+    # from a sparse sweep of cal_res points per branch
+    calibration_mode = config.get('Calibration', 'mode', fallback='full')
     print("Config loaded successfully.")
 except Exception as e:
     raise ValueError("Error reading config file.")
 
+if calibration_mode not in ('full', 'update'):
+    raise ValueError(f"Unknown calibration mode '{calibration_mode}', expected 'full' or 'update'.")
+if calibration_mode == 'update' and not os.path.exists(MODEL_FILE):
+    raise FileNotFoundError(f"'update' needs a fitted model, run a full calibration first ({MODEL_FILE} not found).")
+# sparse updates keep the full raw data intact
+raw_file = CALIBRATION_FILE if calibration_mode == 'full' else os.path.splitext(CALIBRATION_FILE)[0] + '_update.csv'
+
 print("Connecting to Magnet Controller...")
 
-magnet = MagnetController()
-magnet.connect()
+magnet, = open_instruments(('magnet', MagnetController))
 
-curr_arr = np.linspace(-4,4,calibration_resolution)
+# up branch -4 -> +4 A, then the down branch back from +4 -> -4 A
+up = np.linspace(-4,4,calibration_resolution)
+curr_arr = np.concatenate([up, up[::-1]])
+branch_arr = np.repeat(BRANCHES, calibration_resolution)
+n_points = len(curr_arr)
 
-data = np.zeros((calibration_resolution,2))
+# every measured point is journaled; a crashed calibration resumes from there
+journal = Journal(os.path.splitext(CALIBRATION_FILE)[0] + '_journal.jsonl',
+                  {'cal_res': calibration_resolution, 'branches': list(BRANCHES), 'mode': calibration_mode})
+start = len(journal.entries)
 
-print(f"Starting field calibration sweep for {calibration_resolution} points...")
+print(f"Starting field calibration sweep for {calibration_resolution} points per branch...")
 
-for idx,curr in enumerate(curr_arr):
-    print(f"Setting current to {curr:.2f} A")
-    magnet.set_current(curr)
-    time.sleep(2)  # Wait for the magnet to stabilize
-    field = magnet.query_field()
-    print(f"Measured field: {field:.2f} mT")
-    data[idx,0] = curr
-    data[idx,1] = field
+try:
+    if 0 < start < n_points:
+        print(f"Resuming after {start} points...")
+        # re-enter the branch from its starting end so the hysteresis history matches
+        branch_start = 0 if start < calibration_resolution else calibration_resolution
+        magnet.set_current(curr_arr[branch_start])
+        magnet.set_current(curr_arr[start - 1])
+        magnet.wait_for_settle()
+    for idx in range(start, n_points):
+        curr = curr_arr[idx]
+        print(f"[{idx+1}/{n_points}] Setting current to {curr:.2f} A ({branch_arr[idx]})")
+        magnet.set_current(curr)
+        field, settle_time = magnet.wait_for_settle()
+        if field is None:
+            # still journaled, so resuming keeps its place; read_raw() drops the empty field
+            print(f"Warning: no field reading at {curr:.2f} A, point left out of the fit.")
+        else:
+            print(f"Measured field: {field:.2f} mT (settled after {settle_time:.2f} s)")
+        journal.record(current=float(curr), field=field, branch=str(branch_arr[idx]))
+except KeyboardInterrupt:
+    # keep the previous calibration rather than overwrite it with a partial one
+    journal.close()
+    print(f"Calibration cancelled after {len(journal.entries)} points, run again to resume.")
+    raise SystemExit(1)
+finally:
+    magnet.stop_and_query_field()
+    magnet.disconnect()
 
-df = pd.DataFrame(data, columns=['Current_A', 'Field_mT'])
-df.to_csv(os.path.join('..', 'field_calibration_data.csv'), index=False)
+df = pd.DataFrame(journal.entries).rename(columns={'current': 'Current_A', 'field': 'Field_mT', 'branch': 'Branch'})
+df.to_csv(raw_file, index=False)
+journal.remove()
 
-magnet.stop_and_query_field()
-magnet.disconnect()
+print(f"Field calibrated and data saved to '{raw_file}'.")
 
-print("Field calibrated and data saved to 'field_calibration_data.csv'.")
\ No newline at end of file
+if calibration_mode == 'full':
+    model = fit_model(read_raw(raw_file), source=raw_file, dac_coeffs=FieldCalibration().dac_coeffs())
+else:
+    model = update_model(load_model(MODEL_FILE), read_raw(raw_file), source=raw_file)
+save_model(model)
+for branch, entry in model['branches'].items():
+    stats = entry['residuals']
+    print(f"{branch}: residual rms {stats['rms_mT']:.3f} mT, max {stats['max_mT']:.3f} mT "
+          f"over {stats['n_points']} points")
+print(f"Calibration model saved to '{MODEL_FILE}'.")
+if not model_enabled():
+    # set_field() interpolates the raw table unless the model is asked for
+    print(f"Field setpoints use the raw table '{CALIBRATION_FILE}'; set FIELD_CALIBRATION=model to use the model"
+          + (", which is the only one this update corrects." if calibration_mode == 'update' else "."))
\ No newline at end of file
@@ -0,0 +1,249 @@
+import os, json, time
+import numpy as np
+import pandas as pd
+from numpy.polynomial import Polynomial
+
+CALIBRATION_FILE = 'field_calibration_data.csv'
+MODEL_FILE = 'calibration_model.json'
+MODEL_VERSION = 1
+
+# hysteresis branches: the field reached while the current rises / falls
+BRANCHES = ('up', 'down')
+
+# current (A) -> DAC code, highest power first; the fit of the original packet captures
+DAC_COEFFS = (4.76264, 2.00444, 252.08648, -8.46937)
+
+FIT_DEGREE = 5          # polynomial degree of the field(current) fits
+INVERSE_SAMPLES = 4096  # density of the field -> current table built from a fit
+
+# which calibration set_field() uses: 'table' interpolates the raw CSV exactly,
+# 'model' the smoother but approximate fit in calibration_model.json
+CALIBRATION_SOURCE_ENV = "FIELD_CALIBRATION"
+CALIBRATION_SOURCES = ('table', 'model')
+
+def model_enabled():
+    """True if FIELD_CALIBRATION=model asks for the fitted model (the default is the table)."""
+    source = os.getenv(CALIBRATION_SOURCE_ENV, 'table')
+    if source not in CALIBRATION_SOURCES:
+        raise ValueError(f"Unknown {CALIBRATION_SOURCE_ENV} '{source}', expected one of {CALIBRATION_SOURCES}.")
+    return source == 'model'
+
+class FieldCalibration:
+    """
+    Field <-> current lookup. Interpolates the raw calibration CSV
+    (Current_A, Field_mT and, for hysteresis-aware calibrations, Branch);
+    with use_model (default: FIELD_CALIBRATION=model) the fitted model in
+    calibration_model.json is used instead, when there is one.
+    Raw tables are cached in a binary .npz sidecar next to the CSV. Whichever
+    source is used is only re-read when its mtime changes.
+    """
+    def __init__(self, path=CALIBRATION_FILE, model_path=MODEL_FILE, use_model=None):
+        self.path = path
+        self.model_path = model_path
+        self.use_model = model_enabled() if use_model is None else use_model
+        self.sidecar = os.path.splitext(path)[0] + '.npz'
+        self._source = None
+        self.tables = {}  # branch -> monotonic (current, field) table, for field -> current
+        self.model = None # fitted model dict, when loaded from the JSON
+        self._fits = {}   # branch -> field_of_current polynomial
+
+    def refresh(self):
+        """Reloads the calibration if its file changed since the last load."""
+        if self.use_model and os.path.exists(self.model_path):
+            source = (self.model_path, os.stat(self.model_path).st_mtime_ns)
+        else:
+            source = (self.path, os.stat(self.path).st_mtime_ns)
+        if source == self._source:
+            return
+        if source[0] == self.model_path:
+            self.model = load_model(self.model_path)
+            self._fits = {branch: _poly(entry['field_of_current'])
+                          for branch, entry in self.model['branches'].items()}
+            # the fit does not pass through the samples, say by how much it misses them
+            for branch, entry in self.model['branches'].items():
+                stats = entry['residuals']
+                print(f"Field calibration: fitted model {self.model_path} ({branch}), residual rms "
+                      f"{stats['rms_mT']:.3f} mT, max {stats['max_mT']:.3f} mT.")
+            # dense inverse tables, built once per load
+            self.tables = {branch: _inverse_table(self._fits[branch], entry['current_range'])
+                           for branch, entry in self.model['branches'].items()}
+        else:
+            self.model = None
+            self._load(source[1])
+        self._source = source
+
+    def _load(self, mtime):
+        try:
+            with np.load(self.sidecar) as npz:
+                if int(npz['mtime']) == mtime:
+                    self.tables = {branch: (npz[f'current_{branch}'], npz[f'field_{branch}'])
+                                   for branch in BRANCHES}
+                    return
+        except (OSError, KeyError, ValueError):
+            pass  # missing, stale-format or unreadable sidecar, rebuild it
+        dataframe = read_raw(self.path)
+        self.tables = {branch: self._monotonic(*branch_samples(dataframe, branch)) for branch in BRANCHES}
+        np.savez(self.sidecar, mtime=mtime,
+                 **{f'current_{branch}': self.tables[branch][0] for branch in BRANCHES},
+                 **{f'field_{branch}': self.tables[branch][1] for branch in BRANCHES})
+
+    @staticmethod
+    def _monotonic(current, field):
+        """
+        Sorts by current and smooths measurement noise into a non-decreasing
+        field curve, then drops repeated field values so it can be inverted.
+        """
+        order = np.argsort(current, kind='stable')
+        current = np.asarray(current, dtype=float)[order]
+        field = np.asarray(field, dtype=float)[order]
+        # mean of the upper and lower monotone envelopes
+        field = (np.maximum.accumulate(field) + np.minimum.accumulate(field[::-1])[::-1]) / 2
+        field, idx = np.unique(field, return_index=True)
+        return current[idx], field
+
+    def field_range(self, branch='up'):
+        self.refresh()
+        field = self.tables[branch][1]
+        return field[0], field[-1]
+
+    def current_for(self, field, branch='up'):
+        """Current (A) for a field (mT) on a branch, interpolated; clipped to the calibrated range."""
+        self.refresh()
+        current_cal, field_cal = self.tables[branch]
+        return np.interp(field, field_cal, current_cal)
+
+    def field_for(self, current, branch='up'):
+        """Field (mT) expected at a current (A) on a branch, clipped to the calibrated range."""
+        self.refresh()
+        current_cal, field_cal = self.tables[branch]
+        if self.model is None:
+            return np.interp(current, current_cal, field_cal)
+        return self._fits[branch](np.clip(current, current_cal[0], current_cal[-1]))
+
+    def dac_coeffs(self):
+        """Current -> DAC code polynomial (highest power first), from the model if there is one."""
+        if os.path.exists(self.model_path):
+            return tuple(load_model(self.model_path)['dac']['coeffs'])
+        return DAC_COEFFS
+
+# --- fitting ----------------------------------------------------------------------
+
+def read_raw(path=CALIBRATION_FILE):
+    """Raw calibration samples; single-sweep CSVs count as both branches."""
+    dataframe = pd.read_csv(path).dropna(subset=['Field_mT'])
+    if 'Branch' not in dataframe:
+        dataframe = pd.concat([dataframe.assign(Branch=branch) for branch in BRANCHES])
+    return dataframe
+
+def branch_samples(dataframe, branch):
+    """(current, field) samples of one branch, or of all of them if it was not measured."""
+    rows = dataframe[dataframe['Branch'] == branch]
+    if rows.empty:
+        rows = dataframe
+    return rows['Current_A'].values.astype(float), rows['Field_mT'].values.astype(float)
+
+def _poly(fit):
+    return Polynomial(fit['coef'], domain=fit['domain'])
+
+def _to_fit(polynomial):
+    return {'coef': polynomial.coef.tolist(), 'domain': polynomial.domain.tolist()}
+
+def _residuals(forward, current, field):
+    residual = field - forward(current)
+    return {'n_points': int(residual.size),
+            'rms_mT': float(np.sqrt(np.mean(residual**2))),
+            'max_mT': float(np.max(np.abs(residual)))}
+
+def _inverse_table(forward, current_range):
+    """Monotonic (current, field) table sampled densely from a forward fit."""
+    current = np.linspace(*current_range, INVERSE_SAMPLES)
+    return FieldCalibration._monotonic(current, forward(current))
+
+def _fit_branch(forward, current_range, stats):
+    current, field = _inverse_table(forward, current_range)
+    return {'field_of_current': _to_fit(forward),
+            'current_range': [float(current_range[0]), float(current_range[1])],
+            'field_range': [float(field[0]), float(field[-1])],
+            'residuals': stats}
+
+def fit_model(dataframe, source=CALIBRATION_FILE, dac_coeffs=DAC_COEFFS, degree=FIT_DEGREE):
+    """
+    Fits field(current) per branch, with residual statistics. The inverse is not
+    stored; FieldCalibration tabulates it from the fit when the model is loaded.
+    """
+    branches = {}
+    for branch in BRANCHES:
+        current, field = branch_samples(dataframe, branch)
+        forward = Polynomial.fit(current, field, degree)
+        branches[branch] = _fit_branch(forward, (current.min(), current.max()),
+                                       _residuals(forward, current, field))
+    return {'version': MODEL_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'source': source,
+            'dac': {'coeffs': list(dac_coeffs)},
+            'branches': branches}
+
+def update_model(model, dataframe, source):
+    """
+    Corrects a fitted model with a sparse set of new samples instead of a full
+    recalibration: the residuals of each measured branch are fitted with a
+    low-order polynomial (offset, then gain, then curvature as points allow)
+    and added to the forward fit.
+    """
+    model = json.loads(json.dumps(model))  # deep copy
+    for branch in BRANCHES:
+        rows = dataframe[dataframe['Branch'] == branch]
+        if rows.empty:
+            continue
+        current = rows['Current_A'].values.astype(float)
+        field = rows['Field_mT'].values.astype(float)
+        entry = model['branches'][branch]
+        forward = _poly(entry['field_of_current'])
+        degree = min(2, len(np.unique(current)) - 1)
+        correction = Polynomial.fit(current, field - forward(current), degree)
+        # add in a common basis, then go back to the original domain
+        forward = (forward.convert() + correction.convert()).convert(domain=forward.domain)
+        model['branches'][branch] = _fit_branch(forward, entry['current_range'],
+                                                _residuals(forward, current, field))
+    model['version'] = MODEL_VERSION
+    model['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    model.setdefault('updates', []).append(source)
+    return model
+
+def save_model(model, path=MODEL_FILE):
+    with open(path, 'w') as f:
+        json.dump(model, f, indent=2)
+
+def load_model(path=MODEL_FILE):
+    with open(path) as f:
+        model = json.load(f)
+    if model.get('version') != MODEL_VERSION:
+        raise ValueError(f"{path} has model version {model.get('version')}, expected {MODEL_VERSION}. "
+                         "Refit it with calibration_model.py.")
+    return model
+
+def describe_calibration(path=CALIBRATION_FILE, model_path=MODEL_FILE, use_model=None):
+    """
+    What FieldCalibration would use right now, for run metadata: the fitted
+    model's version, creation time and number of updates, or the raw CSV and
+    its modification time. None when there is no calibration at all.
+    """
+    use_model = model_enabled() if use_model is None else use_model
+    if use_model and os.path.exists(model_path):
+        with open(model_path) as f:
+            model = json.load(f)
+        return {'source': model_path, 'version': model.get('version'), 'created': model.get('created'),
+                'updates': len(model.get('updates', []))}
+    if os.path.exists(path):
+        modified = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(os.path.getmtime(path)))
+        return {'source': path, 'version': None, 'created': modified, 'updates': 0}
+    return None
+
+if __name__ == "__main__":
+    model = fit_model(read_raw(CALIBRATION_FILE))
+    save_model(model)
+    for branch, entry in model['branches'].items():
+        stats = entry['residuals']
+        print(f"{branch}: {stats['n_points']} points, residual rms {stats['rms_mT']:.3f} mT, "
+              f"max {stats['max_mT']:.3f} mT")
+    print(f"Model saved to '{MODEL_FILE}'.")
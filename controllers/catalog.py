@@ -0,0 +1,262 @@
+"""
+SQLite index of the runs under data/: sweep parameters, timestamps, instrument
+IDs, calibration, point count, setpoint range, measured field range (mT) and
+frequency range. experiment.py registers its run when it finishes; scan()
+indexes runs made before the catalog existed (or copied in) and drops deleted
+ones. Queries only read the index:
+
+    catalog = Catalog()
+    for run in catalog.query(field=50, unit='mT', sparam='s21'):
+        fields, freq, s21 = load_slice(run, 's21', field=(40, 60), freq=(5e9, 8e9))
+
+catalog.query(field=0.5, unit='A') matches current sweeps by setpoint instead.
+
+    python controllers/catalog.py --scan --field 50 --unit mT --sparam s21
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from collections import namedtuple
+import numpy as np
+from dataset import (SPARAMS, META_FILE, FREQ_FILE, FIELDS_FILE, SETPOINTS_FILE, FIELD_UNIT,
+                     is_sweep, legacy_fields, load_ordered)
+
+DATA_DIR = "data"
+CATALOG_FILE = os.path.join(DATA_DIR, "catalog.sqlite")
+CATALOG_VERSION = 2  # the index is rebuilt by scan() when this changes
+
+# run directories named by experiment.py (and the old scripts): s_params_<low><unit>_to_<high><unit>_step_<step><unit>
+RUN_NAME_RE = re.compile(r"^s_params_(?P<low>-?[\d.]+)(?P<unit>mT|A)_to_(?P<high>-?[\d.]+)(?P=unit)"
+                         r"_step_(?P<step>-?[\d.]+)(?P=unit)$")
+
+COLUMNS = (('path', 'TEXT PRIMARY KEY'), ('layout', 'TEXT'), ('unit', 'TEXT'),
+           ('low', 'REAL'), ('high', 'REAL'), ('step', 'REAL'),
+           ('field_min_mT', 'REAL'), ('field_max_mT', 'REAL'),    # measured field
+           ('setpoint_min', 'REAL'), ('setpoint_max', 'REAL'),    # requested, in the run's unit
+           ('freq_min', 'REAL'), ('freq_max', 'REAL'), ('n_freq', 'INTEGER'),
+           ('n_points', 'INTEGER'), ('n_planned', 'INTEGER'),
+           ('sparams', 'TEXT'),  # ',s11,s21,' so a LIKE '%,s21,%' matches exactly
+           ('created', 'TEXT'), ('modified', 'TEXT'),
+           ('magnet_id', 'TEXT'), ('vna_id', 'TEXT'),
+           ('calibration_version', 'INTEGER'), ('calibration_created', 'TEXT'),
+           ('meta', 'TEXT'),     # the run's meta.json, as written
+           ('signature', 'INTEGER'))  # mtime_ns of the run's metadata when it was indexed
+
+Run = namedtuple("Run", [name for name, _ in COLUMNS])
+
+def _timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(seconds))
+
+def _signature(pathname):
+    """Changes whenever a point is added to the run."""
+    if is_sweep(pathname):
+        return os.stat(os.path.join(pathname, META_FILE)).st_mtime_ns
+    keys = legacy_fields(pathname)[1]
+    return max([os.stat(pathname).st_mtime_ns] +
+               [os.stat(os.path.join(pathname, key)).st_mtime_ns for key in keys])
+
+def _bound(reduce, values):
+    """reduce(values) as a float, None when there is no value to reduce."""
+    values = np.asarray(values, dtype=float)
+    return float(reduce(values)) if np.any(~np.isnan(values)) else None
+
+def describe_run(pathname):
+    """Reads a run directory's catalog entry from its files, without loading the traces."""
+    pathname = os.path.normpath(pathname)
+    freq = np.load(os.path.join(pathname, FREQ_FILE), mmap_mode='r')
+    named = RUN_NAME_RE.match(os.path.basename(pathname))
+    params = {k: (v if k == 'unit' else float(v)) for k, v in named.groupdict().items()} if named else {}
+    if is_sweep(pathname):
+        with open(os.path.join(pathname, META_FILE)) as f:
+            meta = json.load(f)
+        n = meta.get('n_points', 0)
+        fields = np.load(os.path.join(pathname, FIELDS_FILE), mmap_mode='r')[:n]
+        setpoints = np.load(os.path.join(pathname, SETPOINTS_FILE), mmap_mode='r')[:n]
+        if meta.get('unit') == FIELD_UNIT:
+            # fall back to the setpoint where the field query failed, as load_ordered does
+            fields = np.where(np.isnan(fields), setpoints, fields)
+        layout, sparams, n_planned = 'sweep', meta.get('s_params', list(SPARAMS)), meta.get('n_fields')
+        modified = os.path.getmtime(os.path.join(pathname, META_FILE))
+    else:
+        setpoints, sparams = legacy_fields(pathname)
+        # old runs only have the setpoints, which are the field for mT sweeps
+        fields = setpoints if params.get('unit') == FIELD_UNIT else np.full(len(setpoints), np.nan)
+        meta, layout, n, n_planned = {}, 'legacy', len(setpoints), None
+        modified = os.path.getmtime(pathname)
+    instruments = meta.get('instruments') or {}
+    calibration = meta.get('calibration') or {}
+    return Run(
+        path=pathname, layout=layout, unit=meta.get('unit', params.get('unit')),
+        low=meta.get('low', params.get('low')), high=meta.get('high', params.get('high')),
+        step=meta.get('step', params.get('step')),
+        field_min_mT=_bound(np.nanmin, fields), field_max_mT=_bound(np.nanmax, fields),
+        setpoint_min=_bound(np.nanmin, setpoints), setpoint_max=_bound(np.nanmax, setpoints),
+        freq_min=float(freq[0]) if freq.size else None, freq_max=float(freq[-1]) if freq.size else None,
+        n_freq=int(freq.size), n_points=int(n), n_planned=n_planned,
+        sparams=',' + ','.join(sparams) + ',',
+        created=meta.get('created', _timestamp(os.path.getmtime(os.path.join(pathname, FREQ_FILE)))),
+        modified=_timestamp(modified),
+        magnet_id=instruments.get('magnet'), vna_id=instruments.get('vna'),
+        calibration_version=calibration.get('version'), calibration_created=calibration.get('created'),
+        meta=json.dumps(meta), signature=_signature(pathname))
+
+def is_run(pathname):
+    return os.path.isfile(os.path.join(pathname, FREQ_FILE)) and (
+        is_sweep(pathname) or bool(legacy_fields(pathname)[1]))
+
+class Catalog:
+    """The run index; opened per use, every method commits before it returns."""
+    def __init__(self, path=CATALOG_FILE):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=10)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != CATALOG_VERSION:
+            # an index of another version: start over, scan() refills it
+            with self.db:
+                self.db.execute("DROP TABLE IF EXISTS runs")
+                self.db.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+        with self.db:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS runs "
+                            f"({', '.join(f'{name} {kind}' for name, kind in COLUMNS)})")
+            self.db.execute("CREATE INDEX IF NOT EXISTS runs_by_field ON runs (field_min_mT, field_max_mT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS runs_by_setpoint ON runs (unit, setpoint_min, setpoint_max)")
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def register(self, pathname):
+        """Adds or updates one run directory; returns its entry."""
+        run = describe_run(pathname)
+        with self.db:
+            self.db.execute(f"INSERT OR REPLACE INTO runs VALUES ({', '.join('?' * len(COLUMNS))})", run)
+        return run
+
+    def scan(self, root=DATA_DIR):
+        """
+        Brings the index in line with the run directories under root: new or
+        changed runs are (re)read, entries of deleted ones removed.
+        Returns the number of runs read.
+        """
+        known = dict(self.db.execute("SELECT path, signature FROM runs"))
+        found, read = set(), 0
+        for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+            pathname = os.path.normpath(os.path.join(root, name))
+            if not is_run(pathname):
+                continue
+            found.add(pathname)
+            if known.get(pathname) != _signature(pathname):
+                self.register(pathname)
+                read += 1
+        prefix = os.path.normpath(root) + os.sep
+        with self.db:
+            self.db.executemany("DELETE FROM runs WHERE path = ?",
+                                [(path,) for path in known if path.startswith(prefix) and path not in found])
+        return read
+
+    def get(self, pathname):
+        """The entry of a run directory, or None if it is not indexed."""
+        row = self.db.execute("SELECT * FROM runs WHERE path = ?", (os.path.normpath(pathname),)).fetchone()
+        return Run(*row) if row else None
+
+    def query(self, field=None, unit=None, sparam=None, freq=None, since=None, complete=False):
+        """
+        Runs matching every given criterion, oldest first:
+          field:    a field the sweep covers, in unit: a measured field in mT (current
+                    sweeps included), or a current setpoint in A (only 'A' runs)
+          unit:     'mT' (default for field) or 'A'; without field, runs swept in that unit
+          sparam:   an S-parameter the run holds, e.g. 's21'
+          freq:     a frequency (Hz) inside the run's span
+          since:    created at or after this ISO time, e.g. '2025-01-31'
+          complete: only runs with all their planned points
+        """
+        where, args = [], []
+        if field is not None and unit in (None, FIELD_UNIT):
+            where.append("field_min_mT <= ? AND field_max_mT >= ?")
+            args += [field, field]
+        elif field is not None:
+            where.append("unit = ? AND setpoint_min <= ? AND setpoint_max >= ?")
+            args += [unit, field, field]
+        elif unit is not None:
+            where.append("unit = ?")
+            args.append(unit)
+        if sparam is not None:
+            if sparam not in SPARAMS:
+                raise ValueError(f"Unknown S-parameter '{sparam}', expected one of {SPARAMS}.")
+            where.append("sparams LIKE ?")
+            args.append(f"%,{sparam},%")
+        if freq is not None:
+            where.append("freq_min <= ? AND freq_max >= ?")
+            args += [freq, freq]
+        if since is not None:
+            where.append("created >= ?")
+            args.append(since)
+        if complete:
+            where.append("n_planned IS NOT NULL AND n_points >= n_planned")
+        sql = "SELECT * FROM runs" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY created"
+        return [Run(*row) for row in self.db.execute(sql, args)]
+
+def _index_range(values, span):
+    """Index range of sorted values for None (all), a scalar (the nearest) or a (low, high) span."""
+    if span is None:
+        return 0, len(values)
+    if np.isscalar(span):
+        i = int(np.argmin(np.abs(values - span)))
+        return i, i + 1
+    low, high = sorted(span)
+    return int(np.searchsorted(values, low, 'left')), int(np.searchsorted(values, high, 'right'))
+
+def load_slice(run, sparam='s21', field=None, freq=None):
+    """
+    Reads part of a run: field and freq are None (all), a value (the nearest
+    row/column) or a (low, high) span in the unit of the run's field axis and
+    Hz; that is the measured field in mT, or A for old current runs saved per
+    setpoint (see dataset.load_ordered). Returns (fields, freq, (n_fields, n_freq)
+    complex matrix), rows sorted by field.
+    Consolidated sweeps stay memory-mapped, so only the slice is read.
+    """
+    pathname = run.path if isinstance(run, Run) else run
+    fields, frequency, s_params, order, _ = load_ordered(pathname)
+    if sparam not in s_params:
+        raise ValueError(f"{pathname} has no {sparam} data.")
+    r0, r1 = _index_range(fields, field)
+    c0, c1 = _index_range(frequency, freq)
+    return fields[r0:r1], frequency[c0:c1], np.asarray(s_params[sparam][order[r0:r1], c0:c1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lists the indexed runs under data/.")
+    parser.add_argument('--scan', action='store_true', help="re-index data/ first")
+    parser.add_argument('--field', type=float, help="runs covering this measured field (mT) or, "
+                                                    "with --unit A, current setpoint")
+    parser.add_argument('--unit', choices=['mT', 'A'])
+    parser.add_argument('--sparam', choices=SPARAMS)
+    parser.add_argument('--freq', type=float, help="runs covering this frequency (Hz)")
+    parser.add_argument('--since', help="runs created at or after this ISO date")
+    parser.add_argument('--complete', action='store_true', help="only runs with all planned points")
+    args = parser.parse_args(argv)
+    fresh = not os.path.exists(CATALOG_FILE)
+    with Catalog() as catalog:
+        if args.scan or fresh:
+            print(f"Indexed {catalog.scan()} runs.")
+        runs = catalog.query(args.field, args.unit, args.sparam, args.freq, args.since, args.complete)
+        for run in runs:
+            span = ("no points" if run.setpoint_min is None else
+                    f"{run.setpoint_min:g} to {run.setpoint_max:g} {run.unit}")
+            if run.unit != FIELD_UNIT and run.field_min_mT is not None:
+                span += f" ({run.field_min_mT:g} to {run.field_max_mT:g} {FIELD_UNIT})"
+            band = ("no frequencies" if run.freq_min is None else
+                    f"{run.freq_min * 1e-9:g}-{run.freq_max * 1e-9:g} GHz")
+            print(f"{run.path}: {run.n_points} points, {span}, {band}, {run.sparams.strip(',')}, "
+                  f"created {run.created}")
+        print(f"{len(runs)} runs.")
+
+if __name__ == "__main__":
+    main()
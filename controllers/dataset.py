@@ -0,0 +1,188 @@
+import os, json, time
+import numpy as np
+
+SPARAMS = ('s11', 's12', 's21', 's22')
+
+DATA_FILE = 'sweep.npy'
+FIELDS_FILE = 'fields.npy'
+SETPOINTS_FILE = 'setpoints.npy'
+FREQ_FILE = 'frequency.npy'
+META_FILE = 'meta.json'
+FIELD_UNIT = 'mT'  # fields.npy holds the measured field, in mT for current sweeps too
+
+class SweepWriter:
+    """
+    Streams a field sweep into one preallocated, memory-mapped container per run:
+      sweep.npy      complex128 (n_fields, 4, n_freq), S-parameters in SPARAMS order
+      setpoints.npy  requested setpoint of each row
+      fields.npy     field measured at each row (NaN until written)
+      frequency.npy  frequency axis (Hz)
+      meta.json      sweep parameters and the number of rows written
+    The arrays are allocated on the first append(), once the point count is known.
+    With resume=True an existing container is reopened and appended to.
+    """
+    def __init__(self, pathname, n_fields, unit, meta=None, resume=False):
+        self.pathname = pathname
+        self.n_fields = n_fields
+        self.meta = {'unit': unit, 'n_fields': n_fields, 's_params': list(SPARAMS),
+                     'created': time.strftime('%Y-%m-%dT%H:%M:%S'), **(meta or {})}
+        self.n = 0
+        self.data = None
+        self.setpoints = None
+        self.fields = None
+        os.makedirs(pathname, exist_ok=True)
+        if resume and is_sweep(pathname) and os.path.isfile(self._path(DATA_FILE)):
+            self._reopen()
+
+    def _reopen(self):
+        with open(self._path(META_FILE)) as f:
+            saved = json.load(f)
+        self.data = np.load(self._path(DATA_FILE), mmap_mode='r+')
+        self.setpoints = np.load(self._path(SETPOINTS_FILE), mmap_mode='r+')
+        self.fields = np.load(self._path(FIELDS_FILE), mmap_mode='r+')
+        if len(self.data) != self.n_fields:
+            raise RuntimeError(f"{self.pathname} holds {len(self.data)} points, expected {self.n_fields}.")
+        self.meta.update(created=saved['created'], n_freq=saved['n_freq'])
+        self.n = saved.get('n_points', 0)
+
+    def _path(self, name):
+        return os.path.join(self.pathname, name)
+
+    def _allocate(self, freq):
+        open_memmap = np.lib.format.open_memmap
+        self.data = open_memmap(self._path(DATA_FILE), mode='w+', dtype=np.complex128,
+                                shape=(self.n_fields, len(SPARAMS), len(freq)))
+        self.setpoints = open_memmap(self._path(SETPOINTS_FILE), mode='w+',
+                                     dtype=np.float64, shape=(self.n_fields,))
+        self.fields = open_memmap(self._path(FIELDS_FILE), mode='w+',
+                                  dtype=np.float64, shape=(self.n_fields,))
+        self.setpoints[:] = np.nan
+        self.fields[:] = np.nan
+        np.save(self._path(FREQ_FILE), freq)
+        self.meta['n_freq'] = len(freq)
+
+    def append(self, setpoint, field, freq, traces):
+        """Writes one field point; `traces` maps 's11'... to complex arrays."""
+        if self.data is None:
+            self._allocate(freq)
+        if self.n >= self.n_fields:
+            raise IndexError(f"Sweep container is full ({self.n_fields} points).")
+        row = self.data[self.n]
+        for k, s in enumerate(SPARAMS):
+            row[k] = traces[s]
+        self.setpoints[self.n] = setpoint
+        self.fields[self.n] = np.nan if field is None else field
+        self.n += 1
+        self.flush()
+
+    def flush(self):
+        """Pushes written rows to disk and records how many are valid."""
+        for array in (self.data, self.setpoints, self.fields):
+            if array is not None:
+                array.flush()
+        self.meta['n_points'] = self.n
+        with open(self._path(META_FILE), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+    def close(self):
+        self.flush()
+        self.data = self.setpoints = self.fields = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def is_sweep(pathname):
+    """True if `pathname` holds a consolidated sweep container."""
+    return os.path.isfile(os.path.join(pathname, META_FILE))
+
+def load_sweep(pathname, mmap_mode='r'):
+    """
+    Opens a sweep written by SweepWriter without copying it into memory.
+    Returns (fields, setpoints, freq, {'s11': (n_points, n_freq) array, ...}, meta).
+    """
+    with open(os.path.join(pathname, META_FILE)) as f:
+        meta = json.load(f)
+    n = meta.get('n_points', 0)
+    freq = np.load(os.path.join(pathname, FREQ_FILE))
+    data = np.load(os.path.join(pathname, DATA_FILE), mmap_mode=mmap_mode)[:n]
+    fields = np.load(os.path.join(pathname, FIELDS_FILE), mmap_mode=mmap_mode)[:n]
+    setpoints = np.load(os.path.join(pathname, SETPOINTS_FILE), mmap_mode=mmap_mode)[:n]
+    s_params = {s: data[:, k, :] for k, s in enumerate(SPARAMS)}
+    return fields, setpoints, freq, s_params, meta
+
+def _parse_unit(filename):
+    """'-0.10A.npy' -> 'A', '5.00mT.npy' -> 'mT'."""
+    stem = os.path.splitext(filename)[0]
+    return stem[len(stem.rstrip('AaTtm')):]
+
+def _parse_field(filename):
+    """'-0.10A.npy' -> -0.1; the unit suffix is ignored."""
+    return float(os.path.splitext(filename)[0].rstrip('AaTtm'))
+
+def legacy_fields(pathname):
+    """Sorted fields and S-parameters of an old-layout run, from its file names alone."""
+    keys = [s for s in SPARAMS if os.path.isdir(os.path.join(pathname, s))]
+    if not keys:
+        return np.empty(0), keys
+    fields = np.sort([_parse_field(name) for name in os.listdir(os.path.join(pathname, keys[0]))])
+    return fields, keys
+
+def load_legacy(pathname, mmap_mode='r'):
+    """
+    Loads the old one-.npy-per-point layout (<run>/s21/<field><unit>.npy) into
+    one preallocated array per S-parameter, rows sorted by the field parsed
+    from the file names. Returns (fields, freq, {'s11': (n_fields, n_freq), ...}).
+    """
+    freq = np.load(os.path.join(pathname, FREQ_FILE))
+    keys = [s for s in SPARAMS if os.path.isdir(os.path.join(pathname, s))]
+    s_params = {}
+    fields = None
+    for key in keys:
+        files = np.array(sorted(os.listdir(os.path.join(pathname, key))))
+        key_fields = np.array([_parse_field(name) for name in files])
+        order = np.argsort(key_fields, kind='stable')
+        if fields is None:
+            fields = key_fields[order]
+        elif not np.array_equal(fields, key_fields[order]):
+            raise RuntimeError(f"{key} was saved at different fields than {keys[0]}.")
+        first = np.load(os.path.join(pathname, key, files[order[0]]), mmap_mode=mmap_mode)
+        matrix = np.empty((len(files), first.size), dtype=first.dtype)
+        for row, name in enumerate(files[order]):
+            matrix[row] = np.load(os.path.join(pathname, key, name), mmap_mode=mmap_mode)
+        s_params[key] = matrix
+    return fields, freq, s_params
+
+def load_ordered(pathname):
+    """
+    Like load_matrices, but leaves the rows where they are: returns
+    (fields, freq, s_params, order, unit) with fields sorted and
+    s_params[key][order[i]] the row of fields[i], so memory-mapped sweeps are
+    never copied. unit is that of the field axis: consolidated sweeps hold the
+    measured field in mT whatever the sweep unit, old runs the setpoint.
+    """
+    if not is_sweep(pathname):
+        fields, freq, s_params = load_legacy(pathname)
+        key = next(iter(s_params), None)
+        unit = _parse_unit(os.listdir(os.path.join(pathname, key))[0]) if key else FIELD_UNIT
+        return fields, freq, s_params, np.arange(len(fields)), unit
+    fields, setpoints, freq, s_params, meta = load_sweep(pathname)
+    if meta.get('unit', FIELD_UNIT) == FIELD_UNIT:
+        # fall back to the setpoint where the field query failed
+        fields = np.where(np.isnan(fields), setpoints, fields)
+    # rows still without a field (current sweeps) are left out
+    order = np.argsort(fields, kind='stable')[:np.count_nonzero(~np.isnan(fields))]
+    return fields[order], freq, s_params, order, FIELD_UNIT
+
+def load_matrices(pathname):
+    """
+    Loads either layout as (fields, freq, {'s11': (n_fields, n_freq), ...}, unit),
+    rows sorted by field, unit that of the fields (see load_ordered).
+    Consolidated sweeps stay memory-mapped unless they have to be reordered.
+    """
+    fields, freq, s_params, order, unit = load_ordered(pathname)
+    if not np.array_equal(order, np.arange(len(fields))) or any(len(m) != len(order) for m in s_params.values()):
+        s_params = {s: matrix[order] for s, matrix in s_params.items()}
+    return fields, freq, s_params, unit
@@ -1,9 +1,22 @@
 from EM3000S import MagnetController
 from VNA import VNAController
 # from lab_emulator import MagnetController, VNAController
+from dataset import SweepWriter, SPARAMS
+from session import open_instruments
+from sweep import SweepEngine
+from planner import refine_setpoints, order_setpoints
+from journal import Journal
+from live_plot import LivePlot
+from catalog import Catalog
+from calibration_model import describe_calibration
 import numpy as np
 import configparser
-import time, os
+import signal
+import os
+
+# the GUI's Cancel button sends CTRL_BREAK on Windows, treat it like Ctrl+C
+if hasattr(signal, 'SIGBREAK'):
+    signal.signal(signal.SIGBREAK, signal.default_int_handler)
 
 dir = "data"
 CONFIG_FILE = 'params.ini'
@@ -20,6 +33,12 @@ try:
     CURRENT_LOW = float(config.get('Experiment', 'low', fallback='0'))
     CURRENT_HIGH = float(config.get('Experiment', 'high', fallback='1'))
     STEP = float(config.get('Experiment', 'step', fallback='0.1'))
+    # extra points placed where the response changes fastest, 0 for a plain grid
+    REFINE = int(config.get('Experiment', 'refine', fallback='0'))
+    # passes over the grid, alternating direction
+    REPEATS = int(config.get('Experiment', 'repeats', fallback='1'))
+    # 1 shows the maps while they are measured, see controllers/live_plot.py
+    LIVE = int(config.get('Experiment', 'live', fallback='0'))
    
     print("Config loaded successfully.")
 except Exception as e:
@@ -31,40 +50,67 @@ if UNIT == 'A':
 
 pathname = os.path.join(dir, f"s_params_{CURRENT_LOW}{UNIT}_to_{CURRENT_HIGH}{UNIT}_step_{STEP}{UNIT}")
 
-s_params = ['s11', 's12', 's21', 's22']
-s_param_dirs = [os.path.join(pathname, s) for s in s_params]
-for subdir in s_param_dirs:
-    os.makedirs(subdir, exist_ok=True)
-
 print("Connecting to VNA and Magnet Controllers...")
 
-vna = VNAController()
-magnet = MagnetController()
+magnet, vna = open_instruments(('magnet', MagnetController), ('vna', VNAController))
 
-magnet.connect()
-vna.connect()
+# serpentine passes starting from the end nearest zero field
+currs = order_setpoints(np.arange(CURRENT_LOW, CURRENT_HIGH + STEP, STEP), start=0.0, repeats=REPEATS)
+
+# check the whole plan, as it will be run, against the supply limit and the calibration
+# before moving the magnet
+magnet.preflight(currs, UNIT)
 
 print("Sweeping...")
+definition = {'unit': UNIT, 'low': CURRENT_LOW, 'high': CURRENT_HIGH, 'step': STEP,
+              'refine': REFINE, 'repeats': REPEATS}
+
+# completed points are journaled, so a crashed run picks up where it stopped
+os.makedirs(pathname, exist_ok=True)
+journal = Journal(os.path.join(pathname, 'journal.jsonl'), definition)
+# catalog metadata, kept out of the definition so it doesn't stop a resume
+meta = {**definition, 'instruments': {'magnet': os.getenv("EM_ID"), 'vna': os.getenv("VNA_ID")},
+        'calibration': describe_calibration()}
+writer = SweepWriter(pathname, len(currs) + REFINE, UNIT, meta=meta, resume=True)
+writer.n = min(writer.n, len(journal.entries))
+record = lambda setpoint, field, freq, traces: journal.record(row=writer.n - 1, setpoint=setpoint, field=field)
+set_point = magnet.set_current if UNIT == 'A' else magnet.set_field
+live = LivePlot(UNIT, os.path.basename(pathname)) if LIVE else None
+on_point = [record] + ([live.push] if live else [])
+
+try:
+    if writer.n == writer.n_fields:
+        print(f"{pathname} is already complete, delete it to measure again.")
+    elif writer.n:
+        print(f"Resuming after {writer.n} points...")
+        # re-approach the last good setpoint so the next one comes from the same side
+        set_point(writer.setpoints[writer.n - 1])
+    SweepEngine(magnet, vna, writer, currs[writer.n:], unit=UNIT, on_point=on_point).run()
+    # adaptive passes: split the intervals where |S21| changes most, down to STEP/8
+    while writer.n < writer.n_fields:
+        s21 = writer.data[:writer.n, SPARAMS.index('s21'), :]
+        extra = refine_setpoints(writer.setpoints[:writer.n], s21,
+                                 budget=writer.n_fields - writer.n, min_step=STEP / 8)
+        if extra.size == 0:
+            break
+        print(f"Refining with {extra.size} extra points...")
+        extra = order_setpoints(extra, start=writer.setpoints[writer.n - 1])
+        SweepEngine(magnet, vna, writer, extra, unit=UNIT, on_point=on_point).run()
+except KeyboardInterrupt:
+    print(f"Sweep cancelled after {writer.n} points, run again to resume.")
+finally:
+    writer.close()
+    journal.close()
+    if live:
+        live.close()
+
+    print("Stopping magnet...")
+    magnet.stop_and_query_field()
+
+    magnet.disconnect()
 
-currs = np.arange(CURRENT_LOW, CURRENT_HIGH + STEP, STEP)
-s_param_magnitudes = {'s11': [], 's12': [], 's21': [], 's22': []}
-
-for curr in currs:
-    print(f"Setting field to {curr:.2f} mT")
-    curr_return = magnet.set_field(curr)
-    time.sleep(2)  # Wait for the magnet to stabilize
-    freq, s11 = vna.read_s11()
-    _, s12 = vna.read_s12()
-    _, s21 = vna.read_s21()
-    _, s22 = vna.read_s22()
-    np.save(os.path.join(pathname, 'frequency.npy'), freq)
-    for s in s_params:
-        np.save(os.path.join(pathname, s, f"{curr_return:.2f}{UNIT}.npy"), eval(s))
-
-print("Stopping magnet...")
-magnet.stop_and_query_field()
-
-magnet.disconnect()
+with Catalog() as catalog:
+    catalog.register(pathname)
 
 print("Data saved.\n")
 
@@ -0,0 +1,60 @@
+import os, json, hashlib
+
+def definition_hash(definition):
+    """Short, stable hash of a sweep definition (a JSON-serialisable dict)."""
+    text = json.dumps(definition, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+class Journal:
+    """
+    Append-only record of completed sweep points, one JSON object per line,
+    synced to disk after every entry. The first line holds the hash of the
+    sweep definition; reopening the journal with a different definition raises
+    instead of mixing two sweeps into one run.
+    """
+    def __init__(self, path, definition):
+        self.path = path
+        self.hash = definition_hash(definition)
+        self.entries = []
+        # empty or headerless, e.g. a crash while it was being created: start it anew
+        if not (os.path.exists(path) and self._read()):
+            with open(path, 'w') as f:
+                f.write(json.dumps({'definition': definition, 'hash': self.hash}) + '\n')
+        self._file = open(path, 'a')
+
+    def _read(self):
+        """Loads the entries; False if the file has no header to check them against."""
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except json.JSONDecodeError:
+            return False
+        if not isinstance(header, dict) or 'hash' not in header:
+            return False
+        if header['hash'] != self.hash:
+            raise RuntimeError(f"{self.path} belongs to a different sweep definition "
+                               f"({header.get('definition')}). Move or delete it to start over.")
+        for line in lines[1:]:
+            try:
+                self.entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # torn last line from a crash: drop it, that point is redone
+                with open(self.path, 'w') as f:
+                    f.write('\n'.join(lines[:len(self.entries) + 1]) + '\n')
+                break
+        return True
+
+    def record(self, **entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.entries.append(entry)
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        """Deletes the journal once its sweep has been saved for good."""
+        self.close()
+        os.remove(self.path)
@@ -1,24 +1,91 @@
+"""
+Emulated instruments for development and offline benchmarking.
+Both controllers keep the real APIs. Instrument time runs on a shared clock
+scaled by EMULATOR_TIME_SCALE (e.g. 0.1 runs ten times faster than the lab),
+so a sweep takes the wall time it would take in the lab, scaled.
+"""
 import os
+import time
 import numpy as np
+from tracing import tracer, configure_from_env
+
+TIME_SCALE = float(os.getenv("EMULATOR_TIME_SCALE", "1.0"))
+if not TIME_SCALE > 0:
+    # emulated time is wall time / TIME_SCALE, it cannot run infinitely fast
+    raise ValueError(f"EMULATOR_TIME_SCALE must be > 0, got {TIME_SCALE}.")
+
+# --- Magnet: serial link and supply ----------------------------------------------
+MAGNET_TIMING = {
+    'serial_step_sec': 0.012,   # one written byte and its acknowledgement at 19200 baud
+    'ack_wait_sec': 0.05,       # START/STOP/END commands wait for the ACK byte
+    'ramp_A_per_sec': 2.0,      # supply slew rate
+    'settle_tau_sec': 0.4,      # eddy-current lag of the field behind the current
+}
+MAGNET_PHYSICS = {
+    'saturation_mT': 480.0,     # B = saturation * tanh((I -/+ coercive) / width)
+    'width_A': 5.0,
+    'coercive_A': 0.08,         # shift between the up and down branches
+    'noise_mT': 0.05,
+    'max_current_A': 4.0,
+}
+
+# --- VNA: SCPI link and sweep ------------------------------------------------------
+VNA_TIMING = {
+    'scpi_latency_sec': 0.003,  # one query round trip
+    'ifbw_hz': 100e3,           # sweep time ~ points / IF bandwidth
+    'sweep_overhead_sec': 0.02,
+    'bytes_per_sec': 2e6,       # trace transfer rate
+}
+VNA_PHYSICS = {
+    'gamma_GHz_per_T': 28.0,    # Kittel: f = gamma * sqrt(B (B + mu0 Ms))
+    'mu0_Ms_T': 0.175,
+    'damping': 0.004,           # Gilbert damping, linewidth 2 alpha f + inhomogeneous
+    'inhomogeneous_GHz': 0.02,
+    'coupling': 2e-3,           # |S21| added on resonance (the saved background is ~1e-4)
+    'noise': 1e-5,
+}
+# trace transfer formats, as VNA.DATA_FORMATS; None is comma-separated ASCII
+DATA_TYPES = {"ascii": None, "real32": "<f4", "real64": "<f8"}
+SPARAM_TRACES = {"S11": "MeasS11", "S12": "MeasS12", "S21": "MeasS21", "S22": "MeasS22"}
+
+def _sleep(sec):
+    if sec > 0:
+        time.sleep(sec * TIME_SCALE)
+
+def _now():
+    """Emulated instrument time in seconds."""
+    return time.monotonic() / TIME_SCALE
+
+# the magnet the emulated VNA sits in; set when a MagnetController connects
+_bench = {'magnet': None}
 
 class VNAController:
     """
     Facilitating a virtual VNA for development.
-    Returns data saved from an R&S ZNLE18 VNA.
+    The background is the data saved from an R&S ZNLE18 VNA; on top of it,
+    S21 and S12 carry a ferromagnetic resonance that moves with the field of
+    the emulated magnet. Sweeps and transfers take as long as the settings imply.
     """
-    def __init__(self, timeout_ms=50000, backend=None):
+    def __init__(self, timeout_ms=50000, backend=None, data_format="real32",
+                 timing=None, physics=None, seed=None):
+        if data_format not in DATA_TYPES:
+            raise ValueError(f"Unknown data format '{data_format}', expected one of {sorted(DATA_TYPES)}.")
         self.rm = None
         self.vna = None
+        self.data_format = data_format
+        self.timing = {**VNA_TIMING, **(timing or {})}
+        self.physics = {**VNA_PHYSICS, **(physics or {})}
+        self.rng = np.random.default_rng(seed)
         with open(os.path.join("dev","s_parameters.npz"), 'rb') as f:
             self.data = np.load(f)
-            self.freq = self.data['frequency']
-            self.s11 = self.data['S11']
-            self.s12 = self.data['S12']
-            self.s21 = self.data['S21']
-            self.s22 = self.data['S22']
+            self.background = {name: self.data[name] for name in ('S11', 'S12', 'S21', 'S22')}
+            self._background_freq = self.data['frequency']
+        self.freq = self._background_freq
+        self._traces = None
 
     def connect(self):
         print("Emulated VNA connected.")
+        configure_from_env()
         self.rm = True
         self.vna = True
         return "EMULATED_VNA"
@@ -28,79 +95,281 @@ class VNAController:
         self.vna = None
         self.rm = None
 
-    def read_s11(self):
-        freq = self.freq
-        s11 = self.s11
-        return freq, s11
-    
-    def read_s12(self):
-        freq = self.freq    
-        s12 = self.s12
-        return freq, s12
-
-    def read_s21(self):
-        freq = self.freq
-        s21 = self.s21
-        return freq, s21
-    
-    def read_s22(self):
-        freq = self.freq
-        s22 = self.s22
-        return freq, s22
-
     def disconnect(self):
-        self.rm = None
-        self.vna = None
+        self.close()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def read_s11(self): return self._read_sparam('s11')
+    def read_s12(self): return self._read_sparam('s12')
+    def read_s21(self): return self._read_sparam('s21')
+    def read_s22(self): return self._read_sparam('s22')
+
+    def set_sweep(self, f_start=None, f_stop=None, npts=None):
+        self._require_connection()
+        f_start = self.freq[0] if f_start is None else f_start
+        f_stop = self.freq[-1] if f_stop is None else f_stop
+        npts = self.freq.size if npts is None else int(npts)
+        _sleep(3 * self.timing['scpi_latency_sec'])
+        self.freq = np.linspace(f_start, f_stop, npts)
+        return self.freq
+
+    def clear_cache(self):
+        pass
+
+    def read_all_sparams(self):
+        self.trigger_sweep()
+        return self.fetch_all_sparams()
+
+    def trigger_sweep(self):
+        """Sweeps at the field the magnet has when the sweep starts."""
+        self._require_connection()
+        magnet = _bench['magnet']
+        field = magnet.field_now() if magnet is not None else 0.0
+        with tracer.span('vna', 'sweep', "INIT1"):
+            _sleep(self.timing['scpi_latency_sec'] + self.timing['sweep_overhead_sec']
+                   + self.freq.size / self.timing['ifbw_hz'])
+        self._traces = self._response(field)
+
+    def fetch_all_sparams(self):
+        self._require_connection()
+        if self._traces is None:
+            raise RuntimeError("No sweep to fetch, call trigger_sweep() first.")
+        traces = {code.lower(): self._fetch_trace(trace_name) for code, trace_name in SPARAM_TRACES.items()}
+        return self.freq, traces
+
+    # --- internals ------------------------------------------------------------
+    def _require_connection(self):
+        if self.vna is None:
+            raise RuntimeError("Not connected. Call connect() first.")
+
+    def _fetch_trace(self, trace_name):
+        """Transfers one trace in the configured format and parses it, like the real controller."""
+        with tracer.span('vna', 'trace', trace_name):
+            return self._parse_block(self._read_block(trace_name))
+
+    def _read_block(self, trace_name):
+        code = next(code for code, name in SPARAM_TRACES.items() if name == trace_name)
+        values = self._traces[code.lower()].view(np.float64)  # interleaved Re,Im
+        datatype = DATA_TYPES[self.data_format]
+        if datatype is None:
+            raw = ",".join(f"{v:.9e}" for v in values)
+        else:
+            raw = values.astype(datatype).tobytes()
+        _sleep(self.timing['scpi_latency_sec'] + len(raw) / self.timing['bytes_per_sec'])
+        return raw
+
+    def _parse_block(self, raw):
+        datatype = DATA_TYPES[self.data_format]
+        if datatype is None:
+            data = np.array(raw.split(","), dtype=float)
+        else:
+            data = np.frombuffer(raw, dtype=datatype)
+        return data.astype(np.float64).view(np.complex128)
+
+    def _read_sparam(self, name):
+        self.trigger_sweep()
+        freq, traces = self.fetch_all_sparams()
+        return freq, traces[name]
+
+    def resonance_GHz(self, field_mT):
+        """Kittel frequency (GHz) of the emulated sample at a field (mT)."""
+        p = self.physics
+        b = abs(field_mT) * 1e-3
+        return p['gamma_GHz_per_T'] * np.sqrt(b * (b + p['mu0_Ms_T']))
+
+    def _response(self, field_mT):
+        p = self.physics
+        f_ghz = self.freq * 1e-9
+        f_res = self.resonance_GHz(field_mT)
+        half_width = p['damping'] * f_res + p['inhomogeneous_GHz'] / 2
+        resonance = p['coupling'] * half_width / (half_width - 1j * (f_ghz - f_res))
+        traces = {}
+        for name, background in self.background.items():
+            trace = np.interp(self.freq, self._background_freq, background.real) \
+                + 1j * np.interp(self.freq, self._background_freq, background.imag)
+            if name in ('S21', 'S12'):
+                trace = trace + resonance
+            noise = self.rng.normal(scale=p['noise'], size=(2, trace.size))
+            traces[name.lower()] = trace + noise[0] + 1j * noise[1]
+        return traces
 
 class MagnetController:
     """
     Facilitating a virtual Magnet Controller for development.
-    Simulates setting current and stopping.
+    The supply ramps the current at a fixed slew rate; the field follows the
+    up or down hysteresis branch of a tanh magnetization curve and lags the
+    current with a first-order time constant. Every call costs the serial
+    time of its handshake.
     """
-    def __init__(self, resource_name=None):
+    def __init__(self, resource_name=None, timing=None, physics=None, seed=None):
         self.inst = None
         self.rm = None
+        self.timing = {**MAGNET_TIMING, **(timing or {})}
+        self.physics = {**MAGNET_PHYSICS, **(physics or {})}
+        self.rng = np.random.default_rng(seed)
         self.current = 0.0
+        # current ramp from _ramp_from to current, starting at _t0; the field
+        # is target(I(t)) + lag, with lag relaxing from _lag0 at _t0
+        self._ramp_from = 0.0
+        self._t0 = _now()
+        self._lag0 = 0.0
+        self._branch = 'up'
+        self._last_field = 0.0
         # self.connect()
 
     def connect(self):
         print("Emulated Magnet Controller connected.")
+        configure_from_env()
         self.inst = True
+        _bench['magnet'] = self
         return "EMULATED_MAGNET"
 
     def disconnect(self):
-        self.rm = None
-        self.vna = None
+        print("Emulated Magnet Controller disconnected.")
+        self.inst = None
+        if _bench['magnet'] is self:
+            _bench['magnet'] = None
 
     def set_current(self, current):
-        if self.inst is None:
-            raise RuntimeError("Magnet Controller not connected.")
-        self.current = current
+        self._require_connection()
+        if abs(current) > self.physics['max_current_A']:
+            raise ValueError(f"Current {current} A out of range for Magnet Controller.")
+        with tracer.span('magnet', 'handshake', 'START'):
+            _sleep(8 * self.timing['serial_step_sec'] + 2 * self.timing['ack_wait_sec'])
+        self._start_ramp(float(current))
         print(f"Emulated Magnet current set to {current} A.")
         return current
 
     def set_field(self, field):
-        if self.inst is None:
-            raise RuntimeError("Magnet Controller not connected.")
-        self.field = field
-        print(f"Emulated Magnet field set to {field} mT.")
-        return field
+        """Sets the current for `field` on the branch it is approached on; returns the expected field."""
+        self._require_connection()
+        if field > self._last_field:
+            self._branch = 'up'
+        elif field < self._last_field:
+            self._branch = 'down'
+        current = self.current_for(field, self._branch)
+        self.set_current(current)
+        self._last_field = field
+        return float(self.target(current, self._branch))
 
     def stop_and_query_field(self):
-        if self.inst is None:
-            raise RuntimeError("Magnet Controller not connected.")
+        self._require_connection()
+        field = self.query_field()
+        with tracer.span('magnet', 'handshake', 'STOP'):
+            _sleep(3 * self.timing['serial_step_sec'] + self.timing['ack_wait_sec'])
+        self._start_ramp(0.0)
+        self._last_field = 0.0
         print("Emulated Magnet stopped. Current field queried.")
+        return field
 
-    def disconnect(self):
-        print("Emulated Magnet Controller disconnected.")
-        self.inst = None
-    
     def query_field(self):
+        """Field reading in mT, with the 0.1 mT resolution of the controller."""
+        self._require_connection()
+        with tracer.span('magnet', 'handshake', 'QUERY'):
+            _sleep(4 * self.timing['serial_step_sec'] + self.timing['ack_wait_sec'])
+        field = self.field_now() + self.rng.normal(scale=self.physics['noise_mT'])
+        return round(field, 1)
+
+    def wait_for_settle(self, tolerance_mT=0.5, window=3, interval_sec=0.2, max_wait_sec=10.0):
+        """Same polling as the real controller; returns (field, emulated seconds waited)."""
+        t0 = _now()
+        max_polls = max(window, int(np.ceil(round(max_wait_sec / interval_sec, 6))))
+        readings = []
+        for poll in range(1, max_polls + 1):
+            readings = (readings + [self.query_field()])[-window:]
+            if len(readings) == window and max(readings) - min(readings) <= tolerance_mT:
+                break
+            if poll == max_polls:
+                print(f"  Field not settled after {max_polls} readings, last readings: {readings}")
+                break
+            _sleep(interval_sec)
+        return readings[-1], _now() - t0
+
+    def preflight(self, setpoints, unit='mT'):
+        setpoints = np.asarray(setpoints, dtype=float)
+        limit = self.physics['max_current_A'] if unit == 'A' else \
+            min(abs(self.target(self.physics['max_current_A'], 'down')),
+                abs(self.target(-self.physics['max_current_A'], 'up')))
+        if np.any(~(np.abs(setpoints) <= limit)):
+            raise ValueError(f"Setpoints out of range for Magnet Controller (+/-{limit:.1f} {unit}).")
+        return np.zeros((setpoints.size, 4), dtype=np.uint8)
+
+    # --- physics ----------------------------------------------------------------
+    def target(self, current, branch):
+        """Static field (mT) at a current on a hysteresis branch."""
+        p = self.physics
+        shift = p['coercive_A'] if branch == 'up' else -p['coercive_A']
+        return p['saturation_mT'] * np.tanh((current - shift) / p['width_A'])
+
+    def current_for(self, field, branch):
+        """Inverse of target(), clipped to the supply range."""
+        p = self.physics
+        shift = p['coercive_A'] if branch == 'up' else -p['coercive_A']
+        ratio = np.clip(field / p['saturation_mT'], -0.999999, 0.999999)
+        current = shift + p['width_A'] * np.arctanh(ratio)
+        return float(np.clip(current, -p['max_current_A'], p['max_current_A']))
+
+    def _ramp_time(self):
+        return abs(self.current - self._ramp_from) / self.timing['ramp_A_per_sec']
+
+    def _state(self, t):
+        """(current, field) at emulated time t."""
+        tau = self.timing['settle_tau_sec']
+        ramp_time = self._ramp_time()
+        dt = t - self._t0
+        if ramp_time > 0 and dt < ramp_time:
+            current = self._ramp_from + (self.current - self._ramp_from) * dt / ramp_time
+            # first-order lag behind a ramp of the static field
+            rate = (self.target(self.current, self._branch) - self.target(self._ramp_from, self._branch)) / ramp_time
+            lag = self._lag0 * np.exp(-dt / tau) - rate * tau * (1 - np.exp(-dt / tau))
+        else:
+            current = self.current
+            rate = 0.0 if ramp_time == 0 else \
+                (self.target(self.current, self._branch) - self.target(self._ramp_from, self._branch)) / ramp_time
+            lag_end = self._lag0 * np.exp(-ramp_time / tau) - rate * tau * (1 - np.exp(-ramp_time / tau))
+            lag = lag_end * np.exp(-(dt - ramp_time) / tau)
+        return current, float(self.target(current, self._branch) + lag)
+
+    def field_now(self):
+        return self._state(_now())[1]
+
+    def _start_ramp(self, current):
+        t = _now()
+        present_current, present_field = self._state(t)
+        if current > present_current:
+            self._branch = 'up'
+        elif current < present_current:
+            self._branch = 'down'
+        self._ramp_from = present_current
+        self.current = current
+        self._t0 = t
+        # keep the field continuous across the branch switch
+        self._lag0 = present_field - self.target(present_current, self._branch)
+
+    def _require_connection(self):
         if self.inst is None:
             raise RuntimeError("Magnet Controller not connected.")
-        return np.random.uniform(-400.0, 400.0)  # Return a dummy field value
 
 if __name__ == "__main__":
     magnet = MagnetController()
     magnet.connect()
-    magnet.set_current(1.0)
+    vna = VNAController()
+    vna.connect()
+    for field in (50.0, 150.0, 100.0):
+        magnet.set_field(field)
+        settled, elapsed = magnet.wait_for_settle()
+        print(f"{field} mT: settled at {settled} mT after {elapsed:.2f} s, "
+              f"resonance {vna.resonance_GHz(settled):.3f} GHz")
+        t = time.monotonic()
+        freq, traces = vna.read_all_sparams()
+        print(f"  sweep + transfer {time.monotonic() - t:.3f} s, "
+              f"|S21| peak at {freq[np.argmax(np.abs(traces['s21']))] * 1e-9:.3f} GHz")
+    magnet.stop_and_query_field()
+    magnet.disconnect()
+    vna.close()
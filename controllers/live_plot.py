@@ -0,0 +1,195 @@
+"""
+Live view of a running sweep. LivePlot.push is a SweepEngine on_point
+callback: it only queues the point, and a feeder thread pipes it to a viewer
+process (this file run as a script) that draws the four S-parameter maps.
+The viewer bins each new trace to the screen height once, appends it as a
+column and redraws at most LIVE_FPS times a second, so neither the plotting
+nor a closed window ever holds up the acquisition.
+
+The window stays open after the sweep until it is closed; plotter.py makes
+the saved plot from the data on disk as before.
+"""
+import os, sys
+import pickle
+import queue
+import subprocess
+import threading
+import time
+import numpy as np
+from dataset import SPARAMS, FIELD_UNIT
+
+LIVE_FPS = 5.0  # redraws per second at most
+
+class LivePlot:
+    """
+    Starts the viewer; push() points to it, close() once the sweep is done.
+    unit is that of the sweep: the map is drawn over the measured field (mT),
+    and only mT sweeps can stand in the setpoint for a missing field reading.
+    """
+    def __init__(self, unit='mT', title='', fps=LIVE_FPS):
+        self.unit = unit
+        # the viewer outlives the sweep, so it must not hold on to our stdout
+        # (app.py waits for the job's pipes to close) nor share our process group,
+        # or the GUI's Cancel would close the window with the sweep
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(fps), title],
+                                        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL,
+                                        creationflags=subprocess.CREATE_NEW_PROCESS_GROUP if os.name == 'nt' else 0,
+                                        start_new_session=os.name != 'nt')
+        self._queue = queue.Queue()
+        self._closed = threading.Event()  # the viewer is gone, drop further points
+        self._feeder = threading.Thread(target=self._feed, name='live_plot', daemon=True)
+        self._feeder.start()
+
+    def push(self, setpoint, field, freq, traces):
+        """on_point callback; never blocks."""
+        if field is None and self.unit == FIELD_UNIT:
+            field = setpoint
+        if self._closed.is_set() or field is None:
+            return
+        traces = {key: np.asarray(traces[key], dtype=np.complex64) for key in SPARAMS if key in traces}
+        self._queue.put((setpoint, field, freq, traces))
+
+    def _feed(self):
+        while (item := self._queue.get()) is not None:
+            try:
+                pickle.dump(item, self.process.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+                self.process.stdin.flush()
+            except (BrokenPipeError, OSError):
+                # window closed, let go of the points that were still waiting
+                self._closed.set()
+                while not self._queue.empty():
+                    self._queue.get_nowait()
+                return
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def close(self, timeout=5.0):
+        """Sends the points still queued and tells the viewer the sweep is over."""
+        self._queue.put(None)
+        self._feeder.join(timeout)
+        self._closed.set()
+
+# --- viewer process ---
+class Waterfall:
+    """The four maps of the points received so far, one column per point."""
+    def __init__(self, title='', fps=LIVE_FPS):
+        import matplotlib.pyplot as plt
+        from matplotlib.image import NonUniformImage
+        self.plt = plt
+        self.title = title
+        self.interval = 1.0 / fps
+        self.fig, axs = plt.subplots(2, 2, figsize=(6, 6), sharey=True)
+        self.axes = dict(zip(SPARAMS, axs.ravel()))
+        self.images = {}
+        for idx, (key, ax) in enumerate(self.axes.items()):
+            ax.set_title(key.upper())
+            ax.set_xlabel(f"Field ({FIELD_UNIT})")
+            if idx % 2 == 0:
+                ax.set_ylabel("Frequency (GHz)")
+            self.images[key] = NonUniformImage(ax, interpolation='nearest')
+        self.fig.suptitle(f"{title} waiting for the first point...".strip())
+        plt.tight_layout()
+        self.n = 0
+        self.fields = np.empty(0)
+        self.columns = {}
+        self.limits = {}
+        self.freq_GHz = None
+        self.shape = None
+        self.changed = False
+
+    def _start(self, freq):
+        from plotter import SAVE_DPI
+        self.freq_GHz = freq * 1e-9
+        ax = self.axes['s11']
+        height = ax.get_position().height * self.fig.get_size_inches()[1] * max(self.fig.dpi, SAVE_DPI)
+        self.shape = (1, max(1, int(height)))
+        edges = np.arange(0, freq.size, -(-freq.size // self.shape[1]))
+        self.y = np.add.reduceat(self.freq_GHz, edges) / np.diff(np.append(edges, freq.size))
+        for key, ax in self.axes.items():
+            ax.set_ylim(self.freq_GHz[0], self.freq_GHz[-1])
+
+    def add(self, setpoint, field, freq, traces):
+        """Bins the new traces along frequency and appends them as a column."""
+        from plotter import decimate
+        if self.freq_GHz is None:
+            self._start(freq)
+        if self.n == len(self.fields):
+            # grow by doubling, earlier columns are kept as they are
+            capacity = max(64, 2 * self.n)
+            self.fields = np.resize(self.fields, capacity)
+            for key in traces:
+                grown = np.empty((capacity, len(self.y)), dtype=np.float32)
+                if key in self.columns:
+                    grown[:self.n] = self.columns[key][:self.n]
+                self.columns[key] = grown
+        self.fields[self.n] = field
+        for key, trace in traces.items():
+            column = decimate(trace[None, :], (0, 1), (0, trace.size), self.shape)[0][0]
+            self.columns[key][self.n] = column
+            finite = column[np.isfinite(column)]
+            if finite.size:
+                low, high = self.limits.get(key, (np.inf, -np.inf))
+                self.limits[key] = (min(low, finite.min()), max(high, finite.max()))
+        self.n += 1
+        self.changed = True
+
+    def render(self, status=None):
+        if not self.n:
+            return
+        order = np.argsort(self.fields[:self.n], kind='stable')
+        x = self.fields[:self.n][order]
+        half = (x[-1] - x[0]) / max(self.n - 1, 1) / 2 or 0.5
+        for key, image in self.images.items():
+            if key not in self.columns:
+                continue
+            image.set_data(x, self.y, self.columns[key][:self.n][order].T)
+            image.set_extent((x[0] - half, x[-1] + half, self.y[0], self.y[-1]))
+            if key in self.limits:
+                image.set_clim(*self.limits[key])
+            if image not in self.axes[key].images:
+                self.axes[key].add_image(image)
+            self.axes[key].set_xlim(x[0] - half, x[-1] + half)
+        last = self.fields[self.n - 1]
+        self.fig.suptitle(f"{self.title} {status or f'{self.n} points, last at {last:.2f} {FIELD_UNIT}'}".strip())
+        self.fig.canvas.draw_idle()
+        self.changed = False
+
+    def run(self, stream):
+        """Shows points from the pickled stream until it ends, then keeps the window open."""
+        received = queue.Queue()
+        def read():
+            while True:
+                try:
+                    received.put(pickle.load(stream))
+                except (EOFError, OSError, pickle.UnpicklingError):
+                    received.put(None)
+                    return
+        threading.Thread(target=read, daemon=True).start()
+        self.plt.show(block=False)
+        last_draw = 0.0
+        while self.plt.fignum_exists(self.fig.number):
+            done = False
+            while True:
+                try:
+                    item = received.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                self.add(*item)
+            if done:
+                self.render(f"sweep finished, {self.n} points")
+                self.plt.show()
+                return
+            if self.changed and time.monotonic() - last_draw >= self.interval:
+                self.render()
+                last_draw = time.monotonic()
+            self.plt.pause(self.interval / 2)
+
+if __name__ == "__main__":
+    fps, title = float(sys.argv[1]), sys.argv[2]
+    Waterfall(title, fps).run(sys.stdin.buffer)
@@ -0,0 +1,54 @@
+"""Sweep planning: which setpoints to visit, and in which order."""
+import numpy as np
+
+def response_change(setpoints, s21, metric='magnitude', freq=None):
+    """
+    Scores each interval between neighbouring setpoints (sorted) by how much
+    the S21 response changes across it:
+      'magnitude': RMS difference of |S21| over the frequency axis
+      'resonance': shift of the |S21| dip, in Hz if `freq` is given, else in points
+    Returns (sorted setpoints, score per interval).
+    """
+    order = np.argsort(setpoints, kind='stable')
+    setpoints = np.asarray(setpoints, dtype=float)[order]
+    magnitude = np.abs(np.asarray(s21)[order])
+    if metric == 'magnitude':
+        score = np.sqrt(np.mean(np.diff(magnitude, axis=0)**2, axis=1))
+    elif metric == 'resonance':
+        dip = np.argmin(magnitude, axis=1)
+        dip = freq[dip] if freq is not None else dip.astype(float)
+        score = np.abs(np.diff(dip))
+    else:
+        raise ValueError(f"Unknown metric {metric!r}, expected 'magnitude' or 'resonance'.")
+    return setpoints, score
+
+def refine_setpoints(setpoints, s21, budget, min_step, metric='magnitude', freq=None):
+    """
+    Picks up to `budget` new setpoints at the midpoints of the intervals where the
+    response changes fastest. Intervals narrower than 2*min_step are not split.
+    Returns the new setpoints, sorted.
+    """
+    setpoints, score = response_change(setpoints, s21, metric, freq)
+    gaps = np.diff(setpoints)
+    score = np.where(gaps >= 2 * min_step, score, -np.inf)
+    best = np.argsort(score)[::-1][:max(budget, 0)]
+    best = best[np.isfinite(score[best]) & (score[best] > 0)]
+    return np.sort((setpoints[best] + setpoints[best + 1]) / 2)
+
+def order_setpoints(setpoints, start=0.0, repeats=1, serpentine=True):
+    """
+    Orders setpoints into monotonic passes so each pass stays on one hysteresis
+    branch. The first pass starts at the end nearest to `start`; with `serpentine`
+    every further pass reverses direction instead of jumping back, which keeps
+    total travel and the number of reversals to one per pass.
+    """
+    ascending = np.unique(np.asarray(setpoints, dtype=float))
+    if ascending.size == 0:
+        return ascending
+    forward = abs(start - ascending[0]) <= abs(start - ascending[-1])
+    passes = []
+    for _ in range(repeats):
+        passes.append(ascending if forward else ascending[::-1])
+        if serpentine:
+            forward = not forward
+    return np.concatenate(passes)
@@ -1,80 +1,260 @@
+"""
+Field x frequency maps of a sweep. The matrices are never drawn point by
+point: each axes shows its current view binned down to its size in pixels
+(the mean, min or max of every bin, or 'minmax', whichever extreme is farther
+from the bin mean so narrow resonances survive), as an image: imshow when
+the fields are evenly spaced, a NonUniformImage otherwise. Zooming in re-bins
+the new view from the full data.
+
+    python controllers/plotter.py              plot and show the window
+    python controllers/plotter.py --headless   only save the PNG (or PLOT_HEADLESS=1)
+    python controllers/plotter.py data/<run>   plot that run instead of the one in params.ini
+"""
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.image import NonUniformImage
 import os, sys
 import configparser
 from dotenv import load_dotenv
+from dataset import load_matrices, load_ordered
+from postprocess import PRODUCTS, process
 
 load_dotenv()
 
-dir = "data"
-
 CONFIG_FILE = 'params.ini'
+# 'real' plots the raw data, the others the cached products of postprocess.py
+PLOT_PRODUCTS = ('real',) + PRODUCTS
+BINNINGS = ('minmax', 'mean', 'min', 'max')
+SAVE_DPI = 150
+CHUNK_VALUES = 4_000_000  # samples read from the data per step while binning
+UNIFORM_TOLERANCE = 0.25  # max deviation from an even grid, in grid steps, drawn with imshow
+REFRESH_MS = 150          # delay before a zoomed view is re-binned
+
+def config_dir():
+    """Data directory of the sweep currently described in params.ini, and its unit."""
+    if not os.path.exists(CONFIG_FILE):
+        raise FileNotFoundError("params.ini not found!")
+
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+
+    try:
+        # Load Experiment tab values
+        UNIT = config.get('Experiment', 'unit', fallback='A')
+        CURRENT_LOW = float(config.get('Experiment', 'low', fallback='0'))
+        CURRENT_HIGH = float(config.get('Experiment', 'high', fallback='1'))
+        STEP = float(config.get('Experiment', 'step', fallback='0.1'))
+
+        print("Config loaded successfully.")
+    except Exception as e:
+        raise ValueError("Error reading config file.")
+
+    # if len(sys.argv)>1:
+        # subdir = sys.argv[1]
+    # else:
+    subdir = f"s_params_{CURRENT_LOW}{UNIT}_to_{CURRENT_HIGH}{UNIT}_step_{STEP}{UNIT}"
+
+    dirname = os.path.join("data", subdir)
+
+    assert os.path.isdir(dirname), "Data does not exist, recheck values entered in inputs."
+    return dirname, UNIT
+
+def matrixize(dirname):
+    """
+    Returns (fields, freq, {'s11': (n_fields, n_freq) array, ...}, unit), sorted by
+    field; unit is that of the fields, mT for every sweep saved by SweepWriter.
+    """
+    return load_matrices(dirname)
+
+def config_plot():
+    """The [Plot] product and binning of params.ini, 'real' and 'minmax' if they are not set."""
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    product = config.get('Plot', 'product', fallback='real')
+    if product not in PLOT_PRODUCTS:
+        raise ValueError(f"Unknown plot product '{product}', expected one of {PLOT_PRODUCTS}.")
+    binning = config.get('Plot', 'binning', fallback='minmax')
+    if binning not in BINNINGS:
+        raise ValueError(f"Unknown plot binning '{binning}', expected one of {BINNINGS}.")
+    return product, binning
+
+# --- binning ---
+def _reduce(block, row_step, col_step, binning):
+    """Bins a (k*row_step, n) block into (k, ceil(n/col_step)), ignoring NaNs."""
+    rows, cols = block.shape
+    n_rows, n_cols = -(-rows // row_step), -(-cols // col_step)
+    padded = np.full((n_rows * row_step, n_cols * col_step), np.nan, dtype=np.float32)
+    padded[:rows, :cols] = block
+    bins = padded.reshape(n_rows, row_step, n_cols, col_step)
+    if binning == 'max':
+        return np.fmax.reduce(bins, axis=(1, 3))
+    if binning == 'min':
+        return np.fmin.reduce(bins, axis=(1, 3))
+    valid = ~np.isnan(bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(bins, axis=(1, 3)) / valid.sum(axis=(1, 3))
+    if binning == 'mean':
+        return mean
+    high, low = np.fmax.reduce(bins, axis=(1, 3)), np.fmin.reduce(bins, axis=(1, 3))
+    return np.where(high - mean >= mean - low, high, low)
+
+def decimate(matrix, rows, cols, shape, binning='minmax', transform=np.real, order=None):
+    """
+    Bins matrix[rows[0]:rows[1], cols[0]:cols[1]] (row indices into `order`
+    when it is given) down to at most shape = (n_rows, n_cols) values, reading
+    the matrix in chunks. transform maps the raw values (e.g. complex) to the
+    plotted ones. Returns (image, row_step, col_step).
+    """
+    (r0, r1), (c0, c1) = rows, cols
+    row_step = max(1, -(-(r1 - r0) // shape[0]))
+    col_step = max(1, -(-(c1 - c0) // shape[1]))
+    image = np.empty((-(-(r1 - r0) // row_step), -(-(c1 - c0) // col_step)), dtype=np.float32)
+    chunk = max(1, CHUNK_VALUES // (row_step * (c1 - c0)))  # bins per chunk
+    for i in range(0, len(image), chunk):
+        a, b = r0 + i * row_step, min(r0 + (i + chunk) * row_step, r1)
+        index = slice(a, b) if order is None else order[a:b]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block = transform(np.asarray(matrix[index, c0:c1]))
+        image[i:i + chunk] = _reduce(block, row_step, col_step, binning)
+    return image, row_step, col_step
+
+def _bin_centres(values, start, stop, step):
+    """Mean of `values` over the bins [start, start+step), ... of [start, stop)."""
+    edges = np.arange(start, stop, step)
+    return np.add.reduceat(values[start:stop], edges - start) / np.diff(np.append(edges, stop))
+
+def _uniform(values):
+    """True if values lie on an evenly spaced grid, within UNIFORM_TOLERANCE steps."""
+    if len(values) < 3:
+        return True
+    grid = np.linspace(values[0], values[-1], len(values))
+    step = abs(grid[1] - grid[0])
+    return step > 0 and np.max(np.abs(values - grid)) <= UNIFORM_TOLERANCE * step
+
+class LevelOfDetail:
+    """
+    The image of one field x frequency map on an axes, binned to the axes'
+    size in pixels and re-binned whenever the view limits change.
+    """
+    def __init__(self, ax, fields, freq, matrix, transform=np.real, binning='minmax', order=None):
+        self.ax = ax
+        self.fields = fields
+        self.freq_GHz = freq * 1e-9
+        self.matrix = matrix
+        self.transform = transform
+        self.binning = binning
+        self.order = order
+        self.uniform = _uniform(fields) and _uniform(self.freq_GHz)
+        self.image = None
+        self._view = None
+        self._timer = None
+        self.refresh()
+        ax.set_xlim(*self._limits(fields))
+        ax.set_ylim(*self._limits(self.freq_GHz))
+        ax.callbacks.connect('xlim_changed', self._schedule)
+        ax.callbacks.connect('ylim_changed', self._schedule)
+
+    @staticmethod
+    def _limits(values):
+        half = (values[-1] - values[0]) / max(len(values) - 1, 1) / 2 or 0.5
+        return values[0] - half, values[-1] + half
+
+    def _pixels(self):
+        """Size of the axes in pixels at the larger of the screen and save resolution."""
+        fig = self.ax.figure
+        box = self.ax.get_position()
+        width, height = fig.get_size_inches()
+        dpi = max(fig.dpi, SAVE_DPI)
+        return max(1, int(box.width * width * dpi)), max(1, int(box.height * height * dpi))
+
+    def _visible(self):
+        """Index ranges of the fields and frequencies inside the current limits."""
+        if self.image is None:
+            return (0, len(self.fields)), (0, len(self.freq_GHz))
+        ranges = []
+        for values, (low, high) in ((self.fields, sorted(self.ax.get_xlim())),
+                                    (self.freq_GHz, sorted(self.ax.get_ylim()))):
+            a = max(int(np.searchsorted(values, low, 'left')) - 1, 0)
+            b = min(int(np.searchsorted(values, high, 'right')) + 1, len(values))
+            ranges.append((a, max(b, a + 1)))
+        return tuple(ranges)
+
+    def refresh(self):
+        rows, cols = self._visible()
+        n_x, n_y = self._pixels()
+        view = (rows, cols, n_x, n_y)
+        if view == self._view:
+            return
+        self._view = view
+        image, row_step, col_step = decimate(self.matrix, rows, cols, (n_x, n_y),
+                                             self.binning, self.transform, self.order)
+        x = _bin_centres(self.fields, *rows, row_step)
+        y = _bin_centres(self.freq_GHz, *cols, col_step)
+        if self.image is None:
+            if self.uniform:
+                self.image = self.ax.imshow(image.T, origin='lower', aspect='auto',
+                                            interpolation='nearest')
+            else:
+                self.image = NonUniformImage(self.ax, interpolation='nearest')
+                self.ax.add_image(self.image)
+            # keep the colour scale of the full map while zoomed in
+            finite = image[np.isfinite(image)]
+            if finite.size:
+                self.image.set_clim(finite.min(), finite.max())
+        if self.uniform:
+            self.image.set_data(image.T)
+        else:
+            self.image.set_data(x, y, image.T)
+        self.image.set_extent((*self._limits(x), *self._limits(y)))
+
+    def _schedule(self, ax):
+        """Re-bins once the limits stop changing, so a zoom (x and y) re-bins once."""
+        canvas = self.ax.figure.canvas
+        if self._timer is None:
+            self._timer = canvas.new_timer(interval=REFRESH_MS)
+            self._timer.single_shot = True
+            self._timer.add_callback(self._refresh_and_draw)
+        self._timer.stop()
+        self._timer.start()
+
+    def _refresh_and_draw(self):
+        self.refresh()
+        self.ax.figure.canvas.draw_idle()
 
-if not os.path.exists(CONFIG_FILE):
-    raise FileNotFoundError("params.ini not found!")
-    
-config = configparser.ConfigParser()
-config.read(CONFIG_FILE)
-    
-try:
-    # Load Experiment tab values
-    UNIT = config.get('Experiment', 'unit', fallback='A')
-    CURRENT_LOW = float(config.get('Experiment', 'low', fallback='0'))
-    CURRENT_HIGH = float(config.get('Experiment', 'high', fallback='1'))
-    STEP = float(config.get('Experiment', 'step', fallback='0.1'))
-   
-    print("Config loaded successfully.")
-except Exception as e:
-    raise ValueError("Error reading config file.")
-
-# if len(sys.argv)>1:
-    # subdir = sys.argv[1]
-# else:
-subdir = f"s_params_{CURRENT_LOW}{UNIT}_to_{CURRENT_HIGH}{UNIT}_step_{STEP}{UNIT}"
-
-dir = os.path.join("data",subdir)
-
-assert os.path.isdir(dir), "Data does not exist, recheck values entered in inputs."
-
-def import_data(dirname=dir):
-    for root, dirs, files in os.walk(dirname):
-        # print(roots)
-        if dirs != []:
-            keys = dirs
-            freq = np.load(os.path.join(root, 'frequency.npy'))
-            s_param_dict = {key: [] for key in keys}
-            continue
-        if root[-3:] in keys:
-            for file in files:
-                s_param_dict[root[-3:]].append(np.load(os.path.join(root, file)))
-
-    return freq, s_param_dict
-
-def matrixize(dirname=dir):
-    freq, s_param_dict = import_data(dirname)
-    for key in s_param_dict.keys():
-        s_param_array = np.zeros_like(s_param_dict[key])
-        for idx, array in enumerate(s_param_dict[key]):
-            s_param_array[idx,:] = array
-        s_param_dict[key] = s_param_array
-    return freq, s_param_dict
-
-def plotter(dirname=dir):
-    freq, s_params = matrixize(dirname)
-    currs = np.arange(CURRENT_LOW, CURRENT_HIGH + STEP, STEP)
+def plotter(dirname, product='real', binning='minmax', show=True):
+    """Plots the four maps of a run and saves them as a PNG; show=False only saves it."""
+    if product == 'real':
+        fields, freq, s_params, order, unit = load_ordered(dirname)
+        sources = {key: (matrix, np.real, order) for key, matrix in s_params.items()}
+    else:
+        post = process(dirname)
+        fields, freq, unit = post['fields'], post['freq'], post['unit']
+        # dS/dH is complex, plot its magnitude
+        transform = np.abs if product == 'dh' else np.asarray
+        sources = {key: (post[key][product], transform, None) for key in post if key.startswith('s')}
     fig, axs = plt.subplots(2,2, figsize=(6,6), sharex=False, sharey=True)
-    dirs = s_params.keys()
     axs = axs.ravel()
-    for idx, dir in enumerate(dirs):
-        axs[idx].pcolormesh(currs, freq*1e-9, s_params[dir].real.T)
-        axs[idx].set_xlabel(f"Current ({UNIT})")
+    # referenced by the figure, so zooming keeps re-binning while it is open
+    fig.levels_of_detail = []
+    for idx, (key, (matrix, transform, rows)) in enumerate(sources.items()):
+        fig.levels_of_detail.append(LevelOfDetail(axs[idx], fields, freq, matrix, transform, binning, rows))
+        axs[idx].set_xlabel(f"Field ({unit})")
         if idx % 2 == 0:
             axs[idx].set_ylabel("Frequency (GHz)")
-        axs[idx].set_title(dir.upper())
+        axs[idx].set_title(key.upper() if product == 'real' else f"{key.upper()} {product}")
     plt.tight_layout()
-    plt.savefig(os.path.join(dirname, "s_params_plot.png"), dpi=150)
-    plt.show()
+    name = "s_params_plot.png" if product == 'real' else f"s_params_{product}_plot.png"
+    plt.savefig(os.path.join(dirname, name), dpi=SAVE_DPI)
+    if show:
+        plt.show()
+    plt.close(fig)
 
 if __name__ == "__main__":
-    print(matrixize()[1]['s21'].shape)
-    plotter()
+    headless = '--headless' in sys.argv[1:] or os.getenv("PLOT_HEADLESS", "0") not in ("", "0")
+    if headless:
+        plt.switch_backend('Agg')
+    runs = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    dirname = runs[0] if runs else config_dir()[0]
+    product, binning = config_plot()
+    plotter(dirname, product, binning, show=not headless)
+    print(f"Plot saved to {dirname}.")
@@ -0,0 +1,139 @@
+"""
+Derived products of a field sweep, computed from the (n_fields, n_freq)
+complex S-parameter matrices in field-sorted row chunks and cached in
+<run>/post/ so plots and later analysis don't recompute them:
+
+  db       20 log10 |S|
+  phase    phase (rad), unwrapped along frequency
+  norm_db  |S / S(reference field)| in dB, i.e. background-subtracted
+  dh       dS/dH, central differences over the neighbouring distinct fields
+           (per mT; per A only for old runs saved per current setpoint)
+
+Real products are stored as float32 and dh as complex64.
+"""
+import os, json
+import numpy as np
+from dataset import SPARAMS, DATA_FILE, FIELDS_FILE, is_sweep, load_ordered
+
+POST_DIR = 'post'
+POST_META = 'post.json'
+POST_VERSION = 1
+PRODUCTS = ('db', 'phase', 'norm_db', 'dh')
+CHUNK_ROWS = 256  # fields per chunk; one chunk of every product is in memory at a time
+
+def _source(pathname):
+    """Field-sorted fields, freq, {sparam: row-indexable matrix}, row order, field unit and a signature of the data."""
+    fields, freq, s_params, order, unit = load_ordered(pathname)
+    if is_sweep(pathname):
+        signature = [len(order), os.stat(os.path.join(pathname, DATA_FILE)).st_mtime_ns,
+                     os.stat(os.path.join(pathname, FIELDS_FILE)).st_mtime_ns]
+    else:
+        signature = [len(fields)] + [os.stat(os.path.join(pathname, s)).st_mtime_ns for s in sorted(s_params)]
+    return fields, freq, s_params, order, unit, signature
+
+def _neighbours(fields):
+    """Rows of the nearest lower and higher distinct field, or the row itself at the ends."""
+    rows = np.arange(len(fields))
+    lower = np.searchsorted(fields, fields, 'left') - 1
+    higher = np.searchsorted(fields, fields, 'right')
+    lower = np.where(lower < 0, rows, lower)
+    higher = np.where(higher >= len(fields), rows, higher)
+    return lower, higher
+
+def _chunk_products(window, start, a, b, fields, lower, higher, reference_db):
+    """
+    All products for the field-sorted rows [a, b). `window` holds the rows
+    [start, ...), which covers their dh neighbours.
+    """
+    s = window[a - start:b - start]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        db = 20 * np.log10(np.abs(s))
+        phase = np.unwrap(np.angle(s), axis=1)
+        hi, lo = higher[a:b], lower[a:b]
+        dh = (window[hi - start] - window[lo - start]) / (fields[hi] - fields[lo])[:, None]
+    return {'db': db, 'phase': phase, 'norm_db': db - reference_db, 'dh': dh}
+
+def _compute(pathname, sparams, reference_field, chunk_rows, signature_source):
+    fields, freq, s_params, order, _, signature = signature_source
+    n = len(fields)
+    if reference_field is None:
+        reference_row = int(np.argmax(np.abs(fields)))
+    else:
+        reference_row = int(np.argmin(np.abs(fields - reference_field)))
+    lower, higher = _neighbours(fields)
+    post_dir = os.path.join(pathname, POST_DIR)
+    os.makedirs(post_dir, exist_ok=True)
+    np.save(os.path.join(post_dir, FIELDS_FILE), fields)
+    for key in sparams:
+        matrix = s_params[key]
+        with np.errstate(divide='ignore'):
+            reference_db = 20 * np.log10(np.abs(matrix[order[reference_row]]))
+        outputs = {product: np.lib.format.open_memmap(
+                       os.path.join(post_dir, f"{key}_{product}.npy"), mode='w+',
+                       dtype=np.complex64 if product == 'dh' else np.float32, shape=(n, freq.size))
+                   for product in PRODUCTS}
+        for a in range(0, n, chunk_rows):
+            b = min(a + chunk_rows, n)
+            # read the chunk plus the neighbour rows dh needs, in field order
+            start, stop = int(lower[a:b].min()), int(higher[a:b].max()) + 1
+            window = matrix[order[start:stop]]
+            for product, values in _chunk_products(window, start, a, b, fields, lower, higher,
+                                                   reference_db).items():
+                outputs[product][a:b] = values
+        for output in outputs.values():
+            output.flush()
+        del outputs
+    meta = {'version': POST_VERSION, 'source': signature, 'sparams': list(sparams),
+            'reference_field': float(fields[reference_row]), 'requested_reference': reference_field,
+            'products': list(PRODUCTS)}
+    with open(os.path.join(post_dir, POST_META), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+def _cached(pathname, sparams, reference_field, signature):
+    try:
+        with open(os.path.join(pathname, POST_DIR, POST_META)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (meta.get('version') != POST_VERSION or meta.get('source') != signature
+            or meta.get('requested_reference') != reference_field
+            or not set(sparams) <= set(meta.get('sparams', []))):
+        return None
+    return meta
+
+def process(pathname, sparams=None, reference_field=None, chunk_rows=CHUNK_ROWS, force=False):
+    """
+    Computes (or loads from the cache) the products of a run directory.
+    sparams: e.g. ('s21',), default every S-parameter the run has
+    reference_field: field (in the fields' unit) of the background trace for
+                     norm_db, default the field farthest from zero
+    Returns {'fields': ..., 'unit': ..., 'freq': ..., 'reference_field': ..., 's21': {'db': ..., ...}},
+    unit being that of the fields; the product arrays are memory-mapped from <run>/post/.
+    """
+    source = _source(pathname)
+    fields, freq, s_params, _, unit, signature = source
+    sparams = tuple(s for s in SPARAMS if s in s_params) if sparams is None else tuple(sparams)
+    unknown = set(sparams) - set(SPARAMS)
+    if unknown:
+        raise ValueError(f"Unknown S-parameters {sorted(unknown)}, expected some of {SPARAMS}.")
+    missing = set(sparams) - set(s_params)
+    if missing:
+        raise ValueError(f"{pathname} has no {sorted(missing)} data.")
+    meta = None if force else _cached(pathname, sparams, reference_field, signature)
+    if meta is None:
+        print(f"Post-processing {', '.join(sparams)} of {pathname}...")
+        meta = _compute(pathname, sparams, reference_field, chunk_rows, source)
+    post_dir = os.path.join(pathname, POST_DIR)
+    result = {'fields': fields, 'unit': unit, 'freq': freq, 'reference_field': meta['reference_field']}
+    for key in sparams:
+        result[key] = {product: np.load(os.path.join(post_dir, f"{key}_{product}.npy"), mmap_mode='r')
+                       for product in PRODUCTS}
+    return result
+
+if __name__ == "__main__":
+    from plotter import config_dir
+    dirname, _ = config_dir()
+    post = process(dirname, force=True)
+    print(f"Products of {len(post['fields'])} fields saved to {os.path.join(dirname, POST_DIR)}, "
+          f"background at {post['reference_field']} {post['unit']}.")
@@ -0,0 +1,274 @@
+"""
+Resonance tracking across a field sweep. For every field the resonance is
+located in |S21 - background|^2 by a vectorized peak search and
+refined by a Lorentzian fit that runs as one batched Levenberg-Marquardt
+problem over all fields. Fits that fail or jump away from their neighbours
+are redone seeded with the previous field's solution. Large sweeps are
+split over worker processes.
+
+f_res(H) is then fitted with the Kittel law f = gamma sqrt(H (H + mu0 Ms)),
+and the frequency linewidth converted to a field linewidth
+dH = df / (df_res/dH).
+"""
+import os, json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+FIT_ITERATIONS = 50
+SMOOTH_POINTS = 5               # moving average for the peak search
+WINDOW_HALF_WIDTHS = 8          # fit window, in estimated half widths either side
+SNR_MIN = 10                    # fitted peak height over the noise for a resonance to count
+MIN_HALF_WIDTH = 1.0            # narrower fits (in frequency points) are single-point noise spikes
+PARALLEL_MIN_VALUES = 4_000_000 # n_fields * n_freq above which worker processes are used
+TRACK_FILE = 'resonance.csv'
+KITTEL_FILE = 'resonance.json'
+
+# --- batched Lorentzian fit ------------------------------------------------------
+def _lorentzian(x, p):
+    """p[:, 0..3] = height, centre, half width, offset; x is (n, w)."""
+    u = (x - p[:, 1:2]) / p[:, 2:3]
+    return p[:, 0:1] / (1 + u**2) + p[:, 3:4]
+
+def _jacobian(x, p):
+    u = (x - p[:, 1:2]) / p[:, 2:3]
+    d = 1 + u**2
+    height, width = p[:, 0:1], p[:, 2:3]
+    return np.stack([1 / d,
+                     height * 2 * u / (width * d**2),
+                     height * 2 * u**2 / (width * d**2),
+                     np.ones_like(x)], axis=-1)
+
+def fit_lorentzians(x, y, p0, iterations=FIT_ITERATIONS):
+    """
+    Fits y ~ height / (1 + ((x - centre) / width)^2) + offset to every row at once.
+    x, y: (n, w) windows; p0: (n, 4) start values. Returns (params, rms residual).
+    Rows drop out of the iteration once their damping shows they have converged.
+    """
+    p = p0.astype(float).copy()
+    lam = np.full(len(p), 1e-3)
+    cost = np.sum((y - _lorentzian(x, p))**2, axis=1)
+    eye = np.eye(4)
+    for _ in range(iterations):
+        active = np.flatnonzero(lam < 1e8)
+        if active.size == 0:
+            break
+        xa, ya, pa = x[active], y[active], p[active]
+        r = ya - _lorentzian(xa, pa)
+        J = _jacobian(xa, pa)
+        JT = J.transpose(0, 2, 1)
+        JTJ = JT @ J
+        JTr = JT @ r[..., None]
+        diag = JTJ[:, np.arange(4), np.arange(4)]
+        A = JTJ + lam[active, None, None] * eye * (diag[:, :, None] + 1e-12)
+        try:
+            step = np.linalg.solve(A, JTr)[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.stack([np.linalg.lstsq(a, b, rcond=None)[0][:, 0] for a, b in zip(A, JTr)])
+        trial = pa + step
+        trial[:, 2] = np.abs(trial[:, 2])
+        with np.errstate(invalid='ignore', over='ignore', divide='ignore'):
+            trial_cost = np.sum((ya - _lorentzian(xa, trial))**2, axis=1)
+        better = np.isfinite(trial_cost) & (trial_cost < cost[active])
+        p[active[better]] = trial[better]
+        cost[active[better]] = trial_cost[better]
+        lam[active] = np.where(better, lam[active] / 3, lam[active] * 3)
+    return p, np.sqrt(cost / x.shape[1])
+
+# --- peak search and windows -------------------------------------------------------
+def _smooth(signal, points=SMOOTH_POINTS):
+    kernel = np.ones(points) / points
+    padded = np.pad(signal, ((0, 0), (points // 2, points - 1 - points // 2)), mode='edge')
+    csum = np.cumsum(padded, axis=1)
+    csum = np.concatenate([np.zeros((len(signal), 1)), csum], axis=1)
+    return (csum[:, points:] - csum[:, :-points]) * kernel[0]
+
+def find_peaks(signal):
+    """Vectorized peak search: (index, height, offset, half width in points) per row."""
+    smooth = _smooth(signal)
+    index = np.argmax(smooth, axis=1)
+    rows = np.arange(len(signal))
+    offset = np.median(smooth, axis=1)
+    height = smooth[rows, index] - offset
+    # points above half maximum around the peak ~ full width
+    above = smooth > (offset + height / 2)[:, None]
+    half_width = np.maximum(above.sum(axis=1) / 2, 1.0)
+    return index, height, offset, half_width
+
+def _windows(n_freq, centre, width):
+    start = np.clip(centre - width // 2, 0, max(n_freq - width, 0))
+    return start[:, None] + np.arange(min(width, n_freq))
+
+def _fit_rows(signal, seeds, width):
+    """
+    Fits every row of `signal` (in frequency-point units) from (n, 4) start
+    values in a window of `width` points around each start centre.
+    Returns (params (n, 4), rms (n,), (n, 2) first and last point of each window).
+    """
+    cols = _windows(signal.shape[1], np.round(seeds[:, 1]).astype(int), width)
+    y = np.take_along_axis(signal, cols, axis=1)
+    params, rms = fit_lorentzians(cols.astype(float), y, seeds)
+    return params, rms, cols[:, [0, -1]]
+
+def _noise(signal):
+    """Robust per-row noise level (scaled median absolute deviation)."""
+    return 1.4826 * np.median(np.abs(signal - np.median(signal, axis=1, keepdims=True)), axis=1)
+
+def _valid(params, rms, noise, edges):
+    """
+    Fits that stand out of the noise, are wider than a point and lie, with
+    their half width, inside the fit window (and so inside the band): a peak
+    cut by the window or band edge is a tail, not a resonance.
+    """
+    height, centre, half_width, _ = params.T
+    with np.errstate(invalid='ignore'):
+        return (np.isfinite(params).all(axis=1) & (height > SNR_MIN * np.maximum(noise, rms))
+                & (half_width >= MIN_HALF_WIDTH)
+                & (centre - half_width >= edges[:, 0]) & (centre + half_width <= edges[:, 1]))
+
+def _track(signal, params, rms, edges, noise, width):
+    """Refits failed or jumping rows, walking in field order from the previous field's solution."""
+    ok = _valid(params, rms, noise, edges)
+    for i in range(1, len(signal)):
+        prev = params[i - 1]
+        jump = abs(params[i, 1] - prev[1]) > 5 * max(prev[2], 1.0)
+        if ok[i - 1] and (not ok[i] or jump):
+            p, r, e = _fit_rows(signal[i:i+1], prev[None, :], width)
+            if _valid(p, r, noise[i:i+1], e)[0] and (not ok[i] or r[0] < rms[i]):
+                params[i], rms[i], ok[i] = p[0], r[0], True
+    return ok
+
+# --- Kittel -----------------------------------------------------------------------
+def fit_kittel(fields_T, f_res_GHz):
+    """
+    Least-squares Kittel fit f^2 = gamma^2 H^2 + gamma^2 mu0Ms H (H in T, f in GHz).
+    Returns (gamma in GHz/T, mu0 Ms in T).
+    """
+    h = np.abs(fields_T)
+    design = np.column_stack([h**2, h])
+    (a, b), *_ = np.linalg.lstsq(design, f_res_GHz**2, rcond=None)
+    if a <= 0:
+        raise ValueError("Kittel fit failed, f_res does not grow with |H|.")
+    return float(np.sqrt(a)), float(b / a)
+
+def kittel(fields_T, gamma, mu0_ms):
+    h = np.abs(fields_T)
+    return gamma * np.sqrt(h * (h + mu0_ms))
+
+def kittel_slope(fields_T, gamma, mu0_ms):
+    """df_res/d|H| (GHz/T)."""
+    h = np.abs(fields_T)
+    with np.errstate(divide='ignore'):
+        return gamma * (2 * h + mu0_ms) / (2 * np.sqrt(h * (h + mu0_ms)))
+
+# --- public API -----------------------------------------------------------------------
+def track_resonance(fields, freq, s21, unit='mT', reference_field=None, workers=None):
+    """
+    Resonance frequency and linewidth at every field of a sweep.
+    fields, freq, s21, unit: as from plotter.matrixize() (fields sorted, s21 (n_fields, n_freq))
+    reference_field: field whose trace is the background, default the median over all fields
+                     at each frequency (the resonance moves, the background does not)
+    workers: worker processes, default one per core for large sweeps, 1 disables them
+    Returns a dict of arrays (fields, f_res in Hz, linewidth = FWHM in Hz, delta_h = FWHM
+    in the field unit, amplitude, ok) plus the Kittel parameters when unit is mT.
+    """
+    fields = np.asarray(fields, dtype=float)
+    freq = np.asarray(freq, dtype=float)
+    s21 = np.asarray(s21)
+    if reference_field is None:
+        reference = None
+        background = np.median(s21.real, axis=0) + 1j * np.median(s21.imag, axis=0)
+    else:
+        reference = int(np.argmin(np.abs(fields - reference_field)))
+        background = s21[reference]
+    signal = np.abs(s21 - background)**2
+    # normalize so the fit works on O(1) numbers
+    scale = np.max(signal) or 1.0
+    signal = signal / scale
+
+    n = len(fields)
+    index, height, offset, half_width = find_peaks(signal)
+    seeds = np.column_stack([height, index, half_width, offset])
+    # one window size for all rows, so the fit is the same however it is split
+    width = int(np.clip(2 * WINDOW_HALF_WIDTHS * np.median(half_width), 16, signal.shape[1]))
+    if workers is None:
+        workers = os.cpu_count() if signal.size >= PARALLEL_MIN_VALUES else 1
+    if workers > 1 and n >= 2 * workers:
+        chunks = np.array_split(np.arange(n), workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_fit_rows, [signal[c] for c in chunks], [seeds[c] for c in chunks],
+                                    [width] * len(chunks)))
+        params = np.concatenate([p for p, _, _ in results])
+        rms = np.concatenate([r for _, r, _ in results])
+        edges = np.concatenate([e for _, _, e in results])
+    else:
+        params, rms, edges = _fit_rows(signal, seeds, width)
+    ok = _track(signal, params, rms, edges, _noise(signal), width)
+    if reference is not None:
+        ok[reference] = False  # the reference trace has no signal left
+
+    df = (freq[-1] - freq[0]) / (len(freq) - 1)
+    f_res = np.where(ok, freq[0] + params[:, 1] * df, np.nan)
+    linewidth = np.where(ok, 2 * params[:, 2] * df, np.nan)
+    result = {'fields': fields, 'f_res': f_res, 'linewidth': linewidth,
+              'amplitude': np.where(ok, params[:, 0] * scale, np.nan), 'ok': ok,
+              'delta_h': np.full(n, np.nan), 'unit': unit}
+    if unit == 'mT' and ok.sum() >= 3:
+        fields_T = fields * 1e-3
+        try:
+            gamma, mu0_ms = fit_kittel(fields_T[ok], f_res[ok] * 1e-9)
+        except ValueError as e:
+            # the per-field results still stand, only delta_h and the fit are left out
+            print(f"Warning: {e}")
+            return result
+        slope = kittel_slope(fields_T, gamma, mu0_ms)  # GHz/T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['delta_h'] = linewidth * 1e-9 / slope * 1e3
+        result['kittel'] = {'gamma_GHz_per_T': gamma, 'mu0_Ms_T': mu0_ms}
+    return result
+
+def save_track(pathname, track):
+    """Writes the per-field results to <run>/resonance.csv and the Kittel fit to resonance.json."""
+    unit = track['unit']
+    columns = np.column_stack([track['fields'], track['f_res'], track['linewidth'],
+                               track['delta_h'], track['amplitude'], track['ok']])
+    np.savetxt(os.path.join(pathname, TRACK_FILE), columns, delimiter=',', comments='',
+               header=f"field_{unit},f_res_Hz,linewidth_Hz,delta_h_{unit},amplitude,ok")
+    with open(os.path.join(pathname, KITTEL_FILE), 'w') as f:
+        json.dump({'unit': unit, 'n_fields': int(len(track['fields'])), 'n_ok': int(track['ok'].sum()),
+                   'kittel': track.get('kittel')}, f, indent=2)
+
+def plot_track(pathname, track):
+    import matplotlib.pyplot as plt
+    unit = track['unit']
+    fig, axs = plt.subplots(2, 1, figsize=(6, 6), sharex=True)
+    axs[0].plot(track['fields'], track['f_res'] * 1e-9, '.', label='fit')
+    if 'kittel' in track:
+        k = track['kittel']
+        h = np.linspace(track['fields'].min(), track['fields'].max(), 400)
+        axs[0].plot(h, kittel(h * 1e-3, k['gamma_GHz_per_T'], k['mu0_Ms_T']), '-',
+                    label=f"Kittel, $\\mu_0M_s$ = {k['mu0_Ms_T'] * 1e3:.0f} mT")
+        axs[0].legend()
+        axs[1].plot(track['fields'], track['delta_h'], '.')
+        axs[1].set_ylabel(f"$\\Delta H$ ({unit})")
+    else:
+        axs[1].plot(track['fields'], track['linewidth'] * 1e-6, '.')
+        axs[1].set_ylabel("Linewidth (MHz)")
+    axs[0].set_ylabel("$f_{res}$ (GHz)")
+    axs[1].set_xlabel(f"Field ({unit})")
+    plt.tight_layout()
+    plt.savefig(os.path.join(pathname, "resonance_plot.png"), dpi=150)
+    plt.show()
+
+if __name__ == "__main__":
+    from plotter import config_dir, matrixize
+    dirname, _ = config_dir()
+    # the field axis is measured mT even for current sweeps, so those get the Kittel fit too
+    fields, freq, s_params, unit = matrixize(dirname)
+    track = track_resonance(fields, freq, s_params['s21'], unit=unit)
+    save_track(dirname, track)
+    print(f"Resonance found at {track['ok'].sum()}/{len(fields)} fields, saved to "
+          f"{os.path.join(dirname, TRACK_FILE)}.")
+    if 'kittel' in track:
+        k = track['kittel']
+        print(f"Kittel fit: gamma = {k['gamma_GHz_per_T']:.2f} GHz/T, mu0 Ms = {k['mu0_Ms_T'] * 1e3:.1f} mT")
+    plot_track(dirname, track)
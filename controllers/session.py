@@ -0,0 +1,207 @@
+"""
+Long-lived instrument session. Run this file to keep the magnet and the VNA
+connected; experiment.py and calibration.py then send their calls here
+instead of re-opening the VISA resources and repeating the handshakes.
+"""
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import os
+import secrets
+import threading
+import signal
+
+SESSION_ADDRESS = ('localhost', 18700)
+# the Listener unpickles what it receives, so only holders of this run's key may connect:
+# a fresh random key per session, readable only by the user who started it
+SESSION_KEY_FILE = os.path.join("data", "session.key")
+
+def new_session_key(path=SESSION_KEY_FILE):
+    """Creates the key of a new session and writes it where clients find it."""
+    key = secrets.token_bytes(32)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)  # so the file is created anew with the mode below
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+def session_key(path=SESSION_KEY_FILE):
+    """The running session's key; raises OSError (FileNotFoundError) without one."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+# the session owns the connections, clients may not open or close them
+SESSION_OWNED = {'connect', 'disconnect', 'close'}
+
+class InstrumentServer:
+    """
+    Serves method calls on connected instruments to local clients.
+    Each client connection gets a thread; calls on one instrument are serialized
+    by a per-instrument lock, so the magnet and the VNA can be driven concurrently.
+    """
+    def __init__(self, instruments, address=SESSION_ADDRESS, authkey=None, key_file=SESSION_KEY_FILE):
+        """authkey: None creates a new key and publishes it in key_file for the clients."""
+        self.instruments = instruments
+        self.locks = {name: threading.Lock() for name in instruments}
+        self.address = address
+        self.key_file = key_file if authkey is None else None
+        self.authkey = new_session_key(key_file) if authkey is None else authkey
+        self._stopping = False
+
+    def serve_forever(self):
+        self._stopping = False
+        try:
+            with Listener(self.address, authkey=self.authkey) as listener:
+                print(f"Instrument session listening on {self.address[0]}:{self.address[1]}")
+                while True:
+                    try:
+                        conn = listener.accept()
+                    except (AuthenticationError, EOFError, ConnectionError):
+                        continue  # a client without the key, or one that hung up in the handshake
+                    if self._stopping:
+                        conn.close()
+                        break
+                    threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self._remove_key()
+
+    def _remove_key(self):
+        """Deletes the published key, unless a newer session has replaced it."""
+        try:
+            if self.key_file is not None and session_key(self.key_file) == self.authkey:
+                os.remove(self.key_file)
+        except OSError:
+            pass
+
+    def shutdown(self):
+        self._stopping = True
+        # wake up accept() with a throwaway connection
+        Client(self.address, authkey=self.authkey).close()
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    name, method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if name == 'session':
+                    conn.send(('ok', sorted(self.instruments)))
+                    if method == 'shutdown':
+                        self.shutdown()
+                    continue
+                try:
+                    if name not in self.instruments:
+                        raise KeyError(f"No instrument '{name}' in this session.")
+                    if method.startswith('_') or method in SESSION_OWNED:
+                        raise AttributeError(f"'{method}' cannot be called through the session.")
+                    with self.locks[name]:
+                        result = getattr(self.instruments[name], method)(*args, **kwargs)
+                    reply = ('ok', result)
+                except Exception as e:
+                    # VISA errors do not always pickle, send a plain copy
+                    reply = ('error', RuntimeError(f"{type(e).__name__}: {e}"))
+                try:
+                    conn.send(reply)
+                except OSError:
+                    # the client gave up on this call (e.g. cancelled) and closed the connection
+                    return
+
+class InstrumentProxy:
+    """Client-side stand-in for a controller held by the session."""
+    def __init__(self, name, address=SESSION_ADDRESS, authkey=None):
+        self._name = name
+        # one connection per proxy so threads driving different instruments don't queue
+        self._address = address
+        self._authkey = session_key() if authkey is None else authkey
+        self._conn = Client(address, authkey=self._authkey)
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            if self._conn is None:
+                # the last call was interrupted; its reply went with the old connection
+                self._conn = Client(self._address, authkey=self._authkey)
+            try:
+                self._conn.send((self._name, method, args, kwargs))
+                status, result = self._conn.recv()
+            except BaseException:
+                # e.g. a cancel during recv(): don't let the next call read this reply
+                self._conn.close()
+                self._conn = None
+                raise
+        if status == 'error':
+            raise result
+        return result
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        if method in SESSION_OWNED:
+            return lambda *args, **kwargs: None
+        return lambda *args, **kwargs: self._call(method, *args, **kwargs)
+
+def session_running(address=SESSION_ADDRESS, authkey=None):
+    """Names of the instruments held by a running session, or None."""
+    try:
+        with Client(address, authkey=session_key() if authkey is None else authkey) as conn:
+            conn.send(('session', 'instruments', (), {}))
+            return conn.recv()[1]
+    except (OSError, EOFError, AuthenticationError):
+        # no key, nothing listening, or something else on the port
+        return None
+
+def stop_session(address=SESSION_ADDRESS, authkey=None):
+    with Client(address, authkey=session_key() if authkey is None else authkey) as conn:
+        conn.send(('session', 'shutdown', (), {}))
+        conn.recv()
+
+def open_instruments(*factories):
+    """
+    Returns one controller per (name, class) pair, e.g. ('magnet', MagnetController).
+    Uses the running session's instruments when there is one, otherwise creates
+    and connects the controllers locally.
+    """
+    held = session_running() or []
+    instruments = []
+    for name, factory in factories:
+        if name in held:
+            print(f"Using {name} from the instrument session.")
+            instruments.append(InstrumentProxy(name))
+        else:
+            instrument = factory()
+            instrument.connect()
+            instruments.append(instrument)
+    return instruments
+
+if __name__ == "__main__":
+    from EM3000S import MagnetController
+    from VNA import VNAController
+    # from lab_emulator import MagnetController, VNAController
+
+    if hasattr(signal, 'SIGBREAK'):
+        signal.signal(signal.SIGBREAK, signal.default_int_handler)
+
+    instruments = {}
+    for name, factory in (('magnet', MagnetController), ('vna', VNAController)):
+        try:
+            instrument = factory()
+            instrument.connect()
+            instruments[name] = instrument
+        except Exception as e:
+            print(f"Could not connect {name}: {e}")
+    if not instruments:
+        raise SystemExit("No instruments connected, session not started.")
+
+    server = InstrumentServer(instruments)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Closing instrument session...")
+        if 'magnet' in instruments:
+            instruments['magnet'].disconnect()
+        if 'vna' in instruments:
+            instruments['vna'].close()
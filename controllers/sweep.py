@@ -0,0 +1,141 @@
+import threading
+import queue
+from collections import namedtuple
+
+# one field point on its way through the pipeline
+Point = namedtuple("Point", ["index", "setpoint", "settled_field"])
+
+POLL_SEC = 0.1  # how often blocked stages check for a stop request
+
+# end of a stage's output; not None, which is a valid (missing) field reading
+_DONE = object()
+
+class SweepEngine:
+    """
+    Pipelined field sweep. Three threads, each the only user of its resource:
+      magnet: sets and settles point N+1 while point N's traces are transferred,
+              then reads the field the VNA actually swept at
+      vna:    sweeps once the field has settled, releases the magnet as soon as
+              the sweep is done, then fetches the traces
+      writer: saves point N and runs the on_point callbacks while later points
+              are still being acquired
+    The stages are connected by bounded queues, so a slow disk only stalls the
+    sweep once `write_buffer` points are waiting.
+    """
+    def __init__(self, magnet, vna, writer, setpoints, unit='mT', settle=None,
+                 on_point=None, write_buffer=4):
+        """
+        setpoints: sequence of fields (mT) or currents (A), depending on `unit`
+        settle:    keyword arguments for magnet.wait_for_settle()
+        on_point:  callables run by the writer thread as f(setpoint, field, freq, traces)
+        """
+        self.magnet = magnet
+        self.vna = vna
+        self.writer = writer
+        self.setpoints = list(setpoints)
+        self.unit = unit
+        self.settle = settle or {}
+        self.on_point = list(on_point or [])
+        self._acquire_q = queue.Queue(maxsize=1)
+        self._field_q = queue.Queue()
+        self._write_q = queue.Queue(maxsize=write_buffer)
+        self._swept = threading.Event()
+        self._stop = threading.Event()   # no new setpoints, finish the ones in flight
+        self._abort = threading.Event()  # a stage failed, everyone gives up
+        self._error = None
+        self.written = 0
+
+    # --- public API -----------------------------------------------------------
+    def run(self):
+        """Runs the sweep to completion; returns the number of points written."""
+        threads = [threading.Thread(target=self._guard, args=(stage,), name=stage.__name__, daemon=True)
+                   for stage in (self._magnet_stage, self._vna_stage, self._writer_stage)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(POLL_SEC)
+        except KeyboardInterrupt:
+            # save the points already in flight, then re-raise
+            self.stop()
+            for thread in threads:
+                thread.join()
+            raise
+        if self._error is not None:
+            raise self._error
+        return self.written
+
+    def stop(self):
+        """Stops issuing setpoints; points already being acquired are still saved."""
+        self._stop.set()
+
+    # --- stages ---------------------------------------------------------------
+    def _guard(self, stage):
+        try:
+            stage()
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+            self._abort.set()
+
+    def _magnet_stage(self):
+        set_point = self.magnet.set_current if self.unit == 'A' else self.magnet.set_field
+        n = len(self.setpoints)
+        for index, setpoint in enumerate(self.setpoints):
+            if self._stop.is_set():
+                break
+            print(f"[{index+1}/{n}] Setting field to {setpoint:.2f} {self.unit}")
+            set_point(setpoint)
+            settled, settle_time = self.magnet.wait_for_settle(**self.settle)
+            print(f"Settled at {settled} mT after {settle_time:.2f} s")
+            if not self._put(self._acquire_q, Point(index, setpoint, settled)):
+                break
+            # hold the field until the VNA has finished sweeping
+            while not self._swept.wait(POLL_SEC):
+                if self._abort.is_set():
+                    return
+            self._swept.clear()
+            field = self.magnet.query_field()
+            # settled is None when no reading was valid; the writer stores that as NaN
+            self._field_q.put(field if isinstance(field, float) else settled)
+        self._put(self._acquire_q, _DONE)
+
+    def _vna_stage(self):
+        while (point := self._get(self._acquire_q)) is not _DONE:
+            self.vna.trigger_sweep()
+            self._swept.set()
+            freq, traces = self.vna.fetch_all_sparams()
+            if not self._put(self._write_q, (point, freq, traces)):
+                return
+        self._put(self._write_q, _DONE)
+
+    def _writer_stage(self):
+        while (item := self._get(self._write_q)) is not _DONE:
+            point, freq, traces = item
+            field = self._get(self._field_q)
+            if field is _DONE:
+                return
+            self.writer.append(point.setpoint, field, freq, traces)
+            self.written += 1
+            for callback in self.on_point:
+                callback(point.setpoint, field, freq, traces)
+
+    # --- queue helpers that give up when the sweep is aborted -----------------
+    def _put(self, q, item):
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=POLL_SEC)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=POLL_SEC)
+            except queue.Empty:
+                pass
+        return _DONE
@@ -0,0 +1,259 @@
+"""
+Timing and tracing of instrument I/O. Every VISA write/query/read of a traced
+resource, every handshake step and every retry emits an Event to the sinks of
+the module-level `tracer`. Nothing is wrapped unless a sink is configured,
+normally through the SWEEP_TRACE environment variable (or .env), e.g.
+
+    SWEEP_TRACE=jsonl:data/trace.jsonl,counters
+
+Sinks: ring[:size] keeps the last events in memory, jsonl[:path] appends one
+JSON object per event, counters[:seconds] prints a '[trace] ...' summary line
+per source and operation every few seconds (shown live by app.py).
+"""
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple, deque, defaultdict
+
+TRACE_ENV = "SWEEP_TRACE"
+TRACE_FILE = os.path.join("data", "trace.jsonl")
+VI_ERROR_TMO = -1073807339  # VISA timeout status code
+DETAIL_CHARS = 60
+
+# one traced operation
+#   t:           wall-clock time the operation ended
+#   source:      'vna' or 'magnet'
+#   op:          write, query, read_bytes, ... for VISA calls; handshake, step,
+#                sweep, trace for protocol spans; retry for discarded replies
+#   detail:      command text or bytes sent, truncated
+#   duration_ms: time the operation took
+#   bytes_out:   bytes written
+#   bytes_in:    bytes read
+#   status:      'ok', 'timeout', 'error' or 'retry'
+#   context:     innermost protocol span the operation ran in, e.g. 'START 3'
+Event = namedtuple("Event", ["t", "source", "op", "detail", "duration_ms",
+                             "bytes_out", "bytes_in", "status", "context"])
+
+# --- sinks --------------------------------------------------------------------
+class RingBuffer:
+    """Keeps the most recent events in memory."""
+    def __init__(self, size=10000):
+        self._events = deque(maxlen=size)
+
+    def emit(self, event):
+        self._events.append(event)
+
+    def events(self):
+        return list(self._events)
+
+    def dump(self, path):
+        """Writes the buffered events as JSON lines, e.g. after a failure."""
+        with open(path, "w") as f:
+            for event in self.events():
+                f.write(json.dumps(event._asdict()) + "\n")
+
+    def close(self):
+        pass
+
+class JsonlSink:
+    """Appends one JSON object per event to a file."""
+    def __init__(self, path=TRACE_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event._asdict()) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class Counters:
+    """
+    Running totals per (source, op): calls, time, bytes, timeouts and errors.
+    Prints a one-line summary at most every `report_sec` seconds.
+    """
+    def __init__(self, report_sec=2.0):
+        self.report_sec = report_sec
+        self.totals = defaultdict(lambda: {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                           'bytes_out': 0, 'bytes_in': 0, 'timeouts': 0, 'errors': 0})
+        self._lock = threading.Lock()
+        self._last_report = time.monotonic()
+
+    def emit(self, event):
+        with self._lock:
+            entry = self.totals[(event.source, event.op)]
+            entry['calls'] += 1
+            entry['total_ms'] += event.duration_ms
+            entry['max_ms'] = max(entry['max_ms'], event.duration_ms)
+            entry['bytes_out'] += event.bytes_out
+            entry['bytes_in'] += event.bytes_in
+            entry['timeouts'] += event.status == 'timeout'
+            entry['errors'] += event.status == 'error'
+            due = self.report_sec is not None and time.monotonic() - self._last_report >= self.report_sec
+            if due:
+                self._last_report = time.monotonic()
+        if due:
+            self.report()
+
+    def snapshot(self):
+        with self._lock:
+            return {f"{source}.{op}": dict(entry) for (source, op), entry in self.totals.items()}
+
+    def summary(self, top=4):
+        """The operations that took the most time, e.g. 'vna.query 12x 340ms | ...'."""
+        parts = []
+        for name, entry in sorted(self.snapshot().items(), key=lambda item: -item[1]['total_ms'])[:top]:
+            part = f"{name} {entry['calls']}x {entry['total_ms']:.0f}ms (max {entry['max_ms']:.0f})"
+            if entry['timeouts']:
+                part += f" {entry['timeouts']} timeouts"
+            parts.append(part)
+        return " | ".join(parts)
+
+    def report(self):
+        print(f"[trace] {self.summary()}", flush=True)
+
+    def close(self):
+        if self.totals:
+            self.report()
+
+SINKS = {'ring': lambda arg: RingBuffer(int(arg) if arg else 10000),
+         'jsonl': lambda arg: JsonlSink(arg or TRACE_FILE),
+         'counters': lambda arg: Counters(float(arg) if arg else 2.0)}
+
+# --- tracer -------------------------------------------------------------------
+class Tracer:
+    """Sends events to its sinks; does nothing while it has none."""
+    def __init__(self):
+        self.sinks = []
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def configure(self, spec):
+        """Adds sinks from a spec such as 'jsonl:data/trace.jsonl,counters:5'."""
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            name, _, arg = item.partition(":")
+            if name not in SINKS:
+                raise ValueError(f"Unknown trace sink '{name}', expected one of {sorted(SINKS)}.")
+            self.add_sink(SINKS[name](arg))
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+
+    def context(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def emit(self, source, op, detail="", duration_ms=0.0, bytes_out=0, bytes_in=0, status='ok'):
+        if not self.sinks:
+            return
+        event = Event(time.time(), source, op, str(detail)[:DETAIL_CHARS], duration_ms,
+                      bytes_out, bytes_in, status, self.context())
+        for sink in self.sinks:
+            sink.emit(event)
+
+    @contextlib.contextmanager
+    def span(self, source, op, detail=""):
+        """Times a protocol-level operation; I/O inside it carries `detail` as context."""
+        if not self.sinks:
+            yield
+            return
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(detail)
+        status = 'ok'
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            stack.pop()
+            self.emit(source, op, detail, (time.perf_counter() - t0) * 1e3, status=status)
+
+tracer = Tracer()
+_configured = False
+
+def configure_from_env():
+    """Sets up the sinks named in SWEEP_TRACE once per process."""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    spec = os.getenv(TRACE_ENV)
+    if spec:
+        tracer.configure(spec)
+        atexit.register(tracer.close)
+
+# --- traced VISA resources ------------------------------------------------------
+def _size(value):
+    if value is None:
+        return 0
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    return len(value) if hasattr(value, '__len__') else 0
+
+def _describe(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value).strip()
+
+class TracedResource:
+    """
+    Stand-in for a pyvisa resource that emits an Event per I/O call.
+    Everything else, including attribute assignment, goes to the resource.
+    """
+    IO_METHODS = ('write', 'write_raw', 'read', 'read_raw', 'read_bytes',
+                  'query', 'query_binary_values', 'clear')
+
+    def __init__(self, resource, source, tracer=tracer):
+        object.__setattr__(self, '_resource', resource)
+        object.__setattr__(self, '_source', source)
+        object.__setattr__(self, '_tracer', tracer)
+
+    def __getattr__(self, name):
+        attr = getattr(self._resource, name)
+        if name not in self.IO_METHODS:
+            return attr
+        def traced_call(*args, **kwargs):
+            detail = _describe(args[0]) if args else ""
+            bytes_out = _size(args[0]) if args and name in ('write', 'write_raw', 'query',
+                                                             'query_binary_values') else 0
+            status, result = 'ok', None
+            t0 = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+                return result
+            except Exception as e:
+                status = 'timeout' if getattr(e, 'error_code', None) == VI_ERROR_TMO else 'error'
+                raise
+            finally:
+                self._tracer.emit(self._source, name, detail, (time.perf_counter() - t0) * 1e3,
+                                  bytes_out, 0 if name.startswith('write') else _size(result), status)
+        return traced_call
+
+    def __setattr__(self, name, value):
+        setattr(self._resource, name, value)
+
+def traced(resource, source):
+    """Wraps a VISA resource when tracing is configured, otherwise returns it unchanged."""
+    configure_from_env()
+    return TracedResource(resource, source) if tracer.enabled else resource
@@ -0,0 +1,298 @@
+"""
+VISA transport used by both controllers. resource_manager() normally returns
+a plain pyvisa.ResourceManager; SWEEP_TRANSPORT switches it to
+
+    record  every call on the opened resources (SCPI queries and writes, serial
+            byte exchanges, attribute settings, VISA errors) is passed to the
+            instrument and written with its timestamp and duration to a
+            gzipped JSON lines file of its own per process, named after
+            SWEEP_TRANSPORT_FILE, the script and the start time, e.g.
+            data/transport-experiment-20250131-120000-4242.jsonl.gz
+    replay  no instrument is opened; the calls are answered from the file
+            SWEEP_TRANSPORT_FILE (by default the latest recording of the same
+            script), taking their recorded time divided by SWEEP_REPLAY_SPEED
+            (1 = original speed, 0 = as fast as possible)
+
+A replay checks that the controllers send what was recorded and raises
+ReplayMismatch at the first call that differs. Their waits are therefore
+counted in calls, not seconds (see MagnetController.wait_for_settle), so a
+replay at any speed makes the same calls as the recorded run.
+"""
+import atexit
+import base64
+import gzip
+import json
+import glob
+import os
+import sys
+import threading
+import time
+import numpy as np
+import pyvisa
+
+TRANSPORT_ENV = "SWEEP_TRANSPORT"
+TRANSPORT_FILE_ENV = "SWEEP_TRANSPORT_FILE"
+REPLAY_SPEED_ENV = "SWEEP_REPLAY_SPEED"
+TRANSPORT_FILE = os.path.join("data", "transport.jsonl.gz")
+RECORDING_VERSION = 1
+FLUSH_SEC = 1.0  # recordings are flushed at least this often, so a crash loses little
+
+# calls that are recorded and replayed; anything else goes to the resource
+IO_METHODS = ('write', 'write_raw', 'read', 'read_raw', 'read_bytes',
+              'query', 'query_binary_values', 'clear', 'close')
+
+class ReplayMismatch(RuntimeError):
+    """The replayed controllers did something the recording did not."""
+
+def _encode(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'bytes': base64.b64encode(value).decode()}
+    if isinstance(value, np.ndarray):
+        return {'array': base64.b64encode(np.ascontiguousarray(value).tobytes()).decode(),
+                'dtype': value.dtype.str, 'shape': list(value.shape)}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    if isinstance(value, (np.integer, np.floating)):
+        return value.item()
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)  # enums such as pyvisa.constants.Parity
+
+def _decode(value):
+    if isinstance(value, dict) and 'bytes' in value:
+        return base64.b64decode(value['bytes'])
+    if isinstance(value, dict) and 'array' in value:
+        data = np.frombuffer(base64.b64decode(value['array']), dtype=value['dtype'])
+        return data.reshape(value['shape']).copy()
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+# --- recording ------------------------------------------------------------------
+def _stem(path):
+    """'data/transport.jsonl.gz' -> ('data/transport', '.jsonl.gz')"""
+    for ext in ('.jsonl.gz', '.gz'):
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+    return os.path.splitext(path)
+
+def _script():
+    return os.path.splitext(os.path.basename(sys.argv[0] or ''))[0] or 'python'
+
+def recording_path(path=TRANSPORT_FILE):
+    """
+    File for a new recording of this process, so the session, experiment and
+    detect processes recording at the same time never share one.
+    """
+    stem, ext = _stem(path)
+    return f"{stem}-{_script()}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}{ext}"
+
+def latest_recording(path=TRANSPORT_FILE):
+    """path itself if it exists, otherwise the newest recording of this script named after it."""
+    if os.path.exists(path):
+        return path
+    stem, ext = _stem(path)
+    found = glob.glob(f"{glob.escape(stem)}-{glob.escape(_script())}-*{ext}")
+    if not found:
+        raise FileNotFoundError(f"No recording {path} or {stem}-{_script()}-*{ext} to replay.")
+    return max(found, key=os.path.getmtime)
+
+class Recorder:
+    """Appends calls to a gzipped JSON lines file; shared by every resource of the process."""
+    def __init__(self, path=TRANSPORT_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._file = gzip.open(path, "wt")
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self._last_flush = self._t0
+        self._resources = 0
+        self._write({'version': RECORDING_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        atexit.register(self.close)
+
+    def _write(self, entry):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps(entry) + "\n")
+            if time.monotonic() - self._last_flush >= FLUSH_SEC:
+                self._file.flush()
+                self._last_flush = time.monotonic()
+
+    def open(self, source, name):
+        with self._lock:
+            res = self._resources
+            self._resources += 1
+        self._write({'t': time.monotonic() - self._t0, 'res': res, 'op': 'open',
+                     'source': source, 'name': name})
+        return res
+
+    def record(self, res, op, args, kwargs, t_start, duration, result=None, error=None):
+        entry = {'t': t_start - self._t0, 'dt': duration, 'res': res, 'op': op,
+                 'args': _encode(list(args)), 'kwargs': _encode(kwargs) if kwargs else {}}
+        if error is not None:
+            entry['error'] = error
+        else:
+            entry['result'] = _encode(result)
+        self._write(entry)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class RecordingResource:
+    """Passes every call to a real resource and records it."""
+    def __init__(self, resource, recorder, res):
+        object.__setattr__(self, '_resource', resource)
+        object.__setattr__(self, '_recorder', recorder)
+        object.__setattr__(self, '_res', res)
+
+    def __getattr__(self, name):
+        attr = getattr(self._resource, name)
+        if name not in IO_METHODS:
+            return attr
+        def recorded_call(*args, **kwargs):
+            t0 = time.monotonic()
+            try:
+                result = attr(*args, **kwargs)
+            except pyvisa.errors.VisaIOError as e:
+                self._recorder.record(self._res, name, args, kwargs, t0, time.monotonic() - t0,
+                                      error=e.error_code)
+                raise
+            self._recorder.record(self._res, name, args, kwargs, t0, time.monotonic() - t0, result)
+            return result
+        return recorded_call
+
+    def __setattr__(self, name, value):
+        setattr(self._resource, name, value)
+        self._recorder.record(self._res, 'set', [name, value], {}, time.monotonic(), 0.0)
+
+class RecordingResourceManager:
+    def __init__(self, rm, recorder, source):
+        self.rm = rm
+        self.recorder = recorder
+        self.source = source
+
+    def open_resource(self, name, **kwargs):
+        resource = self.rm.open_resource(name, **kwargs)
+        return RecordingResource(resource, self.recorder, self.recorder.open(self.source, name))
+
+    def close(self):
+        self.rm.close()
+
+    def __getattr__(self, name):
+        return getattr(self.rm, name)
+
+# --- replay -----------------------------------------------------------------------
+class Recording:
+    """A recording loaded for replay: the calls of each resource, in order."""
+    def __init__(self, path=TRANSPORT_FILE):
+        self.path = path
+        with gzip.open(path, "rt") as f:
+            header = json.loads(f.readline())
+            if header.get('version') != RECORDING_VERSION:
+                raise ValueError(f"{path} is a version {header.get('version')} recording, "
+                                 f"expected version {RECORDING_VERSION}.")
+            self.opened = []   # (res, source, name) in the order they were opened
+            self.calls = {}    # res -> list of entries
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # torn last line of a recording that crashed
+                if entry['op'] == 'open':
+                    self.opened.append((entry['res'], entry['source'], entry['name']))
+                    self.calls[entry['res']] = []
+                else:
+                    self.calls[entry['res']].append(entry)
+        self._lock = threading.Lock()
+
+    def claim(self, source, name):
+        """The calls of the next recorded resource that `source` opened."""
+        with self._lock:
+            for i, (res, rec_source, rec_name) in enumerate(self.opened):
+                if rec_source == source:
+                    del self.opened[i]
+                    return rec_name, self.calls[res]
+        raise ReplayMismatch(f"{self.path} has no more {source} resources to open ({name}).")
+
+class ReplayResource:
+    """Answers the controllers' calls from a recording."""
+    def __init__(self, name, calls, speed):
+        object.__setattr__(self, 'resource_name', name)
+        object.__setattr__(self, '_calls', calls)
+        object.__setattr__(self, '_next', 0)
+        object.__setattr__(self, '_speed', speed)
+        object.__setattr__(self, '_attrs', {})
+
+    def _replay(self, op, args, kwargs=None):
+        if self._next >= len(self._calls):
+            raise ReplayMismatch(f"{self.resource_name}: {op}{tuple(args)} after the end of the recording.")
+        entry = self._calls[self._next]
+        object.__setattr__(self, '_next', self._next + 1)
+        if entry['op'] != op or entry['args'] != _encode(list(args)):
+            raise ReplayMismatch(f"{self.resource_name} call {self._next}: expected "
+                                 f"{entry['op']}{tuple(_decode(entry['args']))}, got {op}{tuple(args)}.")
+        if self._speed > 0 and entry.get('dt'):
+            time.sleep(entry['dt'] / self._speed)
+        if 'error' in entry:
+            raise pyvisa.errors.VisaIOError(entry['error'])
+        return _decode(entry.get('result'))
+
+    def __getattr__(self, name):
+        if name in IO_METHODS:
+            return lambda *args, **kwargs: self._replay(name, args, kwargs)
+        try:
+            return self._attrs[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        self._replay('set', [name, value])
+        self._attrs[name] = value
+
+class ReplayResourceManager:
+    def __init__(self, recording, source, speed=0.0):
+        self.recording = recording
+        self.source = source
+        self.speed = speed
+
+    def open_resource(self, name, **kwargs):
+        rec_name, calls = self.recording.claim(self.source, name)
+        return ReplayResource(rec_name, calls, self.speed)
+
+    def close(self):
+        pass
+
+# --- selection ------------------------------------------------------------------
+_shared = {}  # the process' Recorder or Recording, created on first use
+
+def configure(mode=None, path=None, speed=None):
+    """Overrides the SWEEP_TRANSPORT settings for this process, e.g. from benchmark.py."""
+    _shared.clear()
+    for key, value in ((TRANSPORT_ENV, mode), (TRANSPORT_FILE_ENV, path), (REPLAY_SPEED_ENV, speed)):
+        if value is not None:
+            os.environ[key] = str(value)
+
+def resource_manager(backend=None, source='visa'):
+    """
+    ResourceManager for a controller; `source` ('magnet', 'vna') tells the
+    replay which recorded resources belong to it.
+    """
+    mode = os.getenv(TRANSPORT_ENV, 'visa')
+    path = os.getenv(TRANSPORT_FILE_ENV, TRANSPORT_FILE)
+    if mode == 'replay':
+        if 'recording' not in _shared:
+            _shared['recording'] = Recording(latest_recording(path))
+        return ReplayResourceManager(_shared['recording'], source, float(os.getenv(REPLAY_SPEED_ENV, "0")))
+    rm = pyvisa.ResourceManager(backend) if backend else pyvisa.ResourceManager()
+    if mode == 'record':
+        if 'recorder' not in _shared:
+            _shared['recorder'] = Recorder(recording_path(path))
+            print(f"Recording instrument calls to {_shared['recorder'].path}.")
+        return RecordingResourceManager(rm, _shared['recorder'], source)
+    if mode != 'visa':
+        raise ValueError(f"Unknown {TRANSPORT_ENV} '{mode}', expected 'visa', 'record' or 'replay'.")
+    return rm
@@ -0,0 +1,140 @@
+import os, sys
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'controllers'))
+from calibration_model import FieldCalibration, fit_model, read_raw, save_model
+from EM3000S import MagnetController
+
+def write_calibration(path, currents, fields, branches):
+    pd.DataFrame({'Current_A': currents, 'Field_mT': fields, 'Branch': branches}).to_csv(path, index=False)
+
+def write_hysteresis(path):
+    """Linear branches sampled 1 A apart, the down branch 10 mT above the up branch."""
+    current = np.linspace(-4, 4, 9)
+    write_calibration(path, np.concatenate([current, current[::-1]]),
+                      np.concatenate([50 * current, 50 * current[::-1] + 10]), ['up'] * 9 + ['down'] * 9)
+    return current
+
+class CalibrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.csv = os.path.join(self.workdir.name, 'field_calibration_data.csv')
+        self.model = os.path.join(self.workdir.name, 'calibration_model.json')
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+class CalibrationSourceTest(CalibrationTestCase):
+    def setUp(self):
+        super().setUp()
+        # a curve the degree-5 fit cannot follow exactly
+        current = np.linspace(-4, 4, 41)
+        field = 100 * np.tanh(current) + 3 * np.sign(current) * (np.abs(current) > 2)
+        write_calibration(self.csv, np.concatenate([current, current]), np.concatenate([field, field]),
+                          ['up'] * 41 + ['down'] * 41)
+        save_model(fit_model(read_raw(self.csv), source=self.csv), self.model)
+        self.samples = current, field
+
+    def test_table_is_the_default_even_with_a_model(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop('FIELD_CALIBRATION', None)
+            calibration = FieldCalibration(self.csv, self.model)
+        current, field = self.samples
+        np.testing.assert_allclose(calibration.field_for(current), field)
+        self.assertIsNone(calibration.model)
+
+    def test_model_is_opt_in(self):
+        with mock.patch.dict(os.environ, {'FIELD_CALIBRATION': 'model'}):
+            calibration = FieldCalibration(self.csv, self.model)
+        current, field = self.samples
+        calibration.field_for(current)
+        self.assertIsNotNone(calibration.model)
+        self.assertFalse(np.allclose(calibration.field_for(current), field))
+
+    def test_unknown_source_raises(self):
+        with mock.patch.dict(os.environ, {'FIELD_CALIBRATION': 'poly'}):
+            with self.assertRaises(ValueError):
+                FieldCalibration(self.csv, self.model)
+
+class FieldCalibrationTest(CalibrationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.current = write_hysteresis(self.csv)
+        self.calibration = FieldCalibration(self.csv, self.model, use_model=False)
+
+    def test_interpolates_between_samples(self):
+        np.testing.assert_allclose(self.calibration.current_for([25.0, -12.5], 'up'), [0.5, -0.25])
+        np.testing.assert_allclose(self.calibration.field_for([0.5, -0.25], 'up'), [25.0, -12.5])
+
+    def test_clips_to_the_calibrated_range(self):
+        self.assertEqual(self.calibration.field_range('up'), (-200.0, 200.0))
+        self.assertEqual(self.calibration.current_for(500.0, 'up'), 4.0)
+        self.assertEqual(self.calibration.field_for(-5.0, 'down'), -190.0)
+
+    def test_branches_use_their_own_samples(self):
+        self.assertAlmostEqual(self.calibration.current_for(35.0, 'up'), 0.7)
+        self.assertAlmostEqual(self.calibration.current_for(35.0, 'down'), 0.5)
+        self.assertEqual(self.calibration.field_range('down'), (-190.0, 210.0))
+
+    def test_single_sweep_serves_both_branches(self):
+        pd.DataFrame({'Current_A': self.current, 'Field_mT': 50 * self.current}).to_csv(self.csv, index=False)
+        calibration = FieldCalibration(self.csv, self.model, use_model=False)
+        for branch in ('up', 'down'):
+            self.assertAlmostEqual(calibration.current_for(35.0, branch), 0.7)
+
+    def test_noisy_samples_are_made_invertible(self):
+        write_calibration(self.csv, [0.0, 1.0, 2.0, 3.0], [0.0, 60.0, 50.0, 150.0], ['up'] * 4)
+        calibration = FieldCalibration(self.csv, self.model, use_model=False)
+        calibration.refresh()
+        current, field = calibration.tables['up']
+        self.assertTrue((np.diff(field) > 0).all())
+        self.assertTrue((np.diff(current) > 0).all())
+
+    def test_reloads_when_the_csv_changes(self):
+        self.assertAlmostEqual(self.calibration.current_for(25.0, 'up'), 0.5)
+        write_calibration(self.csv, self.current, 100 * self.current, ['up'] * 9)
+        stat = os.stat(self.csv)
+        os.utime(self.csv, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertAlmostEqual(self.calibration.current_for(25.0, 'up'), 0.25)
+        # a fresh instance reads the rebuilt sidecar
+        self.assertAlmostEqual(FieldCalibration(self.csv, self.model, use_model=False).current_for(25.0, 'up'), 0.25)
+
+class BranchSelectionTest(CalibrationTestCase):
+    def setUp(self):
+        super().setUp()
+        write_hysteresis(self.csv)
+        self.magnet = MagnetController.__new__(MagnetController)
+        self.magnet.calibration = FieldCalibration(self.csv, self.model, use_model=False)
+        self.magnet._last_field = 0.0
+        self.magnet._branch = 'up'
+        self.magnet.currents = []
+        self.magnet.set_current = self.magnet.currents.append
+
+    def test_branch_follows_the_approach_direction(self):
+        fields = [35.0, 60.0, 35.0, 35.0, 60.0]
+        for field in fields:
+            self.assertEqual(self.magnet.set_field(field), field)
+        # rising: up branch; falling and holding: down branch
+        np.testing.assert_allclose(self.magnet.currents, [0.7, 1.2, 0.5, 0.5, 1.2])
+        self.assertEqual(self.magnet._branch, 'up')
+
+    def test_preflight_plans_the_same_branches(self):
+        fields = [35.0, 60.0, 35.0, 35.0, 60.0]
+        # payloads are checked in test_magnet, compare the planned currents here
+        self.magnet.dac = mock.Mock(encode_many=lambda currents: currents)
+        planned = self.magnet.preflight(fields)
+        for field in fields:
+            self.magnet.set_field(field)
+        np.testing.assert_allclose(planned, self.magnet.currents)
+
+    def test_preflight_rejects_fields_outside_the_branch(self):
+        # 205 mT is on the down branch only
+        with self.assertRaises(ValueError):
+            self.magnet.preflight([205.0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import os, sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'controllers'))
+from journal import Journal
+
+DEFINITION = {'unit': 'mT', 'low': -10.0, 'high': 10.0, 'step': 1.0}
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.workdir.name, 'journal.jsonl')
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def _reopen_after_writing(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        journal = Journal(self.path, DEFINITION)
+        journal.record(setpoint=1.0)
+        journal.close()
+        journal = Journal(self.path, DEFINITION)
+        journal.close()
+        return journal.entries
+
+    def test_empty_journal_starts_anew(self):
+        self.assertEqual(self._reopen_after_writing(''), [{'setpoint': 1.0}])
+
+    def test_torn_header_starts_anew(self):
+        self.assertEqual(self._reopen_after_writing('{"definition": {"un'), [{'setpoint': 1.0}])
+
+    def test_other_definition_raises(self):
+        Journal(self.path, DEFINITION).close()
+        with self.assertRaises(RuntimeError):
+            Journal(self.path, {**DEFINITION, 'step': 2.0})
+
+if __name__ == "__main__":
+    unittest.main()
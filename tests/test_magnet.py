@@ -0,0 +1,131 @@
+import os, sys
+import unittest
+import numpy as np
+import pyvisa
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'controllers'))
+from EM3000S import DacEncoder, MagnetController, start_steps
+from calibration_model import DAC_COEFFS
+
+class ScriptedMagnet(MagnetController):
+    """MagnetController answering query_field() from a list, without a connection."""
+    def __init__(self, readings):
+        self.readings = list(readings)
+        self.queries = 0
+
+    def query_field(self):
+        self.queries += 1
+        return self.readings.pop(0) if self.readings else 0.0
+
+class WaitForSettleTest(unittest.TestCase):
+    def test_settles_on_agreeing_readings(self):
+        magnet = ScriptedMagnet([10.0, 5.0, 5.1, 5.2, 9.0])
+        field, _ = magnet.wait_for_settle(interval_sec=0.001)
+        self.assertEqual(field, 5.2)
+        self.assertEqual(magnet.queries, 4)
+
+    def test_timeout_counts_polls_not_seconds(self):
+        # a replay runs at another speed than the recording, it must poll as often
+        for interval_sec in (0.001, 0.01):
+            magnet = ScriptedMagnet([float(i) for i in range(100)])
+            field, _ = magnet.wait_for_settle(interval_sec=interval_sec, max_wait_sec=interval_sec * 20)
+            self.assertEqual(magnet.queries, 20)
+            self.assertEqual(field, 19.0)
+
+    def test_missing_readings_give_none(self):
+        magnet = ScriptedMagnet(["Query Failed"] * 10)
+        field, _ = magnet.wait_for_settle(interval_sec=0.001, max_wait_sec=0.005)
+        self.assertIsNone(field)
+        self.assertEqual(magnet.queries, 5)
+
+class SerialStub:
+    """Serial resource that answers with the given bytes, then times out."""
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.written = b""
+        self.timeout = None
+
+    def write_raw(self, data):
+        self.written += data
+
+    def read_bytes(self, count):
+        if len(self.replies) < count:
+            self.replies = []
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+        data, self.replies = bytes(self.replies[:count]), self.replies[count:]
+        return data
+
+class PipelinedStepsTest(unittest.TestCase):
+    def magnet(self, replies):
+        magnet = MagnetController.__new__(MagnetController)
+        magnet.inst = SerialStub(replies)
+        magnet._timeout_ms = None
+        magnet.pipelining = True
+        return magnet
+
+    def test_lock_step_by_default(self):
+        self.assertFalse(MagnetController.pipelining)
+
+    def test_timeout_keeps_the_replies_that_arrived(self):
+        # steps 1-2 pipelined, then step 3 waits for ACK, which never comes
+        magnet = self.magnet([0x64, 0x65])
+        replies = magnet._run_steps(start_steps(bytes(4)))
+        self.assertEqual(replies[:3], [0x64, 0x65, None])
+        self.assertEqual(magnet.inst.written[:3], b"\x64\x64\x1E")
+
+    def test_partial_batch(self):
+        magnet = self.magnet([0x01, 0x02, 0x03])
+        replies = magnet._exchange_pipelined(start_steps(bytes(4))[3:9])
+        self.assertEqual(replies, [0x01, 0x02, 0x03, None, None, None])
+
+class DacEncoderTest(unittest.TestCase):
+    @staticmethod
+    def legacy_current_map(current_amps):
+        """MagnetController._current_map before DacEncoder, without its debug print."""
+        def map_func(amp):
+            amp = 4.76264*amp**3 + 2.00444*amp**2 + 252.08648*amp - 8.46937
+            return int(amp)
+        pos = 1
+        if current_amps<0:
+            current_amps = abs(current_amps)
+            pos = 0
+        mapped = hex(map_func(current_amps))
+        return_list = [0x00]*4
+        try:
+            return_list[1] = int(mapped[-2:],16)
+        except ValueError:
+            return_list[1] = 0
+        if (zeroth:=mapped.split('x')[1][:-2])!='':
+            return_list[0] = int(zeroth,16)
+        return_list[-1] = pos
+        return return_list
+
+    def setUp(self):
+        self.dac = DacEncoder(DAC_COEFFS)
+        self.currents = np.linspace(-4.0, 4.0, 16001)
+
+    def test_matches_legacy_bytes(self):
+        # except codes 1-15, which the legacy hex slicing ('0x5'[-2:] == 'x5') sent as 0
+        single_digit = (self.dac.codes(self.currents) >= 1) & (self.dac.codes(self.currents) <= 15)
+        self.assertTrue(single_digit.any())
+        for current in self.currents[~single_digit]:
+            self.assertEqual(self.dac.encode(current), bytes(self.legacy_current_map(current)), current)
+
+    def test_single_hex_digit_codes(self):
+        for code in range(1, 16):
+            # smallest current whose code is `code`, searched on a fine grid
+            current = self.currents[np.argmax(self.dac.codes(self.currents) == code)]
+            self.assertEqual(self.legacy_current_map(current)[:2], [0, 0])
+            self.assertEqual(self.dac.encode(current)[:2], bytes([0, code]))
+
+    def test_encode_many_matches_encode(self):
+        payloads = self.dac.encode_many(self.currents)
+        self.assertEqual([bytes(row) for row in payloads], [self.dac.encode(c) for c in self.currents])
+
+    def test_out_of_range_raises(self):
+        for current in (4.01, -4.01, float('nan')):
+            with self.assertRaises(ValueError):
+                self.dac.encode(current)
+
+if __name__ == "__main__":
+    unittest.main()
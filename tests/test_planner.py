@@ -0,0 +1,69 @@
+import os, sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'controllers'))
+from planner import order_setpoints, refine_setpoints
+
+def stepped_s21(setpoints):
+    """|S21| over 5 points that jumps by 1.0 between 4 and 5 and by 0.1 between 7 and 8."""
+    level = 1.0 + 1.0 * (setpoints > 4.5) + 0.1 * (setpoints > 7.5)
+    return np.outer(level, np.ones(5)) * np.exp(1j * 0.3)
+
+class RefineSetpointsTest(unittest.TestCase):
+    def setUp(self):
+        # measured out of order, as a serpentine sweep leaves them
+        self.setpoints = np.array([10.0, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0])
+        self.s21 = stepped_s21(self.setpoints)
+
+    def test_splits_the_fastest_changes_first(self):
+        np.testing.assert_allclose(refine_setpoints(self.setpoints, self.s21, 1, 0.1), [4.5])
+        np.testing.assert_allclose(refine_setpoints(self.setpoints, self.s21, 2, 0.1), [4.5, 7.5])
+
+    def test_flat_intervals_are_not_split(self):
+        np.testing.assert_allclose(refine_setpoints(self.setpoints, self.s21, 10, 0.1), [4.5, 7.5])
+        self.assertEqual(refine_setpoints(self.setpoints, self.s21, 0, 0.1).size, 0)
+
+    def test_min_step(self):
+        self.assertEqual(refine_setpoints(self.setpoints, self.s21, 10, 0.6).size, 0)
+        setpoints = np.append(self.setpoints, 4.2)
+        # 4.2-5 is wide enough, 4-4.2 is not
+        refined = refine_setpoints(setpoints, stepped_s21(setpoints), 10, 0.3)
+        np.testing.assert_allclose(refined, [4.6, 7.5])
+
+    def test_resonance_metric(self):
+        freq = np.linspace(1e9, 2e9, 101)
+        # the dip moves 2 points per setpoint, and 22 between 5 and 6
+        dip = (10 + 2 * self.setpoints + 20 * (self.setpoints > 5)).astype(int)
+        s21 = 1 - 0.5 * (np.arange(freq.size) == dip[:, None])
+        np.testing.assert_allclose(refine_setpoints(self.setpoints, s21, 1, 0.1, 'resonance', freq), [5.5])
+        self.assertEqual(refine_setpoints(self.setpoints, s21, 20, 0.1, 'resonance', freq).size, 10)
+
+    def test_unknown_metric_raises(self):
+        with self.assertRaises(ValueError):
+            refine_setpoints(self.setpoints, self.s21, 1, 0.1, metric='phase')
+
+class OrderSetpointsTest(unittest.TestCase):
+    def setUp(self):
+        self.setpoints = [10.0, -10.0, 0.0, 5.0, -5.0, 5.0]
+
+    def test_single_pass_starts_at_the_nearest_end(self):
+        np.testing.assert_array_equal(order_setpoints(self.setpoints, start=-20.0), [-10, -5, 0, 5, 10])
+        np.testing.assert_array_equal(order_setpoints(self.setpoints, start=8.0), [10, 5, 0, -5, -10])
+
+    def test_serpentine_reverses_every_pass(self):
+        order = order_setpoints(self.setpoints, start=0.0, repeats=3)
+        np.testing.assert_array_equal(order, [-10, -5, 0, 5, 10, 10, 5, 0, -5, -10, -10, -5, 0, 5, 10])
+        # one reversal per pass, so every pass stays on one hysteresis branch
+        moves = np.sign(np.diff(order))
+        self.assertEqual(np.count_nonzero(np.diff(moves[moves != 0])), 2)
+
+    def test_without_serpentine_every_pass_runs_the_same_way(self):
+        order = order_setpoints(self.setpoints, start=20.0, repeats=2, serpentine=False)
+        np.testing.assert_array_equal(order, [10, 5, 0, -5, -10, 10, 5, 0, -5, -10])
+
+    def test_empty(self):
+        self.assertEqual(order_setpoints([], repeats=2).size, 0)
+
+if __name__ == "__main__":
+    unittest.main()
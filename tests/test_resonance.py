@@ -0,0 +1,48 @@
+import os, sys
+import unittest
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'controllers'))
+from lab_emulator import VNAController
+from resonance import track_resonance
+
+def emulated_s21(fields, seed=0):
+    """S21 of the emulated sample at each field, as the emulator VNA returns it."""
+    cwd = os.getcwd()
+    os.chdir(ROOT)  # the emulator reads its background from dev/
+    try:
+        vna = VNAController(seed=seed)
+    finally:
+        os.chdir(cwd)
+    return vna, np.array([vna._response(field)['s21'] for field in fields])
+
+class TrackResonanceTest(unittest.TestCase):
+    def test_default_sweep_on_emulator_data(self):
+        # the default params.ini sweep: most resonances lie below the band
+        fields = np.arange(-100.0, 100.0 + 10.0, 10.0)
+        vna, s21 = emulated_s21(fields)
+        track = track_resonance(fields, vna.freq, s21, unit='mT', workers=1)
+        in_band = vna.resonance_GHz(fields) * 1e9 > vna.freq[0]
+        self.assertTrue(track['ok'].any())
+        # no noise spikes or band-edge tails where the resonance is out of the band
+        np.testing.assert_array_equal(track['ok'] & ~in_band, False)
+        expected = vna.resonance_GHz(fields[track['ok']]) * 1e9
+        np.testing.assert_allclose(track['f_res'][track['ok']], expected, rtol=2e-3)
+        self.assertIn('kittel', track)
+        self.assertAlmostEqual(track['kittel']['gamma_GHz_per_T'], vna.physics['gamma_GHz_per_T'], delta=1.5)
+
+    def test_failed_kittel_fit_keeps_the_track(self):
+        # a resonance that does not move with the field cannot be fitted with Kittel
+        fields = np.linspace(10.0, 100.0, 10)
+        freq = np.linspace(4e9, 6e9, 801)
+        line = 1e-3 / (1 - 1j * (freq - 5e9) / 20e6)
+        rng = np.random.default_rng(0)
+        s21 = np.array([line * (field > 50) + 1e-6 * rng.normal(size=freq.size) for field in fields])
+        track = track_resonance(fields, freq, s21, unit='mT', workers=1)
+        self.assertNotIn('kittel', track)
+        self.assertTrue(track['ok'].any())
+        self.assertTrue(np.isnan(track['delta_h']).all())
+
+if __name__ == "__main__":
+    unittest.main()
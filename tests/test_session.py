@@ -0,0 +1,60 @@
+import os, sys
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'controllers'))
+from session import InstrumentServer, InstrumentProxy, session_key, session_running, stop_session
+
+class Echo:
+    def echo(self, value):
+        return value
+
+def free_address():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()
+
+class SessionKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.key_file = os.path.join(self.workdir.name, 'session.key')
+        self.address = free_address()
+        self.server = InstrumentServer({'echo': Echo()}, address=self.address, key_file=self.key_file)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        for _ in range(100):  # until the listener is up
+            if session_running(self.address, self.server.authkey) is not None:
+                break
+            self.thread.join(0.05)
+
+    def tearDown(self):
+        if self.thread.is_alive():
+            stop_session(self.address, self.server.authkey)
+            self.thread.join(5)
+        self.workdir.cleanup()
+
+    def test_key_is_random_and_private(self):
+        key = session_key(self.key_file)
+        self.assertEqual(key, self.server.authkey)
+        self.assertGreaterEqual(len(key), 32)
+        self.assertNotEqual(key, InstrumentServer({}, key_file=self.key_file + '2').authkey)
+        if os.name != 'nt':
+            self.assertEqual(stat.S_IMODE(os.stat(self.key_file).st_mode), 0o600)
+
+    def test_only_key_holders_connect(self):
+        self.assertEqual(session_running(self.address, session_key(self.key_file)), ['echo'])
+        self.assertIsNone(session_running(self.address, b'sweep-interface'))
+        # a client with the wrong key does not take the session down
+        proxy = InstrumentProxy('echo', self.address, session_key(self.key_file))
+        self.assertEqual(proxy.echo(3), 3)
+
+    def test_key_removed_when_session_stops(self):
+        stop_session(self.address, self.server.authkey)
+        self.thread.join(5)
+        self.assertFalse(os.path.exists(self.key_file))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os, sys
+import tempfile
+import threading
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'controllers'))
+from dataset import SweepWriter, load_sweep
+from sweep import SweepEngine
+
+FREQ = np.linspace(1e9, 2e9, 11)
+
+class NoReadingMagnet:
+    """Magnet whose field queries never give a valid reading."""
+    def set_field(self, field):
+        pass
+
+    def wait_for_settle(self, **kwargs):
+        return None, 0.0
+
+    def query_field(self):
+        return None
+
+class StubVNA:
+    def trigger_sweep(self):
+        pass
+
+    def fetch_all_sparams(self):
+        return FREQ, {s: np.ones(FREQ.size, dtype=complex) for s in ('s11', 's12', 's21', 's22')}
+
+class SweepEngineTest(unittest.TestCase):
+    def test_missing_field_readings_are_saved_as_nan(self):
+        setpoints = [0.0, 10.0, 20.0, 30.0, 40.0, 50.0]
+        with tempfile.TemporaryDirectory() as workdir:
+            writer = SweepWriter(workdir, len(setpoints), 'mT')
+            engine = SweepEngine(NoReadingMagnet(), StubVNA(), writer, setpoints, write_buffer=1)
+            result = {}
+            thread = threading.Thread(target=lambda: result.update(written=engine.run()), daemon=True)
+            thread.start()
+            thread.join(10)
+            if thread.is_alive():
+                engine._abort.set()
+                self.fail("SweepEngine hung on a None field reading")
+            writer.close()
+            self.assertEqual(result['written'], len(setpoints))
+            fields, saved_setpoints, _, _, meta = load_sweep(workdir)
+            self.assertEqual(meta['n_points'], len(setpoints))
+            self.assertTrue(np.all(np.isnan(fields)))
+            np.testing.assert_array_equal(saved_setpoints, setpoints)
+
+if __name__ == "__main__":
+    unittest.main()